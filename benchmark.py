@@ -0,0 +1,231 @@
+import argparse
+import contextlib
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, Iterable, List, Tuple
+
+import numpy as np
+try:
+	import resource
+except ImportError:  # it's not available on Windows
+	resource = None
+
+from cosy_batch import count_batch_points
+from cosy_output import parse_cosy_output
+from cosy_pool import CosyPool
+from fake_cosy import InProcessPool, fake_output
+
+WORKFLOWS = ["optimize", "tolerances", "tilt-scan"]
+FOX_FILES = ["MRSt_OMEGA.fox", "MRSt_tol.fox"]
+
+
+class CountingPool:
+	""" a wrapper around a pool that keeps track of how many scripts (and how many points, since a batch
+		script has several) went thru it and how long it took
+	"""
+	def __init__(self, pool):
+		self.pool = pool
+		self.num_workers = getattr(pool, "num_workers", 1)
+		self.num_runs = 0
+		self.num_points = 0
+		self.time_running = 0.
+
+	def run(self, script: str) -> str:
+		return self.map([script])[0]
+
+	def map(self, scripts: Iterable[str]) -> List[str]:
+		return [output for output, timings in self.map_with_timings(scripts)]
+
+	def map_with_timings(self, scripts: Iterable[str]) -> List[Tuple[str, Dict[str, float]]]:
+		scripts = list(scripts)
+		start = time.perf_counter()
+		runs = self.pool.map_with_timings(scripts)
+		self.time_running += time.perf_counter() - start
+		self.num_runs += len(scripts)
+		self.num_points += sum(count_batch_points(script) for script in scripts)
+		return runs
+
+	def close(self) -> None:
+		self.pool.close()
+
+
+def benchmark_optimize(pool: CountingPool, num_points: int, num_iterations: int, batch_size: int = 1
+                       ) -> Dict[str, float]:
+	""" evaluate a batch of points around the default design twice (the second time should all come out of
+		the store) and then do a short serial Nelder-Mead run
+	"""
+	import optimize
+	optimize.pool = pool
+	optimize.BATCH_SIZE = batch_size
+	requested = [0]
+	evaluate_batch = optimize.evaluate_batch
+	def counting_evaluate_batch(parameter_sets, order=optimize.ORDER):
+		requested[0] += len(parameter_sets)
+		return evaluate_batch(parameter_sets, order)
+	optimize.evaluate_batch = counting_evaluate_batch
+
+	x0, bounds = optimize.get_defaults()
+	spans = np.array([high - low for low, high in bounds])
+	rng = np.random.default_rng(0)
+	points = x0 + rng.uniform(-.05, .05, (num_points, x0.size))*spans
+	optimize.objective_function_batch(points)
+	optimize.objective_function_batch(points)
+	optimize.optimize.minimize(optimize.objective_function, x0, method="Nelder-Mead",
+	                           options=dict(maxfev=num_iterations))
+	optimize.evaluate_batch = evaluate_batch
+	return {"requested": requested[0], "cache hit rate": 1 - pool.num_points/requested[0]}
+
+
+def benchmark_tolerances(pool: CountingPool, batch_size: int = 1) -> Dict[str, float]:
+	""" compute the sensitivities and search for every tolerance, the same way find_tolerances's main does """
+	import find_tolerances
+	from sensitivity import compute_sensitivities
+	find_tolerances.pool = pool
+	find_tolerances.BATCH_SIZE = batch_size
+	x0 = np.zeros(len(find_tolerances.PARAMETERS))
+	steps = np.array(3*[.5] + 6*[.02] + 3*[.1] + 6*[.1] + 5*[.5] + [1])
+	y0, slopes, curvatures, responses = compute_sensitivities(find_tolerances.get_values_batch, x0, steps)
+	y_min = np.array([y + lo for y, (_, lo, _, _) in zip(y0, find_tolerances.OBSERVABLES)])
+	y_max = np.array([y + hi for y, (_, _, hi, _) in zip(y0, find_tolerances.OBSERVABLES)])
+	searches = [(i, sign*find_tolerances.MAX_TOLERANCE) for i in range(x0.size) for sign in [1, -1]]
+	find_tolerances.find_tolerances(searches, y_min, y_max, y0, slopes)
+	return {"requested": pool.num_points}
+
+
+def benchmark_tilt_scan(pool: CountingPool, batch_size: int = 1) -> Dict[str, float]:
+	""" do the adaptive hexapole/octopole scan and root polish from fix_tilt_angle """
+	import fix_tilt_angle
+	from grid_scan import GridScan, estimate_root, polish_root
+	fix_tilt_angle.pool = pool
+	fix_tilt_angle.BATCH_SIZE = batch_size
+	scan = GridScan("benchmark_scan.npy", [fix_tilt_angle.HEXAPOLE_RANGE[0], fix_tilt_angle.OCTOPOLE_RANGE[0]],
+	                [fix_tilt_angle.HEXAPOLE_RANGE[1], fix_tilt_angle.OCTOPOLE_RANGE[1]],
+	                fix_tilt_angle.NUM_COARSE, fix_tilt_angle.NUM_LEVELS, len(fix_tilt_angle.OBSERVABLES))
+	scan.run(fix_tilt_angle.get_values_batch, fix_tilt_angle.TARGETS)
+	X, Y = scan.known_points()
+	try:
+		guess = estimate_root(X, Y, fix_tilt_angle.TARGETS)
+		spacing = (scan.upper - scan.lower)/(np.array(scan.shape) - 1)
+		polish_root(fix_tilt_angle.get_values_batch, guess, fix_tilt_angle.TARGETS, spacing/10, [.1, .1], 3)
+	except (ValueError, np.linalg.LinAlgError) as e:  # the fake observables don't always have a root
+		print(f"couldn't polish the root: {e}", file=sys.stderr)
+	return {"requested": pool.num_points}
+
+
+def time_per_call(function: Callable[[], object], repetitions: int) -> float:
+	""" the average wall time of a function, in seconds """
+	start = time.perf_counter()
+	for _ in range(repetitions):
+		function()
+	return (time.perf_counter() - start)/repetitions
+
+
+def microbenchmarks(repetitions: int) -> Dict[str, float]:
+	""" time the per-evaluation Python work in isolation """
+	import optimize
+	x0, bounds = optimize.get_defaults()
+	streamlined = optimize.modify_script(x0)
+	full = streamlined.replace("streamlined_mode := 1;", "streamlined_mode := 0;")
+	streamlined_output = fake_output(streamlined)
+	full_output = fake_output(full)
+	return {
+		"render (µs)": 1e6*time_per_call(lambda: optimize.modify_script(x0), repetitions),
+		"parse (µs)": 1e6*time_per_call(lambda: parse_cosy_output(streamlined_output), repetitions),
+		"parse with map (µs)": 1e6*time_per_call(lambda: parse_cosy_output(full_output), repetitions),
+	}
+
+
+def run_workflow(name: str, make_pool: Callable[[], object], args: argparse.Namespace) -> Dict[str, float]:
+	""" run one workflow from scratch and collect its statistics """
+	pool = CountingPool(make_pool())
+	if args.trace_memory:
+		tracemalloc.start()
+	start = time.perf_counter()
+	with contextlib.redirect_stdout(open(os.devnull, "w")):
+		if name == "optimize":
+			results = benchmark_optimize(pool, args.points, args.iterations, args.batch_size)
+		elif name == "tolerances":
+			results = benchmark_tolerances(pool, args.batch_size)
+		elif name == "tilt-scan":
+			results = benchmark_tilt_scan(pool, args.batch_size)
+		else:
+			raise ValueError(f"there's no workflow called '{name}'")
+	wall_time = time.perf_counter() - start
+	pool.close()
+	if args.trace_memory:
+		results["peak traced memory (MB)"] = tracemalloc.get_traced_memory()[1]/1e6
+		tracemalloc.stop()
+	results["wall time (s)"] = wall_time
+	results["COSY runs"] = pool.num_runs
+	results["evaluations"] = pool.num_points
+	results["evaluations/s"] = pool.num_points/wall_time
+	results["time outside COSY (%)"] = 100*(1 - pool.time_running/wall_time)
+	return results
+
+
+def main():
+	parser = argparse.ArgumentParser(
+		description="time the optimization and tolerance workflows against a fake COSY, to get a baseline for the Python overhead")
+	parser.add_argument("--workflows", nargs="+", default=WORKFLOWS, choices=WORKFLOWS)
+	parser.add_argument("--backend", choices=["process", "inline"], default="process",
+	                    help="whether to run the fake COSY as a separate process (like the real one) or in this one")
+	parser.add_argument("--latency", type=float, default=0., help="how long each fake COSY run should take (s)")
+	parser.add_argument("--point-latency", type=float, default=0.,
+	                    help="how much longer a fake COSY run should take for each point in a batch (s)")
+	parser.add_argument("--batch-size", type=int, default=1, help="the number of points to put in each COSY run")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="the number of COSY runs to do at once")
+	parser.add_argument("--points", type=int, default=64, help="the size of the batch in the optimize workflow")
+	parser.add_argument("--iterations", type=int, default=50, help="the number of Nelder-Mead evaluations to do")
+	parser.add_argument("--repetitions", type=int, default=200, help="the number of times to repeat each microbenchmark")
+	parser.add_argument("--no-trace-memory", dest="trace_memory", action="store_false",
+	                    help="skip tracemalloc, which slows down allocation-heavy code")
+	parser.add_argument("--output", help="a JSON file in which to save the results")
+	args = parser.parse_args()
+
+	fake_cosy = os.path.abspath("fake_cosy.py")
+	if args.backend == "process":
+		make_pool = lambda: CosyPool([sys.executable, fake_cosy, "--latency", str(args.latency),
+		                              "--point-latency", str(args.point_latency)], args.workers)
+	else:
+		make_pool = lambda: InProcessPool(args.latency, args.workers, point_latency=args.point_latency)
+
+	# work in a scratch directory so that the caches start empty and nothing gets left behind
+	os.environ.setdefault("MPLBACKEND", "Agg")
+	sys.path.insert(0, os.getcwd())
+	directory = tempfile.mkdtemp(prefix="benchmark-")
+	for filename in FOX_FILES:
+		shutil.copy(filename, directory)
+	original_directory = os.getcwd()
+	os.chdir(directory)
+	try:
+		report = {"backend": args.backend, "latency (s)": args.latency, "point latency (s)": args.point_latency,
+		          "workers": args.workers, "batch size": args.batch_size}
+		report["microbenchmarks"] = microbenchmarks(args.repetitions)
+		for name in args.workflows:
+			report[name] = run_workflow(name, make_pool, args)
+	finally:
+		os.chdir(original_directory)
+		shutil.rmtree(directory, ignore_errors=True)
+	if resource is not None:
+		report["max RSS (MB)"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1e3
+		report["max child RSS (MB)"] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss/1e3
+
+	for section, values in report.items():
+		if type(values) is dict:
+			print(f"{section}:")
+			for key, value in values.items():
+				print(f"    {key:26s} {value:12.4g}")
+		else:
+			print(f"{section:30s} {values}")
+	if args.output is not None:
+		with open(args.output, "w") as file:
+			json.dump(report, file, indent="\t")
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,192 @@
+import re
+import time
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+from fox_template import FoxTemplate
+
+TAG = "{BATCH}"  # the comment that marks every line the batch script adds
+RUN_LINE = re.compile(r"^PROCEDURE RUN\s*;[^\n]*\n", re.MULTILINE)
+END_LINE = re.compile(r"^END(?:PROCEDURE|FUNCTION)\s*;[^\n]*\n", re.MULTILINE)
+SETUP_LINE = re.compile(r"^[ \t]*OV\b[^;\n]*;[^\n]*\n", re.MULTILINE)
+TAGGED_LINE = re.compile(r"^[^\n]*\{BATCH\}\n", re.MULTILINE)
+REFERENCE = re.compile(r"BATCH_VALUES\(BATCH_INDEX,(\d+)\)")
+DATA_LINE = re.compile(r"^BATCH_VALUES\((\d+),(\d+)\) := (.*); \{BATCH\}$", re.MULTILINE)
+LOOP_LINE = re.compile(r"^LOOP BATCH_INDEX 1 (\d+); \{BATCH\}$", re.MULTILINE)
+MARKER = re.compile(r"^[ \t]*BATCH_(POINT|DONE)[ \t]+(\d+|END)[ \t]*\r?$", re.MULTILINE)
+INCOMPLETE = "\n ### ERROR: COSY stopped before it finished this point\n"  # what goes on the end of a point that never printed BATCH_DONE
+
+
+class BatchTemplate:
+	""" a way of writing a single COSY script that evaluates a whole bunch of parameter sets, so that
+		COSY only has to start up and load COSY.bin once for all of them.  the parameters that differ
+		between the points go into an array, the main routine (whatever RUN does after its last nested
+		procedure) gets wrapped in a loop over that array, and each time thru the loop COSY prints
+		"BATCH_POINT n" at the start and "BATCH_DONE n" at the end so that the output can be split back up.  the OV call only happens on the
+		first point, since COSY can only set up its DA memory once, so anything it depends on (like
+		the order) has to be the same for the whole batch.  keep in mind that variables that belong to
+		RUN itself aren't reset between points.
+	"""
+	def __init__(self, template: FoxTemplate):
+		self.template = template
+		if RUN_LINE.search(template.script) is None or len(END_LINE.findall(template.script)) < 2:
+			raise ValueError("I can't find the main routine in this script, so I can't loop it")
+		setup = SETUP_LINE.findall(template.script)
+		self.setup_parameters = [name for name in template.parameters
+		                         if any(re.search(rf"\b{name}\b", statement) for statement in setup)]
+
+	def render(self, points: List[Mapping[str, object]]) -> str:
+		""" write out a script that runs every one of these sets of values in turn """
+		try:
+			texts = [{name: str(point[name]) for name in self.template.parameters} for point in points]
+		except KeyError as e:
+			raise ValueError(f"no value was given for {e.args[0]}")
+		varying = [name for name in self.template.parameters
+		           if any(text[name] != texts[0][name] for text in texts)]
+		for name in self.setup_parameters:
+			if name in varying:
+				raise ValueError(f"{name} goes into the OV call, so it has to be the same for every point in a batch")
+		values = dict(texts[0])
+		for k, name in enumerate(varying):
+			values[name] = f"BATCH_VALUES(BATCH_INDEX,{k + 1})"
+		script = self.template.render(values)
+
+		ends = list(END_LINE.finditer(script))
+		insertions = [
+			(RUN_LINE.search(script).end(),
+			 f"VARIABLE BATCH_VALUES 1 {len(points)} {max(len(varying), 1)}; {TAG}\n"
+			 f"VARIABLE BATCH_INDEX 1; {TAG}\n"),
+			(ends[-2].end(),
+			 "".join(f"BATCH_VALUES({i + 1},{k + 1}) := {text[name]}; {TAG}\n"
+			         for i, text in enumerate(texts) for k, name in enumerate(varying)) +
+			 f"LOOP BATCH_INDEX 1 {len(points)}; {TAG}\n"
+			 f"WRITE 6 'BATCH_POINT '&SF(BATCH_INDEX,'(I6)'); {TAG}\n"),
+			(ends[-1].start(),
+			 f"WRITE 6 'BATCH_DONE '&SF(BATCH_INDEX,'(I6)'); {TAG}\n"
+			 f"ENDLOOP; {TAG}\n"
+			 f"WRITE 6 'BATCH_POINT END'; {TAG}\n"),
+		]
+		for statement in SETUP_LINE.finditer(script):
+			insertions.append((statement.start(), f"IF BATCH_INDEX=1; {TAG}\n"))
+			insertions.append((statement.end(), f"ENDIF; {TAG}\n"))
+		pieces = []
+		last_end = len(script)
+		for position, text in sorted(insertions, key=lambda insertion: insertion[0], reverse=True):
+			pieces.append(script[position:last_end])
+			pieces.append(text)
+			last_end = position
+		pieces.append(script[:last_end])
+		return "".join(reversed(pieces))
+
+
+def unpack_batch_script(script: str) -> List[str]:
+	""" undo BatchTemplate.render, getting the script you would have gotten by rendering each point
+		on its own.  COSY doesn't need this, but things that pretend to be COSY do.
+	"""
+	values: Dict[int, Dict[int, str]] = {}
+	for i, k, text in DATA_LINE.findall(script):
+		values.setdefault(int(i), {})[int(k)] = text
+	num_points = count_batch_points(script)
+	base = TAGGED_LINE.sub("", script)
+	return [REFERENCE.sub(lambda match: values[i][int(match.group(1))], base) for i in range(1, num_points + 1)]
+
+
+def is_batch_script(script: str) -> bool:
+	return TAG in script
+
+
+def count_batch_points(script: str) -> int:
+	""" the number of points a script evaluates (1 if it's not a batch script) """
+	loop = LOOP_LINE.search(script)
+	return int(loop.group(1)) if loop is not None else 1
+
+
+def split_batch_output(output: str) -> Tuple[List[str], bool]:
+	""" cut the output of a batch script into the part that belongs to each point.  a point only counts as
+		finished if COSY printed its BATCH_DONE marker; any other point gets an error tacked onto its output,
+		so that it comes out failed even if COSY quit without saying anything (or it got cut off).
+		returns: the output of each point that COSY started, in order, and whether it made it thru all of them
+		         (if it didn't, the last one is where it crashed)
+	"""
+	sections = []
+	start = None  # where the output of the point in progress starts
+	for marker in MARKER.finditer(output):
+		kind, label = marker.groups()
+		if start is not None:
+			section = output[start:marker.start()]
+			sections.append(section if kind == "DONE" else section + INCOMPLETE)
+			start = None
+		if kind == "POINT":
+			if label == "END":
+				return sections, True
+			start = marker.end()
+	if start is not None:
+		sections.append(output[start:] + INCOMPLETE)
+	return sections, False
+
+
+class BatchingPool:
+	""" a wrapper around a CosyPool that takes the values to fill into a template rather than finished
+		scripts, and packs up to points_per_script of them into each COSY run.  the points are spread
+		across at least as many scripts as the pool has workers.  if COSY crashes partway thru a
+		script, the point it crashed on gets the error and the ones after it are run again.  if it runs
+		out of time instead, the point it was on and the ones after it are each run again in their own
+		script, so that only a point that takes too long all by itself counts as a failure.
+	"""
+	def __init__(self, pool, template: BatchTemplate, points_per_script: int = 1):
+		self.pool = pool
+		self.template = template
+		self.points_per_script = points_per_script
+
+	def map(self, points: Iterable[Mapping[str, object]]) -> List[str]:
+		return [output for output, timings in self.map_with_timings(points)]
+
+	def map_with_timings(self, points: Iterable[Mapping[str, object]]) -> List[Tuple[str, Dict[str, float]]]:
+		""" run every set of values and return each one's output along with its share of the time it took
+			to render, write, and run the script it was in
+		"""
+		points = list(points)
+		if self.points_per_script <= 1:
+			runs = []
+			for point in points:
+				start = time.perf_counter()
+				script = self.template.template.render(point)
+				runs.append((script, time.perf_counter() - start))
+			return [(output, {**timings, "render": render_time}) for (script, render_time), (output, timings)
+			        in zip(runs, self.pool.map_with_timings(script for script, render_time in runs))]
+
+		results: List[Optional[Tuple[str, Dict[str, float]]]] = [None]*len(points)
+		remaining = list(range(len(points)))
+		alone: List[int] = []  # points that were in a script that ran out of time, which get a script to themselves
+		while len(remaining) + len(alone) > 0:
+			chunks = [[index] for index in alone]
+			if len(remaining) > 0:
+				num_scripts = max(-(-len(remaining)//self.points_per_script),
+				                  min(len(remaining), getattr(self.pool, "num_workers", 1)))
+				chunks += [remaining[round(j*len(remaining)/num_scripts):round((j + 1)*len(remaining)/num_scripts)]
+				           for j in range(num_scripts)]
+			scripts, render_times = [], []
+			for chunk in chunks:
+				start = time.perf_counter()
+				scripts.append(self.template.render([points[index] for index in chunk]))
+				render_times.append(time.perf_counter() - start)
+
+			remaining, alone = [], []
+			for chunk, render_time, (output, timings) in zip(chunks, render_times, self.pool.map_with_timings(scripts)):
+				sections, finished = split_batch_output(output)
+				if timings.get("stopped") == "timeout" and len(chunk) > 1:
+					# running out of time isn't the fault of whichever point happened to be going, so keep the ones
+					# that finished and run that one (and everything after it) again on their own
+					num_done = max(len(sections) - 1, 0)
+					alone += chunk[num_done:]
+					sections = sections[:num_done]
+				else:
+					if len(sections) == 0:  # it didn't even get to the first point, so they all failed
+						sections = [output]*len(chunk)
+					num_done = len(sections)
+					remaining += chunk[num_done:]
+				share = {"worker": timings["worker"], "render": render_time/max(num_done, 1)}
+				for key in ["write", "subprocess", "cpu"]:
+					share[key] = timings[key]/max(num_done, 1) if timings.get(key) is not None else None
+				for index, section in zip(chunk, sections):
+					results[index] = (section, dict(share))
+		return results
@@ -0,0 +1,158 @@
+import re
+from dataclasses import dataclass, field
+from math import inf, nan
+from typing import Any, Dict, Iterable, List, Optional
+
+import numpy as np
+from numpy.typing import NDArray
+
+NUMBER_PATTERN = r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[EeDd][-+]?\d+)?|\*+"
+MAP_ROW_END = re.compile(r"\s(\d{6,})\s*$")
+MAP_ROW = re.compile(rf"\s*((?:(?:{NUMBER_PATTERN})\s*){{5}})\s+(\d{{6,}})\s*")
+DESIGN_LINE = re.compile(rf".*\b(FP|ISO)DESIGN\s+(.*?)\s+({NUMBER_PATTERN})\s*")
+LABELLED_LINE = re.compile(rf"\s*(.*?)\s*=\s*({NUMBER_PATTERN})\s*")
+
+# the labelled lines that get their own fields, and the fields they go in
+LABELS = {
+	"Dispersion (mm/keV)": "dispersion",
+	"Time skew (ps/keV)": "time_skew",
+	"FP distance (cm)": "fp_distance",
+	"L central ray (m)": "central_ray_length",
+}
+
+
+@dataclass
+class CosyResult:
+	""" everything we care about from one COSY run """
+	fpdesign: Dict[str, float] = field(default_factory=dict)
+	isodesign: Dict[str, float] = field(default_factory=dict)
+	dispersion: float = nan
+	time_skew: float = nan
+	fp_distance: float = nan
+	central_ray_length: float = nan
+	values: Dict[str, float] = field(default_factory=dict)  # any other "label = number" lines
+	map_coefficients: Optional[NDArray[float]] = None  # (terms × 5) coefficients of the last PM printout
+	map_exponents: Optional[NDArray[int]] = None  # (terms × variables) exponents of the last PM printout
+	num_maps: int = 0  # how many PM printouts there were in total
+	errors: List[str] = field(default_factory=list)
+	output: Optional[str] = None  # the raw text, if we still have it
+
+	@property
+	def failed(self) -> bool:
+		return len(self.errors) > 0
+
+	@property
+	def observables(self) -> Dict[str, float]:
+		""" all of the scalar results in one flat dict, with keys like "FPDESIGN Tilt Angle(deg)" and "Time skew (ps/keV)" """
+		observables = {}
+		for name, value in self.fpdesign.items():
+			observables[f"FPDESIGN {name}"] = value
+		for name, value in self.isodesign.items():
+			observables[f"ISODESIGN {name}"] = value
+		for label, attribute in LABELS.items():
+			if not np.isnan(getattr(self, attribute)):
+				observables[label] = getattr(self, attribute)
+		observables.update(self.values)
+		return observables
+
+	def to_dict(self) -> Dict[str, Any]:
+		""" convert this to something that can be saved as JSON (everything but the raw output) """
+		return {
+			"fpdesign": self.fpdesign, "isodesign": self.isodesign,
+			"dispersion": self.dispersion, "time_skew": self.time_skew,
+			"fp_distance": self.fp_distance, "central_ray_length": self.central_ray_length,
+			"values": self.values,
+			"map_coefficients": None if self.map_coefficients is None else self.map_coefficients.tolist(),
+			"map_exponents": None if self.map_exponents is None else self.map_exponents.tolist(),
+			"num_maps": self.num_maps, "errors": self.errors,
+		}
+
+	@classmethod
+	def from_dict(cls, data: Dict[str, Any], output: Optional[str] = None) -> "CosyResult":
+		result = cls(**{key: value for key, value in data.items() if not key.startswith("map_")}, output=output)
+		if data.get("map_coefficients") is not None:
+			result.map_coefficients = np.array(data["map_coefficients"], dtype=float).reshape((-1, 5))
+			result.map_exponents = np.array(data["map_exponents"], dtype=int).reshape((len(result.map_coefficients), -1))
+		return result
+
+
+class CosyOutputParser:
+	""" a parser that reads COSY's stdout one line at a time, so it can work on a stream as it comes in """
+	def __init__(self):
+		self.result = CosyResult()
+		self.map_rows: List[List[float]] = []
+		self.map_codes: List[str] = []
+		self.in_map = False
+
+	def feed(self, line: str) -> None:
+		""" take in one line of output """
+		line = line.rstrip("\r\n")
+
+		# the rows of a PM printout are five coefficients and then a string of exponent digits
+		match = MAP_ROW.fullmatch(line) if MAP_ROW_END.search(line) else None
+		if match is not None:
+			numbers = re.findall(NUMBER_PATTERN, match.group(1))
+			if len(numbers) == 5:
+				if not self.in_map:  # a new printout replaces the last one
+					self.map_rows, self.map_codes = [], []
+					self.in_map = True
+					self.result.num_maps += 1
+				self.map_rows.append([parse_number(number) for number in numbers])
+				self.map_codes.append(match.group(2))
+				return
+		if self.in_map:
+			self.finish_map()
+
+		if "ERROR" in line and ("###" in line or "$$$" in line):
+			self.result.errors.append(line.strip())
+			return
+
+		match = DESIGN_LINE.fullmatch(line)
+		if match is not None:
+			table = self.result.fpdesign if match.group(1) == "FP" else self.result.isodesign
+			table[match.group(2)] = parse_number(match.group(3))
+			return
+
+		match = LABELLED_LINE.fullmatch(line)
+		if match is not None:
+			label = match.group(1)
+			if label in LABELS:
+				setattr(self.result, LABELS[label], parse_number(match.group(2)))
+			else:
+				self.result.values[label] = parse_number(match.group(2))
+
+	def finish_map(self) -> None:
+		self.in_map = False
+		self.result.map_coefficients = np.array(self.map_rows, dtype=float)
+		self.result.map_exponents = np.array([[int(digit) for digit in code] for code in self.map_codes], dtype=int)
+
+	def close(self) -> CosyResult:
+		""" wrap up and return the result """
+		if self.in_map:
+			self.finish_map()
+		return self.result
+
+
+def parse_cosy_output(output: str) -> CosyResult:
+	""" read everything we care about from some COSY output in a single pass """
+	result = parse_cosy_lines(output.splitlines())
+	result.output = output
+	return result
+
+
+def parse_cosy_lines(lines: Iterable[str]) -> CosyResult:
+	""" read everything we care about from some lines of COSY output, as they come """
+	parser = CosyOutputParser()
+	for line in lines:
+		parser.feed(line)
+	return parser.close()
+
+
+def parse_number(text: str) -> float:
+	""" convert a number from COSY's output to a float, where a field full of asterisks means it overflowed """
+	if "*" in text:
+		return inf
+	try:
+		return float(text.replace("D", "E").replace("d", "e"))
+	except ValueError:
+		return nan
@@ -0,0 +1,202 @@
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from queue import Queue
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+from cosy_batch import count_batch_points, is_batch_script
+from cosy_output import CosyOutputParser
+
+
+class CosyPool:
+	""" a set of workers that can each run COSY in their own scratch directory, so that
+		many scripts can be evaluated at once without stepping on each other's temp files.
+		the executable can be anything that takes a script name (minus the .fox) as its last
+		argument and prints to stdout, so it's easy to swap in a stub for testing.
+		COSY's output is read as it comes, and it gets killed as soon as it prints an error, runs out of
+		time, or (if you say which observables you need) has printed everything you need.  a run that
+		fails any of these ways still comes back as output, with an error line that the parser will see,
+		so that one bad point doesn't take down a whole batch.
+	"""
+	def __init__(self, executable: Union[str, Sequence[str]] = "cosy",
+	             num_workers: Optional[int] = None,
+	             scratch_root: str = "scratch",
+	             support_files: Sequence[str] = ("COSY.bin",),
+	             timeout: Optional[float] = None,
+	             memory_limit: Optional[int] = None,
+	             required_observables: Optional[Sequence[str]] = None):
+		""" :param executable: the path to cosy.exe, or a full command prefix like [python, stub.py]
+			:param num_workers: the number of COSY processes to run at once (defaults to the number of cores)
+			:param scratch_root: the directory in which to put each worker's scratch directory
+			:param support_files: files from the current directory that COSY needs to see in its
+		                          working directory (COSY.bin is what INCLUDE 'COSY' loads)
+			:param timeout: the longest a single COSY run can go before it gets killed, in seconds.  a batch
+			                script gets this much time per point.
+			:param memory_limit: the most address space a COSY process can have, in bytes (this only
+		                         works on Unix, where it's set with the shell's ulimit)
+			:param required_observables: if given, stop COSY as soon as it's printed all of these (with keys
+		                                 like in CosyResult.observables), skipping whatever it does after.
+		                                 batch scripts always run to the end.
+		"""
+		if isinstance(executable, str):
+			self.command = [executable]
+		else:
+			self.command = list(executable)
+		self.num_workers = num_workers if num_workers is not None else os.cpu_count() or 1
+		self.scratch_root = scratch_root
+		self.support_files = support_files
+		self.timeout = timeout
+		self.memory_limit = memory_limit
+		self.required_observables = required_observables
+		self.directory: Optional[str] = None
+		self.workspaces: Queue = Queue()
+		self.executor: Optional[ThreadPoolExecutor] = None
+
+	def __enter__(self) -> "CosyPool":
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.close()
+
+	def start(self) -> None:
+		""" make the scratch directories and spin up the threads.  this happens automatically
+			the first time you run something, so you don't normally need to call it.
+		"""
+		if self.executor is not None:
+			return
+		os.makedirs(self.scratch_root, exist_ok=True)
+		# a fresh directory for this pool so that two processes never share a workspace
+		self.directory = tempfile.mkdtemp(prefix="cosy-", dir=self.scratch_root)
+		for i in range(self.num_workers):
+			workspace = os.path.join(self.directory, f"worker{i}")
+			os.makedirs(workspace)
+			for filename in self.support_files:
+				if os.path.isfile(filename):
+					link_or_copy(os.path.abspath(filename), os.path.join(workspace, os.path.basename(filename)))
+			self.workspaces.put((workspace, f"temp{i}"))
+		self.executor = ThreadPoolExecutor(max_workers=self.num_workers)
+
+	def close(self) -> None:
+		""" stop the threads and delete all of the scratch directories """
+		if self.executor is not None:
+			self.executor.shutdown(wait=True)
+			self.executor = None
+		if self.directory is not None:
+			shutil.rmtree(self.directory, ignore_errors=True)
+			self.directory = None
+			self.workspaces = Queue()
+
+	def run(self, script: str) -> str:
+		""" run a single COSY script and return its stdout """
+		return self.map([script])[0]
+
+	def map(self, scripts: Iterable[str]) -> List[str]:
+		""" run a bunch of COSY scripts in parallel and return their stdouts in the same order """
+		return [output for output, timings in self.map_with_timings(scripts)]
+
+	def map_with_timings(self, scripts: Iterable[str]) -> List[Tuple[str, Dict[str, float]]]:
+		""" run a bunch of COSY scripts in parallel like map(), but also say how long each one took.
+			returns: the stdout of each script along with a dict of the time spent writing it to disk
+			         ("write"), the wall time of the COSY process ("subprocess"), the CPU time COSY used
+			         ("cpu", which is None where the OS won't tell us), and which worker ran it ("worker")
+		"""
+		self.start()
+		return list(self.executor.map(self._run_in_workspace, scripts))
+
+	def submit(self, script: str) -> "Future[Tuple[str, Dict[str, float]]]":
+		""" start running a script without waiting for it.  scripts run in the order they're submitted.
+			returns: a future for the same (stdout, timings) pair that map_with_timings gives for each script
+		"""
+		self.start()
+		return self.executor.submit(self._run_in_workspace, script)
+
+	def _run_in_workspace(self, script: str) -> Tuple[str, Dict[str, float]]:
+		""" check out a free workspace, run the script there, and give the workspace back """
+		parser = CosyOutputParser()
+		required = self.required_observables if not is_batch_script(script) else None
+		timeout = self.timeout*count_batch_points(script) if self.timeout is not None else None
+		def is_done(line: str) -> bool:
+			parser.feed(line)
+			if parser.result.failed:
+				return True
+			return required is not None and all(key in parser.result.observables for key in required)
+
+		workspace, name = self.workspaces.get()
+		timings = {"worker": name}
+		try:
+			start = time.perf_counter()
+			with open(os.path.join(workspace, f"{name}.fox"), "w") as f:
+				f.write(script)
+			timings["write"] = time.perf_counter() - start
+			start = time.perf_counter()
+			returncode, stdout, timings["cpu"], stopped = run_process(
+				self.command + [name], workspace, is_done, timeout, self.memory_limit)
+			timings["subprocess"] = time.perf_counter() - start
+		finally:
+			self.workspaces.put((workspace, name))
+
+		output = stdout.decode("ascii", errors="replace")
+		if output != "" and not output.endswith("\n"):
+			output += "\r\n"
+		timings["stopped"] = stopped
+		if stopped == "timeout":
+			output += f" ### ERROR: COSY was killed after running for {timeout:g} s\r\n"
+		elif stopped is None and returncode != 0:
+			output += f" ### ERROR: COSY exited with code {returncode}\r\n"
+		return output, timings
+
+
+def run_process(command: List[str], directory: str, is_done: Optional[Callable[[str], bool]] = None,
+                timeout: Optional[float] = None, memory_limit: Optional[int] = None
+                ) -> Tuple[int, bytes, Optional[float], Optional[str]]:
+	""" run a command and collect its stdout one line at a time.  on Unix this reaps the process with wait4
+		so that we get its own CPU time, which getrusage can't separate out when several run at once.
+		:param is_done: a function that gets each line as it comes in and says whether to kill the process now
+		:param timeout: how long to let it run before killing it, in seconds
+		:param memory_limit: the most address space the process can have, in bytes (ignored where that can't be set)
+		returns: the exit code, the stdout, the user+system CPU time in seconds (or None if it's unavailable), and
+		         why we killed it ("timeout" or "done") or None if it ended on its own
+	"""
+	if memory_limit is not None and os.name == "posix":
+		# set the limit in a shell that then becomes the command, since preexec_fn isn't safe with threads around
+		command = ["/bin/sh", "-c", f'ulimit -v {memory_limit//1024} && exec "$@"', "sh"] + list(command)
+	process = subprocess.Popen(command, cwd=directory, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+	stopped = None
+	def kill(reason: str) -> None:
+		nonlocal stopped
+		if stopped is None:
+			stopped = reason
+			process.kill()
+	timer = threading.Timer(timeout, kill, ["timeout"]) if timeout is not None else None
+	if timer is not None:
+		timer.start()
+
+	lines = []
+	with process.stdout:
+		for line in process.stdout:
+			lines.append(line)
+			if is_done is not None and stopped is None and is_done(line.decode("ascii", errors="replace")):
+				kill("done")
+				break
+	if timer is not None:
+		timer.cancel()
+	if hasattr(os, "wait4"):
+		_, status, usage = os.wait4(process.pid, 0)
+		process.returncode = os.waitstatus_to_exitcode(status)
+		cpu = usage.ru_utime + usage.ru_stime
+	else:
+		process.wait()
+		cpu = None
+	return process.returncode, b"".join(lines), cpu, stopped
+
+
+def link_or_copy(source: str, destination: str) -> None:
+	""" put a file in a workspace as cheaply as the OS will let us """
+	try:
+		os.symlink(source, destination)
+	except (OSError, NotImplementedError):
+		shutil.copy(source, destination)
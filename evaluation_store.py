@@ -0,0 +1,150 @@
+import hashlib
+import json
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence, Tuple
+
+from cosy_output import CosyResult, parse_cosy_output
+
+Observables = Dict[str, float]
+
+# what entries from old pickle caches are filed under, since there's no telling which version of the script made
+# them.  no real script hash looks like this, so lookups never return them; they only come up if you ask for them.
+LEGACY_SCRIPT_HASH = "legacy"
+
+
+class EvaluationStore:
+	""" a persistent record of every COSY run, kept in an SQLite database.  each evaluation is
+		keyed on a hash of the script, the order, and the parameter vector, so editing the .fox
+		file automatically orphans the old entries rather than returning stale results.  the
+		database is in write-ahead-log mode, so several processes can read and write it at once.
+	"""
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.connection = sqlite3.connect(filename, timeout=60, check_same_thread=False)
+		self.connection.execute("PRAGMA journal_mode=WAL")
+		self.connection.execute("PRAGMA synchronous=NORMAL")
+		self.connection.execute(
+			"CREATE TABLE IF NOT EXISTS evaluations ("
+			"  key TEXT PRIMARY KEY,"
+			"  script_hash TEXT NOT NULL,"
+			"  cosy_order INTEGER NOT NULL,"
+			"  parameters TEXT NOT NULL,"
+			"  observables TEXT NOT NULL,"
+			"  output TEXT NOT NULL,"
+			"  timestamp REAL NOT NULL,"
+			"  record TEXT)")
+		columns = [row[1] for row in self.connection.execute("PRAGMA table_info(evaluations)")]
+		if "record" not in columns:  # databases from before the parsed records were stored
+			self.connection.execute("ALTER TABLE evaluations ADD COLUMN record TEXT")
+		self.connection.execute(
+			"CREATE INDEX IF NOT EXISTS evaluations_by_script ON evaluations (script_hash, cosy_order)")
+		self.connection.commit()
+
+	def __len__(self) -> int:
+		with self.lock:
+			return self.connection.execute("SELECT COUNT(*) FROM evaluations").fetchone()[0]
+
+	def __contains__(self, key: str) -> bool:
+		return self.get(key) is not None
+
+	def close(self) -> None:
+		with self.lock:
+			self.connection.close()
+
+	def get(self, key: str) -> Optional[CosyResult]:
+		""" look up the parsed result of one evaluation, or None if it's not there """
+		return self.get_many([key]).get(key)
+
+	def get_many(self, keys: Sequence[str]) -> Dict[str, CosyResult]:
+		""" look up a bunch of evaluations at once.  keys that aren't in the store are left out. """
+		rows = []
+		with self.lock:
+			for start in range(0, len(keys), 500):  # stay under SQLite's limit on query parameters
+				chunk = list(keys[start:start + 500])
+				rows += self.connection.execute(
+					f"SELECT key, output, record FROM evaluations "
+					f"WHERE key IN ({','.join('?'*len(chunk))})", chunk).fetchall()
+		found = {}
+		for key, output, record in rows:
+			if record is not None:
+				found[key] = CosyResult.from_dict(json.loads(record), output)
+			else:  # entries from before the records were stored just get parsed again
+				found[key] = parse_cosy_output(output)
+		return found
+
+	def put(self, key: str, script_hash: str, order: int, parameters: Sequence[float], result: CosyResult) -> None:
+		""" save one evaluation """
+		self.put_many([(key, script_hash, order, parameters, result)])
+
+	def put_many(self, entries: Iterable[Tuple[str, str, int, Sequence[float], CosyResult]]) -> None:
+		""" save a bunch of evaluations in a single transaction """
+		now = time.time()
+		rows = [(key, script_hash, order, json.dumps([float(x) for x in parameters]),
+		         json.dumps(result.observables), result.output or "", now, json.dumps(result.to_dict()))
+		        for key, script_hash, order, parameters, result in entries]
+		with self.lock:
+			with self.connection:
+				self.connection.executemany(
+					"INSERT OR REPLACE INTO evaluations "
+					"(key, script_hash, cosy_order, parameters, observables, output, timestamp, record) "
+					"VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+	def evaluations(self, script_hash: Optional[str] = None, order: Optional[int] = None
+	                ) -> Iterator[Tuple[List[float], Observables]]:
+		""" go thru every stored parameter vector and its observables, optionally only the ones
+			from a particular script and order.  the raw output isn't loaded.
+		"""
+		query = "SELECT parameters, observables FROM evaluations"
+		conditions, arguments = [], []
+		if script_hash is not None:
+			conditions.append("script_hash = ?")
+			arguments.append(script_hash)
+		if order is not None:
+			conditions.append("cosy_order = ?")
+			arguments.append(order)
+		if len(conditions) > 0:
+			query += " WHERE " + " AND ".join(conditions)
+		with self.lock:
+			rows = self.connection.execute(query, arguments).fetchall()
+		for parameters, observables in rows:
+			yield json.loads(parameters), json.loads(observables)
+
+
+def hash_script(script: str) -> str:
+	""" boil a COSY script down to a short string that changes whenever the script does """
+	return hashlib.sha256(script.encode("utf-8")).hexdigest()
+
+
+def make_key(script_hash: str, order: int, parameters: Sequence[float]) -> str:
+	""" the key under which to store a given evaluation.  the parameters are hashed in hex so
+		that no precision is lost to formatting.
+	"""
+	content = f"{script_hash}|{order}|" + ",".join(float(x).hex() for x in parameters)
+	return hashlib.sha256(content.encode("ascii")).hexdigest()
+
+
+def import_pickle_cache(store: EvaluationStore, filename: str, order: int, script_hash: str = LEGACY_SCRIPT_HASH,
+                        parse: Callable[[str], CosyResult] = parse_cosy_output) -> int:
+	""" copy the contents of an old-style {parameters: output} pickle cache into the store.  returns the
+		number of entries copied.
+		:param script_hash: the hash of the script that actually produced the pickle.  if you don't know it
+		                    (and you usually don't, since the pickles didn't record it), leave it as
+		                    LEGACY_SCRIPT_HASH, so that the entries can't pass for results of the current script.
+		:param parse: the function that turns a raw output into a CosyResult
+	"""
+	try:
+		with open(filename, "rb") as file:
+			old_cache = pickle.load(file)
+	except FileNotFoundError:
+		return 0
+	entries = []
+	for parameters, output in old_cache.items():
+		result = parse(output)
+		if not result.failed:
+			entries.append((make_key(script_hash, order, parameters), script_hash, order, parameters, result))
+	store.put_many(entries)
+	return len(entries)
@@ -0,0 +1,230 @@
+import argparse
+import re
+import sys
+import time
+import zlib
+from itertools import product
+from math import ceil, cos, floor, log10, sin, sqrt
+from typing import Dict, Iterable, List, Tuple
+
+from cosy_batch import count_batch_points, is_batch_script, unpack_batch_script
+
+NUMBER_PATTERN = r"(?<![\w.])[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d+)?"
+ASSIGNMENT_PATTERN = r"\b(\w+) := ([-+]?[.\d]+(?:[eE][-+]?\d+)?);"
+SETUP_PATTERN = r"\bOV\s+(\S+)\s+\S+\s+(\d+)\s*;"
+DA_PARAMETER_PATTERN = r"\(([^()]*)\+[-+.\deE]+\*\(PARA\(\d+\)-1\)\)"  # the way parameter_maps puts in a DA parameter
+NUM_RESERVED_PARAMETERS = 3  # the parameters that every script sets up, which the fake map never depends on
+NUM_FEATURES = 6
+DESIGN_NAMES = ['Tilt Angle(deg)', 'Curv.Radius(m)', 'p-dist(mm)', 'HO Resol.RAY(keV)', 'Time Resol.(ps)',
+                'y-Size(mm)', 'Plane Length(m)']
+BANNER = "\r\n".join([
+	"  " + "*"*84,
+	"  **" + " "*80 + "**",
+	"  **" + "FAKE COSY INFINITY -- AN ANALYTIC STAND-IN FOR BENCHMARKING".center(80) + "**",
+	"  **" + " "*80 + "**",
+	"  " + "*"*84,
+]*5) + "\r\n"
+
+
+def weight(key: str) -> float:
+	""" a fixed pseudorandom number between -1 and 1 for each key """
+	return zlib.crc32(key.encode("utf-8"))/2**31 - 1
+
+
+def features(script: str) -> List[float]:
+	""" boil the script down to a few order-1 numbers that vary smoothly with every number in it.
+		each number is weighted based on the text in front of it, so the weights don't change
+		when the lengths of the numbers do.
+	"""
+	totals = [0.]*NUM_FEATURES
+	count = 0
+	for match in re.finditer(NUMBER_PATTERN, script):
+		context = script[max(0, match.start() - 24):match.start()]
+		value = float(match.group())
+		for k in range(NUM_FEATURES):
+			totals[k] += weight(f"{context}|{k}")*sin(value)
+		count += 1
+	return [total/sqrt(max(count, 1)) for total in totals]
+
+
+def design(u: List[float]) -> Dict[str, float]:
+	""" the focal plane design numbers as functions of the features """
+	return {
+		'Tilt Angle(deg)': 60 + 25*sin(u[0]),
+		'Curv.Radius(m)': 1/(0.01 + u[1]**2),
+		'p-dist(mm)': 5*u[1],
+		'HO Resol.RAY(keV)': 80 + 60*u[2]**2 + 20*u[0]**2,
+		'Time Resol.(ps)': 40 + 50*u[3]**2 + 10*u[4]**2,
+		'y-Size(mm)': 10 + 3*cos(u[2]),
+		'Plane Length(m)': 0.35 + 0.05*sin(u[3]),
+	}
+
+
+def format_coefficient(value: float) -> str:
+	""" write a number the way Fortran's G14.7 does, which is how COSY prints maps """
+	if value != 0 and 0.1 <= abs(value) < 1e7:
+		digits = floor(log10(abs(value))) + 1
+		return f"{value:10.{7 - digits}f}    "
+	else:
+		exponent = 0 if value == 0 else floor(log10(abs(value))) + 1
+		return f"{value/10**exponent:.7f}E{exponent:+03d}".rjust(14)
+
+
+def map_lines(u: List[float], order: int, num_parameters: int = NUM_RESERVED_PARAMETERS) -> List[str]:
+	""" a PM printout of a map up to the given order that respects midplane symmetry.  any parameters past
+		the reserved ones get a made-up linear dependence, which has nothing to do with how the outputs
+		would change if you changed the script instead.
+	"""
+	lines = []
+	for total_order in range(1, order + 1):
+		for exponents in product(range(total_order + 1), repeat=6):
+			if sum(exponents) == total_order:
+				suffixes = ["0"*num_parameters]
+			elif sum(exponents) == total_order - 1:  # the rest of the order goes to one of the parameters
+				suffixes = ["0"*j + "1" + "0"*(num_parameters - j - 1) for j in range(NUM_RESERVED_PARAMETERS, num_parameters)]
+			else:
+				continue
+			code = "".join(str(exponent) for exponent in exponents)
+			vertical = (exponents[2] + exponents[3])%2  # whether the term is odd in y and b
+			scale = 10**(total_order - 1)*(1 if sum(exponents) == total_order else 0.01)
+			for suffix in suffixes:
+				key = code + suffix[:NUM_RESERVED_PARAMETERS] + suffix[NUM_RESERVED_PARAMETERS:].rstrip("0")  # the same however many parameters there are
+				coefficients = []
+				for output in range(5):
+					if (output in [2, 3]) == bool(vertical):
+						coefficients.append(scale*weight(key + str(output))*(1 + 0.1*sin(u[(output + total_order)%NUM_FEATURES])))
+					else:
+						coefficients.append(0.)
+				if any(coefficient != 0 for coefficient in coefficients):
+					lines.append(" " + "".join(format_coefficient(c) for c in coefficients) + " " + code + suffix)
+	lines.append("     " + "-"*80)
+	return lines
+
+
+def fake_output(script: str, error_rate: float = 0.) -> str:
+	""" make up the stdout COSY would produce for this script.  it's in the same format as the real thing
+		(FPDESIGN/ISODESIGN lines, labelled values, and a PM map if it's not in streamlined mode), but
+		everything is a cheap analytic function of the numbers in the script.  the answers are meaningless,
+		but they're smooth and deterministic, which is all we need to benchmark the Python side of things.
+		a batch script from cosy_batch gets each of its points answered in turn, stopping at the first error.
+		:param error_rate: the fraction of scripts (picked by hashing them) that should fail
+	"""
+	lines = [BANNER]
+	if is_batch_script(script):
+		for i, point_script in enumerate(unpack_batch_script(script)):
+			lines.append(f"BATCH_POINT {i + 1:6d}")
+			point_lines, failed = fake_lines(point_script, error_rate)
+			lines += point_lines
+			if failed:
+				break
+			lines.append(f"BATCH_DONE {i + 1:6d}")
+		else:
+			lines.append("BATCH_POINT END")
+	else:
+		lines += fake_lines(script, error_rate)[0]
+	return "\r\n".join(lines) + "\r\n"
+
+
+def fake_lines(script: str, error_rate: float = 0.) -> Tuple[List[str], bool]:
+	""" make up everything that a single run of this script would print after the banner.
+		returns: the lines and whether it's an error
+	"""
+	setup = re.search(SETUP_PATTERN, script)
+	num_parameters = int(setup.group(2)) if setup is not None else NUM_RESERVED_PARAMETERS
+	u = features(re.sub(SETUP_PATTERN, "", re.sub(DA_PARAMETER_PATTERN, r"\1", script)))  # DA parameters are all 0
+	if error_rate > 0 and (weight(script) + 1)/2 < error_rate:
+		return [" ### ERROR IN FAKE COSY: this point was picked to fail"], True
+
+	lines = []
+	named = dict(re.findall(ASSIGNMENT_PATTERN, script))
+	if setup is not None and setup.group(1).isdigit():
+		order = int(setup.group(1))
+	else:
+		order = int(float(named.get(setup.group(1) if setup is not None else "order", 3)))
+	if float(named.get("streamlined_mode", 0)) == 0:
+		lines.append("mapping matrix:")
+		lines += map_lines(u, order, num_parameters)
+	lines.append(f"FP distance (cm)    = {100*(0.5 + 0.1*u[5]):11.5f}")
+	lines.append(f"L central ray (m)   = {5 + u[4]:11.5f}")
+	lines.append(f"Dispersion (mm/keV) = {0.15 + 0.02*u[2]:11.5f}")
+	lines.append(f"Time skew (ps/keV)  = {0.3*u[0] + 0.1*u[5]:11.5f}")
+	lines.append("*****************************")
+	values = design(u)
+	for n, name in enumerate(DESIGN_NAMES):
+		lines.append(f"N{n + 1:2d} FPDESIGN {name:22s}{values[name]:16.5f}")
+	lines.append("*****************************")
+	iso_values = design(u[1:] + u[:1])
+	for name in DESIGN_NAMES:
+		lines.append(f"ISODESIGN {name:22s}{iso_values[name]:16.5f}")
+	lines.append("*****************************")
+	return lines, False
+
+
+class InProcessPool:
+	""" something with the same interface as CosyPool that makes up the output right here instead of
+		starting a process, for measuring how much time goes to everything other than COSY.  the latency is
+		applied once per round of num_workers scripts, as if they were running in parallel, and the point
+		latency is added for each point in a batch script on top of that.
+	"""
+	def __init__(self, latency: float = 0., num_workers: int = 1, error_rate: float = 0., point_latency: float = 0.):
+		self.latency = latency
+		self.point_latency = point_latency
+		self.num_workers = num_workers
+		self.error_rate = error_rate
+
+	def __enter__(self) -> "InProcessPool":
+		return self
+
+	def __exit__(self, *exc_info) -> None:
+		self.close()
+
+	def start(self) -> None:
+		pass
+
+	def close(self) -> None:
+		pass
+
+	def run(self, script: str) -> str:
+		return self.map([script])[0]
+
+	def map(self, scripts: Iterable[str]) -> List[str]:
+		return [output for output, timings in self.map_with_timings(scripts)]
+
+	def map_with_timings(self, scripts: Iterable[str]) -> List[Tuple[str, Dict[str, float]]]:
+		""" make up the outputs, timing each one the same way CosyPool does (there's nothing to write) """
+		scripts = list(scripts)
+		runs = []
+		for script in scripts:
+			start, start_cpu = time.perf_counter(), time.process_time()
+			output = fake_output(script, self.error_rate)
+			runs.append((output, {"worker": "inline", "write": 0., "cpu": time.process_time() - start_cpu,
+			                      "subprocess": time.perf_counter() - start}))
+		delays = [self.latency + self.point_latency*count_batch_points(script) for script in scripts]
+		if sum(delays) > 0:
+			time.sleep(max(delays)*ceil(len(runs)/self.num_workers))
+			for (output, timings), delay in zip(runs, delays):
+				timings["subprocess"] += delay
+		return runs
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="pretend to be COSY, so that it can be swapped in for the real executable in a CosyPool")
+	parser.add_argument("--latency", type=float, default=0., help="how long to sleep before answering, in seconds")
+	parser.add_argument("--point-latency", type=float, default=0.,
+	                    help="how much longer to sleep for each point in a batch script, in seconds")
+	parser.add_argument("--error-rate", type=float, default=0., help="the fraction of scripts that should fail")
+	parser.add_argument("--hang-rate", type=float, default=0.,
+	                    help="the fraction of scripts that should print half their output and then hang")
+	parser.add_argument("name", help="the name of the .fox file to run, minus the extension")
+	args = parser.parse_args()
+	with open(f"{args.name}.fox", "r") as file:
+		script = file.read()
+	if args.latency > 0 or args.point_latency > 0:
+		time.sleep(args.latency + args.point_latency*count_batch_points(script))
+	output = fake_output(script, args.error_rate)
+	if args.hang_rate > 0 and (weight("hang|" + script) + 1)/2 < args.hang_rate:
+		sys.stdout.buffer.write(output[:len(output)//2].encode("ascii"))
+		sys.stdout.flush()
+		time.sleep(1e6)
+	sys.stdout.buffer.write(output.encode("ascii"))
@@ -1,10 +1,29 @@
+import os
+
 import numpy as np
 import matplotlib.pyplot as plt
-import subprocess
+
+from cosy_batch import BatchingPool, BatchTemplate
+from cosy_pool import CosyPool
+from evaluation_store import hash_script
+from fox_template import FoxTemplate
+import instrumentation
+from parameter_maps import plain_parameters, run_parametric_map
+from sensitivity import compute_sensitivities
+from tolerance_monte_carlo import monte_carlo_tolerances, spot_check, PERCENTILES
 
 MAKE_GRAFS = False
+SEARCH_TOLERANCES = True # whether to search for the largest acceptable perturbation of each parameter
+MAX_TOLERANCE = 10 # the largest perturbation that the tolerance search will consider
+MONTE_CARLO = True # whether to estimate the statistical spread of each observable from the sensitivities
+COSY_EXECUTABLE = 'cosy'
+NUM_WORKERS = os.cpu_count()
+TIMEOUT = 600 # how long a COSY run can go before it's killed and counted as out of bounds, in seconds
+MEMORY_LIMIT = 4*2**30 # how much memory a COSY run can use, in bytes
+BATCH_SIZE = 1 # how many perturbations to evaluate in each COSY run (see cosy_batch)
+PARAMETRIC_MAP = False # whether to get the sensitivities from one parameter-dependent map instead of a COSY run per stencil point
 
-FINNESS = 0.1**(3/3) # the amount we care about the tolerances being exact
+FINNESS = 0.1**(3/3) # the amount we care about the tolerances being exact (the relative precision of the search)
 assert FINNESS < 1
 PARAMETERS = [
 		'shiftz_H1', 'shiftz_O', 'shiftz_H2', 'shiftx_H1', 'shiftx_O', 'shiftx_H2', 'shifty_H1', 'shifty_O', 'shifty_H2',
@@ -21,6 +40,7 @@ OBSERVABLES = [ # the parameters we can measure (name, lower margin, upper margi
 	('p-dist(mm)', -1, 1, 'strength_O')]
 
 UNITS = {'strength':'%', 'tiltx':'degrees', 'tilty':'degrees', 'shiftx':'cm', 'shifty':'cm', 'shiftz':'cm', 'length':'cm', 'aperture':'cm'}
+DISTRIBUTIONS = {'%':'normal', 'degrees':'uniform', 'cm':'uniform'} # how the errors in each kind of parameter are distributed
 
 
 def basis_vec(idx, val):
@@ -30,12 +50,35 @@ def basis_vec(idx, val):
 	return v
 
 
+pool = CosyPool(COSY_EXECUTABLE, NUM_WORKERS, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT,
+                required_observables=[f'FPDESIGN {key}' for key, lo, hi, controller in OBSERVABLES])
+template = FoxTemplate.from_file('MRSt_tol.fox', PARAMETERS)
+batch_template = BatchTemplate(template)
+
+
 def get_values(X):
 	""" get the observable values at these perturbations """
+	return get_values_batch([X])[0]
+
+
+def get_values_batch(Xs):
+	""" get the observable values at a bunch of perturbations, running them all in parallel """
+	values, events = instrumentation.run_batch(
+		BatchingPool(pool, batch_template, BATCH_SIZE), script_values, Xs, parse_values)
+	instrumentation.record("tolerances", events)
+	return np.array(values)
+
+
+def fill_in_script(X):
+	""" put the perturbations into the placeholders in the tolerance script """
+	return template.render(script_values(X))
+
+
+def script_values(X):
+	""" format the perturbations the way the placeholders in the tolerance script need them """
 	X = np.array(X)
 	assert X.size == len(PARAMETERS), f"{X.size} != {len(PARAMETERS)}"
-	with open('MRSt_tol.fox', 'r') as f:
-		fox = f.read()
+	values = {}
 	for parameter, x in zip(PARAMETERS, X):
 		unit = get_units(parameter)
 		if unit == '%':
@@ -44,21 +87,53 @@ def get_values(X):
 			formatted = f'{x/100:f}'
 		else:
 			formatted = f'{x:f}'
-		fox = fox.replace(f'<<{parameter}>>', formatted)
-	with open('temp.fox', 'w') as g:
-		g.write(fox)
-	try:
-		res = subprocess.run(['cosy', 'temp'], capture_output=True, check=True)
-	except subprocess.CalledProcessError:
-		print(res.stdout.decode('ascii'))
-	vals = np.full(len(OBSERVABLES), np.nan)
-	for line in res.stdout.decode('ascii').split('\r\n'):
-		if 'FPDESIGN' in line:
-			for j, (key, lo, hi, controller) in enumerate(OBSERVABLES):
-				if key in line:
-					vals[j] = float(line.split()[-1])
-					break
-	return vals
+		values[parameter] = formatted
+	return values
+
+
+def parameter_scales():
+	""" how much the text that goes in each placeholder changes per unit of its parameter """
+	return {parameter: .01 if get_units(parameter) in ['%', 'cm'] else 1. for parameter in PARAMETERS}
+
+
+def build_parametric_map(x0):
+	""" run COSY once with every parameter it can take as a DA parameter as one.  the rest (the tilts, which go
+		into TA) can't be read off of the map.
+		returns: the ParametricMap and which of PARAMETERS it depends on, as a boolean array
+	"""
+	scales = parameter_scales()
+	plain = plain_parameters(template, scales)
+	if len(plain) > 0:
+		print(f"COSY can't take DA values for {', '.join(plain)}, so those will still get a COSY run per stencil point")
+	with CosyPool(COSY_EXECUTABLE, 2, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT) as map_pool: # these need the map at the very end (and the plain run goes alongside the parametric one)
+		parametric_map = run_parametric_map(
+			map_pool, template, script_values(x0), {parameter: scales[parameter] for parameter in PARAMETERS if parameter not in plain})
+	return parametric_map, np.array([parameter not in plain for parameter in PARAMETERS])
+
+
+def get_values_from_map(parametric_map, mapped, Xs):
+	""" estimate the observable values at a bunch of perturbations from a parameter-dependent map, without running
+		COSY.  the map was made at zero perturbation, so any point that perturbs a parameter that isn't in mapped
+		gets a COSY run instead.
+	"""
+	Xs = np.asarray(Xs, dtype=float)
+	values = np.empty((Xs.shape[0], len(OBSERVABLES)))
+	off_map = np.any(Xs[:, ~mapped] != 0, axis=1)
+	for i in np.nonzero(~off_map)[0]:
+		observables = parametric_map.observables(Xs[i, mapped])
+		values[i] = [observables.get(f"FPDESIGN {key}", np.nan) for key, lo, hi, controller in OBSERVABLES]
+	if np.any(off_map):
+		values[off_map] = get_values_batch(Xs[off_map])
+	return values
+
+
+def parse_values(result):
+	""" read the observable values out of a parsed COSY output.  if COSY failed, they're all infinite, so
+		that the point counts as out of bounds rather than stopping everything.
+	"""
+	if result.failed:
+		return np.full(len(OBSERVABLES), np.inf)
+	return np.array([result.fpdesign.get(key, np.nan) for key, lo, hi, controller in OBSERVABLES])
 
 
 def is_acceptable(y, y_min, y_max, i=None):
@@ -69,25 +144,93 @@ def is_acceptable(y, y_min, y_max, i=None):
 	"""
 	for j in range(y_min.size): # check each observable
 		if OBSERVABLES[j][3] is None or OBSERVABLES[j][3] == PARAMETERS[i]: # that is not being corrected by a different parameter
-			if y[j] < y_min[j] or y[j] > y_max[j]: # to see if it is out of bounds
+			if not np.isfinite(y[j]) or y[j] < y_min[j] or y[j] > y_max[j]: # to see if it is out of bounds (or missing)
 				return False # if so, it's not acceptable
 	return True # if we make it this far, we're good
 
 
+def violation(y, y_min, y_max, i):
+	""" how far out of bounds the worst observable is (negative if they're all in bounds),
+		counting only the observables that `is_acceptable` would check for parameter `i`.
+		a missing observable (NaN) or a failed run counts as infinitely far out.
+	"""
+	worst = -np.inf
+	for j in range(y_min.size):
+		if OBSERVABLES[j][3] is None or OBSERVABLES[j][3] == PARAMETERS[i]:
+			if not np.isfinite(y[j]):
+				return np.inf
+			worst = max(worst, y[j] - y_max[j], y_min[j] - y[j])
+	return worst
+
+
 def find_tolerance(initial_guess, y_min, y_max, i):
 	""" find the largest number less than `initial_guess` that gets the
 		`i`th observable in bounds. the sampled perturbations will all
 		be of the same sign as `initial_guess`.
 		returns: the positive tolerance
 	"""
-	tol = initial_guess
-	while True: # until I say you're done,
-		x = basis_vec(i, tol)
-		y = get_values(x) # try out this change
-		if is_acceptable(y, y_min, y_max, i): # if everything is in bounds
-			return abs(tol) # take it and go
-		else: # if something is wrong
-			tol *= 0.1**(1/3) # reduce the tolerance and try again
+	return find_tolerances([(i, initial_guess)], y_min, y_max)[0]
+
+
+def find_tolerances(searches, y_min, y_max, y0=None, slopes=None):
+	""" find the largest perturbation (up to its initial guess) of each of several parameters that keeps
+		everything in bounds, to within a relative precision of FINNESS. every search brackets its
+		tolerance between a known-good and a known-bad value and narrows it with safeguarded secant
+		(Illinois) steps on the worst violation, and all of the searches are run together as parallel batches.
+		:param searches: a list of (parameter index, signed initial guess) pairs. a parameter can appear
+		                 twice to search both signs at once.
+		:param y0: the unperturbed observables (needed to use the slopes)
+		:param slopes: the (parameters × observables) sensitivities, used to pick a first guess
+		returns: the positive tolerance for each search
+	"""
+	indices = np.array([i for i, guess in searches])
+	signs = np.sign([guess for i, guess in searches])
+	caps = np.abs([float(guess) for i, guess in searches])
+	lo, hi = np.zeros(len(searches)), np.full(len(searches), np.inf) # the largest good and smallest bad magnitudes
+	v_lo, v_hi = np.full(len(searches), np.nan), np.full(len(searches), np.nan) # and the violations there
+	last_side = np.zeros(len(searches)) # which end of the bracket moved last (+1 for hi, -1 for lo)
+	trial = caps.copy()
+	if y0 is not None:
+		for k, i in enumerate(indices):
+			v_lo[k] = violation(y0, y_min, y_max, i)
+			if slopes is not None: # extrapolate linearly to where the first observable goes out of bounds
+				with np.errstate(divide='ignore', invalid='ignore'):
+					room = np.where(signs[k]*slopes[i] > 0, y_max - y0, y_min - y0)/(signs[k]*slopes[i])
+				room = room[[OBSERVABLES[j][3] is None or OBSERVABLES[j][3] == PARAMETERS[i] for j in range(y0.size)]]
+				room = room[np.isfinite(room) & (room > 0)]
+				if room.size > 0:
+					trial[k] = min(caps[k], np.min(room))
+
+	active = np.ones(len(searches), dtype=bool)
+	while np.any(active):
+		running = np.nonzero(active)[0]
+		ys = get_values_batch([basis_vec(indices[k], signs[k]*trial[k]) for k in running]) # try out all of the changes
+		for k, y in zip(running, ys):
+			if is_acceptable(y, y_min, y_max, indices[k]): # if everything is in bounds, this is a lower bound
+				lo[k], v_lo[k] = trial[k], violation(y, y_min, y_max, indices[k])
+				if last_side[k] == -1: # (if the same end moves twice in a row, lean on the other end so the secant doesn't stall)
+					v_hi[k] /= 2
+				last_side[k] = -1
+			else: # if something is wrong, it's an upper bound
+				hi[k], v_hi[k] = trial[k], violation(y, y_min, y_max, indices[k])
+				if last_side[k] == 1:
+					v_lo[k] /= 2
+				last_side[k] = 1
+
+			if lo[k] >= caps[k] or hi[k] < 1e-12 or (np.isfinite(hi[k]) and hi[k] - lo[k] <= FINNESS*hi[k]): # stop once it's bracketed closely enuff
+				active[k] = False
+			elif np.isinf(hi[k]): # if we haven't overshot yet, step out
+				trial[k] = min(4*trial[k], caps[k])
+			else: # otherwise, interpolate the violation to where it crosses zero
+				if np.isfinite(v_lo[k]) and np.isfinite(v_hi[k]) and v_hi[k] > v_lo[k]:
+					guess = lo[k] - v_lo[k]*(hi[k] - lo[k])/(v_hi[k] - v_lo[k])
+				elif lo[k] > 0:
+					guess = np.sqrt(lo[k]*hi[k])
+				else:
+					guess = hi[k]/4
+				margin = FINNESS/4*hi[k] # but don't waste a run right on top of either end of the bracket
+				trial[k] = min(max(guess, lo[k] + margin), hi[k] - margin)
+	return lo
 
 
 def get_name(param_code):
@@ -99,36 +242,45 @@ def get_units(param_code):
 
 if __name__ == '__main__':
 	x0 = np.zeros(len(PARAMETERS)) # get the base parameters
-	y0 = get_values(x0) # get the base observables by running the program
+	steps = np.array(3*[.5] + 6*[.02] + 3*[.1] + 6*[.1] + 5*[.5] + [1]) # begin finding the tolerances
+	tol = steps.copy()
+
+	script_hash = hash_script(template.script)
+	offsets = [-2, -1, 1, 2] if MAKE_GRAFS else [-1, 1] # the 2× points are only needed for the plots
+	if PARAMETRIC_MAP: # run COSY once with the parameters as DA parameters and read most of the stencil off of the map
+		parametric_map, mapped = build_parametric_map(x0)
+		y0, slopes, curvatures, υ = compute_sensitivities(
+			lambda Xs: get_values_from_map(parametric_map, mapped, Xs), x0, steps, offsets)
+	else: # run the whole stencil as one parallel batch to get the base observables and the direction of the dependencies
+		y0, slopes, curvatures, υ = compute_sensitivities(
+			get_values_batch, x0, steps, offsets, filename=f"sensitivities-{script_hash[:12]}.npz")
 	y_min = np.array([y + lo_bound for y, (_, lo_bound, _, _) in zip(y0, OBSERVABLES)])
 	y_max = np.array([y + hi_bound for y, (_, _, hi_bound, _) in zip(y0, OBSERVABLES)])
 
-	tol = np.array(3*[.5] + 6*[.02] + 3*[.1] + 6*[.1] + 5*[.5] + [1]) # begin finding the tolerances
-	slopes = np.full((x0.size, y0.size), np.nan) # and the direction of the dependencies
-	for i in range(x0.size):
-		# tol_plus = find_tolerance(10, y_min, y_max, i) # look up
-		# tol_minus = find_tolerance(-tol_plus, y_min, y_max, i) # look down
-		# tol[i] = min(tol_plus, tol_minus)*FINNESS # take the more restrictive one
+	if SEARCH_TOLERANCES: # search both directions for every parameter at once
+		searches = [(i, sign*MAX_TOLERANCE) for i in range(x0.size) for sign in [1, -1]]
+		tol_plus_minus = find_tolerances(searches, y_min, y_max, y0, slopes).reshape((x0.size, 2))
+		tol = np.min(tol_plus_minus, axis=1) # take the more restrictive one
 
-		ξ = np.array([-2*tol[i], -tol[i], 0, tol[i], 2*tol[i]]) # now plot out the dependency
-		υ = np.array([get_values(basis_vec(i, perturbation)) for perturbation in ξ])
-		slopes[i,:] = (υ[3,:] - υ[1,:])/(ξ[3] - ξ[1])
-
-		for j in range(y0.size):
-			plt.figure()
-			# if np.isfinite(OBSERVABLES[j][1]):
-			# 	plt.plot(ξ, [y0[j] + OBSERVABLES[j][1]]*len(ξ), 'w-')
-			# if np.isfinite(OBSERVABLES[j][2]):
-			# 	plt.plot(ξ, [y0[j] + OBSERVABLES[j][2]]*len(ξ), 'w-')
-			if OBSERVABLES[j][3] is None or OBSERVABLES[j][3] == PARAMETERS[i]:
-				plt.plot(ξ, υ[:,j], f'C{j}-')
-			else:
-				plt.plot(ξ, υ[:,j], f'C{j}--')
-			plt.xlabel(f"{PARAMETERS[i]} ({get_units(PARAMETERS[i])})")
-			plt.ylabel(OBSERVABLES[j][0])
-			plt.savefig(f"figs/dependency-{i}-{j}.png")
-		# plt.show()
-		plt.close('all')
+	for i in range(x0.size):
+		if MAKE_GRAFS:
+			ξ = np.array([-2*steps[i], -steps[i], 0, steps[i], 2*steps[i]]) # now plot out the dependency
+			υ_i = np.array([υ[i,0,:], υ[i,1,:], y0, υ[i,2,:], υ[i,3,:]])
+			for j in range(y0.size):
+				plt.figure()
+				# if np.isfinite(OBSERVABLES[j][1]):
+				# 	plt.plot(ξ, [y0[j] + OBSERVABLES[j][1]]*len(ξ), 'w-')
+				# if np.isfinite(OBSERVABLES[j][2]):
+				# 	plt.plot(ξ, [y0[j] + OBSERVABLES[j][2]]*len(ξ), 'w-')
+				if OBSERVABLES[j][3] is None or OBSERVABLES[j][3] == PARAMETERS[i]:
+					plt.plot(ξ, υ_i[:,j], f'C{j}-')
+				else:
+					plt.plot(ξ, υ_i[:,j], f'C{j}--')
+				plt.xlabel(f"{PARAMETERS[i]} ({get_units(PARAMETERS[i])})")
+				plt.ylabel(OBSERVABLES[j][0])
+				plt.savefig(f"figs/dependency-{i}-{j}.png")
+			# plt.show()
+			plt.close('all')
 
 		print(f"The tolerance on the {get_name(PARAMETERS[i])} is ±{tol[i]:.1g} {get_units(PARAMETERS[i])}")
 
@@ -144,9 +296,27 @@ if __name__ == '__main__':
 
 	print()
 
-	for j in range(y0.size): # now check the compound effects
-		x = x0 - tol*np.sign(slopes[:,j])
-		minimum = get_values(x)[j]
-		x = x0 + tol*np.sign(slopes[:,j])
-		maximum = get_values(x)[j]
+	corners = [x0 + sign*tol*np.sign(slopes[:,j]) for j in range(y0.size) for sign in [-1, 1]] # now check the compound effects
+	extremes = get_values_batch(corners).reshape((y0.size, 2, y0.size))
+	for j in range(y0.size):
+		minimum, maximum = extremes[j,0,j], extremes[j,1,j]
 		print(f"The {OBSERVABLES[j][0]} range is {minimum} < {y0[j]} < {maximum}")
+
+	if MONTE_CARLO: # now see how the errors stack up statistically
+		print()
+		distributions = [DISTRIBUTIONS[get_units(parameter)] for parameter in PARAMETERS]
+		checked = np.array([controller is None for (_, _, _, controller) in OBSERVABLES])
+		statistics = monte_carlo_tolerances(y0, slopes, curvatures, tol, distributions, y_min, y_max, checked)
+		for j in range(y0.size):
+			ranges = ", ".join(f"{p}%: {v:.5g}" for p, v in zip(PERCENTILES, statistics['percentiles'][:,j]))
+			print(f"The {OBSERVABLES[j][0]} is in bounds {statistics['yield'][j]:.2%} of the time ({ranges})")
+		for i, j in zip(*np.nonzero(statistics['undefined'])):
+			print(f"The sensitivity of the {OBSERVABLES[j][0]} to {PARAMETERS[i]} is undefined, so the model can't predict it")
+		left_out = [name for j, (name, _, _, controller) in enumerate(OBSERVABLES)
+		            if controller is None and np.any(statistics['undefined'][:, j])]
+		print(f"All uncorrected observables are in bounds {statistics['total yield']:.2%} of the time"
+		      + (f" (not counting the {', '.join(left_out)})" if len(left_out) > 0 else ""))
+		X, predicted, actual = spot_check(get_values_batch, y0, slopes, curvatures, tol, distributions)
+		error = np.max(np.abs(predicted - actual), axis=0)
+		for j in range(y0.size):
+			print(f"The response model's {OBSERVABLES[j][0]} is off by up to {error[j]:.3g} at {len(X)} spot-checked points")
@@ -1,8 +1,24 @@
 import numpy as np
 import matplotlib.pyplot as plt
-import subprocess
+import os
+
+from cosy_batch import BatchingPool, BatchTemplate
+from cosy_pool import CosyPool
+from fox_template import FoxTemplate
+import instrumentation
+from grid_scan import GridScan, estimate_root, polish_root
 
 MAKE_GRAFS = False
+COSY_EXECUTABLE = 'cosy'
+NUM_WORKERS = os.cpu_count()
+TIMEOUT = 600 # how long a COSY run can go before it's killed, in seconds
+MEMORY_LIMIT = 4*2**30 # how much memory a COSY run can use, in bytes
+BATCH_SIZE = 1 # how many (hexapole, octopole) pairs to evaluate in each COSY run (see cosy_batch)
+HEXAPOLE_RANGE = (0, 30) # the range of hexapole strengths to scan
+OCTOPOLE_RANGE = (-2, 2) # the range of octopole strengths to scan
+NUM_COARSE = (7, 7) # the number of points along each axis of the coarse grid
+NUM_LEVELS = 3 # the number of times to halve the grid spacing around the contours
+TARGETS = [(0, 0.), (1, 0.)] # the values of each observable we want (zero tilt and zero bend)
 
 FINNESS = 0.1**(3/3) # the amount we care about the tolerances being exact
 assert FINNESS < 1
@@ -17,55 +33,76 @@ OBSERVABLES = [ # the parameters we can measure (name, lower margin, upper margi
 	('Tilt Angle(deg)', -1, 1, 'strength_H2'),
 	('p-dist(mm)', -1, 1, 'strength_O')]
 
+pool = CosyPool(COSY_EXECUTABLE, NUM_WORKERS, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT,
+                required_observables=[f'FPDESIGN {key}' for key, lo, hi, controller in OBSERVABLES])
+template = FoxTemplate.from_file('MRSt_tol.fox', PARAMETERS)
+batch_template = BatchTemplate(template)
+
 
 def get_values(hexapole, octopole):
 	""" get the observable values at these perturbations """
-	with open('MRSt_tol.fox', 'r') as f:
-		fox = f.read()
+	return get_values_batch([[hexapole, octopole]])[0]
+
+
+def get_values_batch(points):
+	""" get the observable values at a bunch of (hexapole, octopole) pairs, running them all in parallel """
+	values, events = instrumentation.run_batch(
+		BatchingPool(pool, batch_template, BATCH_SIZE), lambda point: script_values(*point), points, parse_values)
+	instrumentation.record("tilt-scan", events)
+	return np.array(values)
+
+
+def parse_values(result):
+	""" read the observable values out of a parsed COSY output (all NaN if COSY failed, which the scan counts as out of bounds) """
+	if result.failed:
+		return [np.nan]*len(OBSERVABLES)
+	return [result.fpdesign.get(key, np.nan) for key, lo, hi, controller in OBSERVABLES]
+
+
+def fill_in_script(hexapole, octopole):
+	""" put the magnet strengths into the placeholders in the tolerance script """
+	return template.render(script_values(hexapole, octopole))
+
+
+def script_values(hexapole, octopole):
+	""" the value of every placeholder in the tolerance script for these magnet strengths """
+	values = {}
 	for parameter in PARAMETERS:
 		if parameter == 'strength_H2':
-			fox = fox.replace(f'<<{parameter}>>', str(hexapole))
+			values[parameter] = hexapole
 		elif parameter == 'strength_O':
-			fox = fox.replace(f'<<{parameter}>>', str(octopole))
-		if 'strength' in parameter:
-			fox = fox.replace(f'<<{parameter}>>', '1')
+			values[parameter] = octopole
+		elif 'strength' in parameter:
+			values[parameter] = 1
 		else:
-			fox = fox.replace(f'<<{parameter}>>', '0')
-	with open('temp.fox', 'w') as g:
-		g.write(fox)
-	try:
-		res = subprocess.run(['cosy', 'temp'], capture_output=True, check=True)
-	except subprocess.CalledProcessError:
-		print(res.stdout.decode('ascii'))
-	vals = []
-	for line in res.stdout.decode('ascii').split('\r\n'):
-		if 'FPDESIGN' in line:
-			if "Tilt Angle" in line:
-				vals.append(float(line.split()[-1]))
-			elif "p-dist" in line:
-				vals.append(float(line.split()[-1]))
-	return vals
+			values[parameter] = 0
+	return values
 
 
 if __name__ == '__main__':
-	x = np.linspace(0, 30, 12)
-	y = np.linspace(-2, 2, 13)
-	tilt = np.empty((y.size, x.size))
-	bend = np.empty((y.size, x.size))
-	for j in range(x.size):
-		for i in range(y.size):
-			print(i,j)
-			tilt[i,j], bend[i,j] = get_values(x[j], y[i])
-	plt.figure()
-	plt.contourf(x, y, tilt)
-	plt.title("tilt")
-	plt.xlabel("hexapole strength")
-	plt.ylabel("octopole strength")
-	plt.colorbar()
-	plt.figure()
-	plt.contourf(x, y, bend)
-	plt.title("bend")
-	plt.xlabel("hexapole strength")
-	plt.ylabel("octopole strength")
-	plt.colorbar()
+	scan = GridScan('tilt_scan.npy', [HEXAPOLE_RANGE[0], OCTOPOLE_RANGE[0]], [HEXAPOLE_RANGE[1], OCTOPOLE_RANGE[1]],
+	                NUM_COARSE, NUM_LEVELS, len(OBSERVABLES))
+	scan.run(get_values_batch, TARGETS)
+	X, Y = scan.known_points()
+
+	scales = [hi - lo for key, lo, hi, controller in OBSERVABLES]
+	guess = estimate_root(X, Y, TARGETS, scales)
+	print(f"the scan puts the root near hexapole = {guess[0]:.4f}, octopole = {guess[1]:.4f}")
+	spacing = (scan.upper - scan.lower)/(np.array(scan.shape) - 1)
+	root, values = polish_root(get_values_batch, guess, TARGETS, spacing/10, [hi/10 for hi in scales])
+	print(f"the root is at hexapole = {root[0]:.6f}, octopole = {root[1]:.6f}, where "
+	      + ", ".join(f"{key} = {value:.4f}" for (key, lo, hi, controller), value in zip(OBSERVABLES, values)))
+	print(f"that took {scan.num_evaluations} new scan evaluations plus the polishing")
+
+	finite = np.all(np.isfinite(Y), axis=1)
+	for j, title in enumerate(["tilt", "bend"]):
+		plt.figure()
+		plt.tricontourf(X[finite, 0], X[finite, 1], Y[finite, j])
+		plt.scatter(X[:, 0], X[:, 1], s=2, c='k')
+		plt.plot(root[0], root[1], 'r*')
+		plt.title(title)
+		plt.xlabel("hexapole strength")
+		plt.ylabel("octopole strength")
+		plt.colorbar()
 	plt.show()
+	pool.close()
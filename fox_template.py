@@ -0,0 +1,76 @@
+import re
+from typing import Dict, List, Mapping, Sequence, Tuple
+
+
+class FoxTemplate:
+	""" a COSY script that has been picked apart once so that variants of it can be written quickly.
+		each parameter is either a numeric assignment in the script (`name := 1.23;`), in which case
+		the number gets replaced, or a placeholder (`<<name>>`), in which case every copy of it does.
+		the script is split into fixed fragments around those slots, so rendering a variant is just
+		a matter of joining the fragments with the new values, and any parameter that's missing or
+		ambiguous is caught here rather than after a failed COSY run.
+	"""
+	def __init__(self, script: str, parameters: Sequence[str]):
+		""" :param script: the full text of the .fox file
+			:param parameters: the names of the assignments and placeholders that will be filled in
+		"""
+		self.script = script
+		self.parameters = list(parameters)
+		self.defaults: Dict[str, float] = {}
+
+		assignments: Dict[str, List[Tuple[int, int, str]]] = {}
+		for match in re.finditer(r"\b(\w+) := ([-+]?[.\d]+(?:[eE][-+]?\d+)?);", script):
+			assignments.setdefault(match.group(1), []).append((match.start(2), match.end(2), match.group(2)))
+		placeholders: Dict[str, List[Tuple[int, int]]] = {}
+		for match in re.finditer(r"<<(\w+)>>", script):
+			placeholders.setdefault(match.group(1), []).append((match.start(), match.end()))
+
+		problems = []
+		slots = []
+		for name in self.parameters:
+			if name in assignments and name in placeholders:
+				problems.append(f"{name} is both assigned and used as a placeholder")
+			elif name in placeholders:
+				slots += [(start, end, name) for start, end in placeholders[name]]
+			elif name not in assignments:
+				problems.append(f"there's no assignment or placeholder for {name}")
+			elif len(assignments[name]) > 1:
+				problems.append(f"{name} is assigned {len(assignments[name])} times, so I don't know which one to change")
+			else:
+				start, end, value = assignments[name][0]
+				slots.append((start, end, name))
+				self.defaults[name] = float(value)
+		for name in placeholders:
+			if name not in self.parameters:
+				problems.append(f"nothing is going to fill in the placeholder <<{name}>>")
+		if len(problems) > 0:
+			raise ValueError("this script can't be used as a template:\n\t" + "\n\t".join(problems))
+
+		slots.sort()
+		self.fragments = []
+		self.slots = []
+		last_end = 0
+		for start, end, name in slots:
+			self.fragments.append(script[last_end:start])
+			self.slots.append(name)
+			last_end = end
+		self.fragments.append(script[last_end:])
+
+	@classmethod
+	def from_file(cls, filename: str, parameters: Sequence[str]) -> "FoxTemplate":
+		with open(filename, "r") as f:
+			return cls(f.read(), parameters)
+
+	def render(self, values: Mapping[str, object]) -> str:
+		""" write out a version of the script with the given values filled in.  the values can be numbers
+			or strings; either way they're put in with str().
+		"""
+		try:
+			texts = {name: str(values[name]) for name in self.parameters}
+		except KeyError as e:
+			raise ValueError(f"no value was given for {e.args[0]}")
+		pieces = [self.fragments[0]]
+		for name, fragment in zip(self.slots, self.fragments[1:]):
+			pieces.append(texts[name])
+			pieces.append(fragment)
+		return "".join(pieces)
@@ -0,0 +1,190 @@
+import json
+import os
+from itertools import product
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+BatchFunction = Callable[[NDArray[float]], NDArray[float]]
+
+
+class GridScan:
+	""" an N-dimensional parameter scan that starts on a coarse grid and only fills in the finer grid
+		in cells where one of the contours of interest passes thru.  every point that could ever be
+		evaluated lives on a single finest-level lattice, which is kept in a memory-mapped .npy file
+		where NaN means "not evaluated yet", so a scan that gets interrupted picks up where it left off.
+	"""
+	def __init__(self, filename: str, lower: Sequence[float], upper: Sequence[float],
+	             num_coarse: Sequence[int], num_levels: int, num_outputs: int):
+		""" :param filename: the .npy file in which to keep the results (a .json file next to it records the grid)
+			:param lower: the lower bound of each parameter
+			:param upper: the upper bound of each parameter
+			:param num_coarse: the number of points along each parameter on the coarse grid
+			:param num_levels: the number of times a cell can be split in half along each parameter
+			:param num_outputs: the number of values that the evaluation function returns for each point
+		"""
+		self.filename = filename
+		self.lower = np.array(lower, dtype=float)
+		self.upper = np.array(upper, dtype=float)
+		self.num_levels = num_levels
+		self.coarse_stride = 2**num_levels
+		self.shape = tuple((n - 1)*self.coarse_stride + 1 for n in num_coarse)
+		self.num_outputs = num_outputs
+		self.num_evaluations = 0
+
+		description = {"lower": self.lower.tolist(), "upper": self.upper.tolist(),
+		               "shape": list(self.shape), "num_outputs": num_outputs}
+		description_filename = os.path.splitext(filename)[0] + ".json"
+		try:
+			with open(description_filename, "r") as file:
+				resumable = json.load(file) == description and os.path.isfile(filename)
+		except FileNotFoundError:
+			resumable = False
+		if resumable:
+			self.values = np.lib.format.open_memmap(filename, mode="r+")
+			print(f"resuming the scan in {filename} with {self.num_known()} points already done")
+		else:
+			self.values = np.lib.format.open_memmap(
+				filename, mode="w+", dtype=float, shape=self.shape + (num_outputs,))
+			self.values[...] = np.nan
+			self.values.flush()
+			with open(description_filename, "w") as file:
+				json.dump(description, file)
+
+	def num_known(self) -> int:
+		return int(np.count_nonzero(~np.all(np.isnan(self.values), axis=-1)))
+
+	def parameters(self, indices: NDArray[int]) -> NDArray[float]:
+		""" convert some lattice indices to parameter values """
+		return self.lower + np.asarray(indices)*(self.upper - self.lower)/(np.array(self.shape) - 1)
+
+	def known_points(self) -> Tuple[NDArray[float], NDArray[float]]:
+		""" every point that's been evaluated so far.
+			returns: the (n × parameters) array of parameter values and the (n × outputs) array of results
+		"""
+		indices = np.argwhere(~np.all(np.isnan(self.values), axis=-1))
+		return self.parameters(indices), self.values[tuple(indices.T)]
+
+	def evaluate(self, evaluate_batch: BatchFunction, indices: NDArray[int]) -> None:
+		""" run every one of these lattice points that isn't already done, as a single batch, and save the results """
+		indices = np.unique(np.reshape(indices, (-1, len(self.shape))), axis=0)
+		indices = indices[np.all(np.isnan(self.values[tuple(indices.T)]), axis=-1)]
+		if indices.shape[0] == 0:
+			return
+		results = np.asarray(evaluate_batch(self.parameters(indices)), dtype=float)
+		# a point that failed gets +inf rather than NaN so we don't try it again next time
+		results[np.isnan(results)] = np.inf
+		self.values[tuple(indices.T)] = results
+		self.values.flush()
+		self.num_evaluations += indices.shape[0]
+
+	def cell_points(self, corners: NDArray[int], stride: int) -> NDArray[int]:
+		""" every lattice point at a given stride in each of some cells, given their lower corners """
+		offsets = np.array(list(product(*[range(0, 2*stride + 1, stride)]*len(self.shape))))
+		return corners[:, np.newaxis, :] + offsets[np.newaxis, :, :]
+
+	def run(self, evaluate_batch: BatchFunction, contours: Sequence[Tuple[int, float]]) -> "GridScan":
+		""" evaluate the coarse grid, then repeatedly split any cell that a contour passes thru.
+			:param evaluate_batch: a function that takes an (n × parameters) array and returns an (n × outputs) array
+			:param contours: the contours to refine around, as pairs of (output index, value)
+		"""
+		dimensions = len(self.shape)
+		corner_offsets = np.array(list(product([0, 1], repeat=dimensions)))
+		stride = self.coarse_stride
+		coarse_axes = [np.arange(0, size - 1, stride) for size in self.shape]
+		cells = np.array(list(product(*coarse_axes)), dtype=int).reshape((-1, dimensions))
+		self.evaluate(evaluate_batch, cells[:, np.newaxis, :] + stride*corner_offsets)
+		for level in range(self.num_levels):
+			# find the cells that a contour goes thru
+			corners = cells[:, np.newaxis, :] + stride*corner_offsets  # (cells, corners, dimensions)
+			corner_values = self.values[tuple(np.moveaxis(corners, -1, 0))]  # (cells, corners, outputs)
+			interesting = np.zeros(cells.shape[0], dtype=bool)
+			for output, value in contours:
+				differences = corner_values[:, :, output] - value
+				valid = np.isfinite(differences)  # a failed corner doesn't say which side of the contour it's on
+				above = np.any(valid & (differences >= 0), axis=1)
+				below = np.any(valid & (differences <= 0), axis=1)
+				interesting |= above & below
+			print(f"level {level}: {np.count_nonzero(interesting)}/{cells.shape[0]} cells need refining "
+			      f"({self.num_evaluations} evaluations so far)")
+			if not np.any(interesting):
+				break
+			# split them in half along every dimension
+			stride //= 2
+			cells = cells[interesting]
+			self.evaluate(evaluate_batch, self.cell_points(cells, stride))
+			cells = (cells[:, np.newaxis, :] + stride*corner_offsets).reshape((-1, dimensions))
+		print(f"the scan is done after {self.num_evaluations} new evaluations "
+		      f"({self.num_known()} of {np.prod(self.shape)} lattice points known)")
+		return self
+
+
+def estimate_root(X: NDArray[float], Y: NDArray[float], targets: Sequence[Tuple[int, float]],
+                  scales: Optional[Sequence[float]] = None) -> NDArray[float]:
+	""" guess where all of the targets are met at once from some scattered evaluations, by fitting a plane
+		to the points nearest the best one and solving for where it hits the targets
+		:param X: the (n × parameters) parameter values
+		:param Y: the (n × outputs) results
+		:param targets: pairs of (output index, value) that should all be met
+		:param scales: the amount of each output that's considered significant (defaults to 1 for all of them)
+	"""
+	outputs = [output for output, value in targets]
+	goal = np.array([value for output, value in targets])
+	scales = np.ones(len(targets)) if scales is None else np.asarray(scales, dtype=float)
+	finite = np.all(np.isfinite(Y[:, outputs]), axis=1)
+	X, Y = X[finite], Y[finite][:, outputs]
+	residuals = np.sqrt(np.sum(((Y - goal)/scales)**2, axis=1))
+	best = np.argmin(residuals)
+	# fit a plane to the points closest to the best one
+	span = np.ptp(X, axis=0)
+	span[span == 0] = 1
+	distances = np.sqrt(np.sum(((X - X[best])/span)**2, axis=1))
+	nearest = np.argsort(distances)[:min(X.shape[0], 3*X.shape[1] + 1)]
+	A = np.hstack([np.ones((nearest.size, 1)), X[nearest] - X[best]])
+	coefficients, *_ = np.linalg.lstsq(A, Y[nearest], rcond=None)
+	jacobian = coefficients[1:].T  # (outputs × parameters)
+	step, *_ = np.linalg.lstsq(jacobian, goal - coefficients[0], rcond=None)
+	return X[best] + step
+
+
+def polish_root(evaluate_batch: BatchFunction, x0: NDArray[float], targets: Sequence[Tuple[int, float]],
+                steps: Sequence[float], tolerances: Sequence[float], max_iterations: int = 10
+                ) -> Tuple[NDArray[float], NDArray[float]]:
+	""" refine a root with Newton's method, evaluating each point along with its finite-difference
+		neighbors as a single batch so that each iteration only takes as long as one COSY run
+		:param steps: the finite-difference step for each parameter
+		:param tolerances: how close each output must get to its target
+		returns: the root and the outputs there
+	"""
+	outputs = [output for output, value in targets]
+	goal = np.array([value for output, value in targets])
+	steps = np.asarray(steps, dtype=float)
+	x = np.asarray(x0, dtype=float)
+	last_x, last_y, step = None, None, None  # the last point that COSY could evaluate, and the step that left it
+	for iteration in range(max_iterations):
+		points = np.vstack([x, x + np.diag(steps)])
+		results = np.asarray(evaluate_batch(points), dtype=float)
+		y = results[0]
+		if not np.all(np.isfinite(y[outputs])):  # if COSY failed here, go back and take a shorter step
+			if last_x is None:
+				raise ValueError(f"I can't polish a root starting from {x}, since COSY fails there")
+			step = step/2
+			print(f"iteration {iteration}: {x} failed")
+			x = last_x + step
+			continue
+		if np.all(np.abs(y[outputs] - goal) <= tolerances):
+			return x, y
+		usable = np.all(np.isfinite(results[1:, outputs]), axis=1)  # a neighbor that failed says nothing about the slope
+		if not np.any(usable):
+			raise ValueError(f"I can't get the slope at {x}, since COSY fails at every one of its neighbors")
+		jacobian = ((results[1:][usable] - y)[:, outputs]/steps[usable, np.newaxis]).T  # (outputs × usable parameters)
+		step = np.zeros(x.size)
+		step[usable], *_ = np.linalg.lstsq(jacobian, goal - y[outputs], rcond=None)
+		print(f"iteration {iteration}: {x} -> {y[outputs]}")
+		last_x, last_y = x, y
+		x = x + step
+	y = np.asarray(evaluate_batch(x[np.newaxis, :]), dtype=float)[0]
+	if not np.all(np.isfinite(y[outputs])) and last_x is not None:
+		return last_x, last_y
+	return x, y
@@ -0,0 +1,193 @@
+import argparse
+import csv
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional, Sequence, Tuple, TypeVar
+
+import numpy as np
+
+from cosy_output import CosyResult, parse_cosy_output
+
+Point = TypeVar("Point")
+Result = TypeVar("Result")
+
+# the timings (in seconds) that each evaluation event can have
+TIMINGS = ["lookup", "render", "write", "subprocess", "cpu", "parse", "store"]
+FIELDS = ["time", "workflow", "cached", "failed", "worker"] + TIMINGS
+PERCENTILES = [50, 90, 99]
+
+
+class EventLog:
+	""" a file to which every evaluation gets written as one line, either as JSON or (if the filename
+		ends in .csv) as a CSV row.  it's appended to, so several runs can share one log.
+	"""
+	def __init__(self, filename: str):
+		self.filename = filename
+		self.lock = threading.Lock()
+		self.is_csv = filename.endswith(".csv")
+		is_new = not os.path.isfile(filename) or os.path.getsize(filename) == 0
+		self.file = open(filename, "a", newline="")
+		if self.is_csv:
+			self.writer = csv.DictWriter(self.file, FIELDS, extrasaction="ignore")
+			if is_new:
+				self.writer.writeheader()
+
+	def record(self, events: Sequence[Dict[str, Any]]) -> None:
+		with self.lock:
+			for event in events:
+				if self.is_csv:
+					self.writer.writerow(event)
+				else:
+					self.file.write(json.dumps(event) + "\n")
+			self.file.flush()
+
+	def close(self) -> None:
+		with self.lock:
+			self.file.close()
+
+
+log: Optional[EventLog] = EventLog(os.environ["COSY_EVENT_LOG"]) if "COSY_EVENT_LOG" in os.environ else None
+
+
+def start_log(filename: str) -> None:
+	""" start writing evaluation events to the given file (you can also set the COSY_EVENT_LOG environment variable) """
+	global log
+	if log is not None:
+		log.close()
+	log = EventLog(filename)
+
+
+def record(workflow: str, events: Sequence[Dict[str, Any]]) -> None:
+	""" save some evaluation events to the log, if there is one """
+	if log is not None:
+		now = time.time()
+		log.record([{"time": now, "workflow": workflow, **event} for event in events])
+
+
+@contextmanager
+def stopwatch() -> Iterator[Dict[str, float]]:
+	""" time a block of code.  the elapsed time is put in the yielded dict under "seconds". """
+	timing = {}
+	start = time.perf_counter()
+	try:
+		yield timing
+	finally:
+		timing["seconds"] = time.perf_counter() - start
+
+
+def run_batch(pool, render: Callable[[Point], str], points: Sequence[Point],
+              parse: Optional[Callable[[CosyResult], Result]] = None) -> Tuple[List[Result], List[Dict[str, Any]]]:
+	""" render, run, and parse a batch of points, timing each step of each one.  every output gets parsed into
+		a CosyResult first, which is where each event's "failed" comes from, whatever the caller turns it into.
+		:param pool: a CosyPool (or anything else with a map_with_timings method, like a BatchingPool)
+		:param render: the function that turns a point into whatever the pool takes (a COSY script, or for a
+		               BatchingPool, the values to fill into its template)
+		:param parse: the function that turns a CosyResult into whatever you need (by default you get the CosyResults)
+		returns: the parsed results and an event dict for each point, which can be added to and then passed to record()
+	"""
+	scripts, events = [], []
+	for point in points:
+		start = time.perf_counter()
+		scripts.append(render(point))
+		events.append({"render": time.perf_counter() - start, "cached": False})
+	runs = pool.map_with_timings(scripts)
+	results = []
+	for (output, run_timings), event in zip(runs, events):
+		for key, value in run_timings.items():
+			if key == "render":  # a BatchingPool does some of the rendering itself
+				event[key] += value
+			else:
+				event[key] = value
+		start = time.perf_counter()
+		result = parse_cosy_output(output)
+		results.append(parse(result) if parse is not None else result)
+		event["parse"] = time.perf_counter() - start
+		event["failed"] = result.failed
+	return results, events
+
+
+def load_events(filename: str) -> List[Dict[str, Any]]:
+	""" read back a log written by EventLog """
+	events = []
+	with open(filename, "r", newline="") as file:
+		if filename.endswith(".csv"):
+			for row in csv.DictReader(file):
+				event = {"workflow": row["workflow"], "cached": row["cached"] == "True",
+				         "failed": row["failed"] == "True", "worker": row["worker"]}
+				for key in ["time"] + TIMINGS:
+					if row.get(key, "") != "":
+						event[key] = float(row[key])
+				events.append(event)
+		else:
+			for line in file:
+				if line.strip() != "":
+					events.append(json.loads(line))
+	return events
+
+
+def summarize(events: Sequence[Dict[str, Any]]) -> None:
+	""" print the percentiles of each timing for each workflow, and how the time splits between COSY and Python """
+	for workflow in sorted({event["workflow"] for event in events}):
+		subset = [event for event in events if event["workflow"] == workflow]
+		num_cached = sum(1 for event in subset if event.get("cached"))
+		num_failed = sum(1 for event in subset if event.get("failed"))
+		print(f"{workflow}: {len(subset)} evaluations ({num_cached} from the cache, {num_failed} failed)")
+		print(f"    {'':16s}" + "".join(f"{f'p{percentile}':>10s}" for percentile in PERCENTILES) +
+		      f"{'mean':>10s}{'total':>10s}")
+		totals = {}
+		for key in TIMINGS:
+			values = np.array([event[key] for event in subset if event.get(key) is not None], dtype=float)
+			if values.size == 0:
+				continue
+			totals[key] = np.sum(values)
+			print(f"    {key + ' (ms)':16s}" + "".join(f"{1e3*value:10.3g}" for value in np.percentile(values, PERCENTILES)) +
+			      f"{1e3*np.mean(values):10.3g}{np.sum(values):9.3g}s")
+		ours = sum(total for key, total in totals.items() if key not in ["subprocess", "cpu"])
+		if totals.get("subprocess", 0) + ours > 0:
+			print(f"    {100*totals.get('subprocess', 0)/(totals.get('subprocess', 0) + ours):.1f}% of the "
+			      f"time per evaluation was COSY and {100*ours/(totals.get('subprocess', 0) + ours):.1f}% was Python")
+
+
+def plot_throughput(events: Sequence[Dict[str, Any]], bin_width: Optional[float] = None,
+                    filename: Optional[str] = None) -> None:
+	""" plot the number of evaluations completed per second over the course of the log, one line per workflow """
+	import matplotlib.pyplot as plt
+	times = np.array([event["time"] for event in events])
+	start, end = np.min(times), np.max(times)
+	if bin_width is None:
+		bin_width = max((end - start)/50, 1.)
+	bins = np.arange(start, end + bin_width, bin_width)
+	plt.figure()
+	for workflow in sorted({event["workflow"] for event in events}):
+		for cached in [False, True]:
+			subset = [event["time"] for event in events
+			          if event["workflow"] == workflow and bool(event.get("cached")) == cached]
+			if len(subset) > 0:
+				counts, _ = np.histogram(subset, bins)
+				plt.step(bins[:-1] - start, counts/bin_width, where="post",
+				         label=f"{workflow} ({'cached' if cached else 'COSY'})")
+	plt.xlabel("Time since the first event (s)")
+	plt.ylabel("Evaluations per second")
+	plt.legend()
+	plt.grid()
+	plt.tight_layout()
+	if filename is not None:
+		plt.savefig(filename)
+	else:
+		plt.show()
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="summarize a log of COSY evaluations")
+	parser.add_argument("filename", help="the .jsonl or .csv event log")
+	parser.add_argument("--chart", nargs="?", const="", default=None,
+	                    help="plot the throughput over time (and save it to this file, if one is given)")
+	parser.add_argument("--bin-width", type=float, help="the width of the throughput bins in seconds")
+	args = parser.parse_args()
+	events = load_events(args.filename)
+	summarize(events)
+	if args.chart is not None:
+		plot_throughput(events, args.bin_width, args.chart if args.chart != "" else None)
@@ -6,6 +6,8 @@ from matplotlib.collections import PatchCollection
 from matplotlib.patches import Circle
 from numpy.typing import NDArray
 
+from multipole_field import wire_sum
+
 r_wire = .1
 
 def main():
@@ -60,10 +62,7 @@ def main():
 
 		X, Y = np.meshgrid(np.linspace(-r_aperture, r_aperture, 101),
 		                   np.linspace(-r_aperture, r_aperture, 101), indexing="ij")
-		A = np.zeros_like(X)
-		for x0, y0, sine in zip(present_xs, present_ys, sines):
-			R = np.hypot(X - x0, Y - y0)
-			A += sine/R
+		A = wire_sum(X, Y, present_xs, present_ys, sines, lambda offset: 1/np.abs(offset))
 		A[np.hypot(X, Y) > r_aperture] = nan
 		ax.contour(X, Y, A, levels=np.linspace(-20, 20, 16), colors="#700", linewidths=.6,
 		           linestyles="solid", negative_linestyles="solid", zorder=1)
@@ -0,0 +1,283 @@
+from functools import lru_cache
+from itertools import product
+from math import radians
+from typing import Optional, Sequence
+
+import numpy as np
+from numpy.typing import NDArray
+
+from map_tracing import AMUMEV, E0, m0
+from visualize import COSY_Matrix, monomial_recipe
+
+NUM_COORDINATES = 6  # x, a, y, b, l, d; anything past these is a parameter that the map leaves alone
+
+
+class Algebra:
+	""" the bookkeeping for truncated power series in some number of variables up to some order.  a series is
+		a dense array of coefficients, one for every monomial of total degree up to the order, in order of
+		increasing degree (so the constant term is always first and the linear terms come right after it).
+		anything with extra trailing axes is a bunch of series at once.
+	"""
+	def __init__(self, order: int, num_variables: int = NUM_COORDINATES):
+		self.order = order
+		self.num_variables = num_variables
+		exponents = [term for term in product(range(order + 1), repeat=num_variables) if sum(term) <= order]
+		exponents.sort(key=lambda term: (sum(term), tuple(-power for power in term)))
+		self.exponents = np.array(exponents, dtype=int).reshape((-1, num_variables))
+		self.degrees = np.sum(self.exponents, axis=1)
+		self.size = self.exponents.shape[0]
+		self.radix = (order + 1)**np.arange(num_variables)
+		codes = self.exponents@self.radix
+		self.sorted_codes = np.sort(codes)
+		self.code_indices = np.argsort(codes)
+
+		# every pair of monomials whose product survives the truncation, grouped by which monomial it makes
+		i, j = np.nonzero(self.degrees[:, np.newaxis] + self.degrees[np.newaxis, :] <= order)
+		k = self.find(self.exponents[i] + self.exponents[j])
+		grouping = np.argsort(k, kind="stable")
+		self.left, self.right = i[grouping], j[grouping]
+		self.product_starts = np.searchsorted(k[grouping], np.arange(self.size))
+
+	def find(self, exponents: NDArray[int]) -> NDArray[int]:
+		""" the index of each of these monomials """
+		codes = np.asarray(exponents)@self.radix
+		return self.code_indices[np.searchsorted(self.sorted_codes, codes)]
+
+	def constant(self, value: float) -> NDArray[float]:
+		series = np.zeros(self.size)
+		series[0] = value
+		return series
+
+	def variable(self, index: int) -> NDArray[float]:
+		series = np.zeros(self.size)
+		series[1 + index] = 1
+		return series
+
+	def multiply(self, a: NDArray[float], b: NDArray[float]) -> NDArray[float]:
+		""" the product of two series, dropping everything past the order """
+		return np.add.reduceat(a[self.left]*b[self.right], self.product_starts, axis=0)
+
+	def power(self, a: NDArray[float], exponent: float) -> NDArray[float]:
+		""" raise a series to any power by expanding around its constant term, which must be positive unless
+			the exponent is a nonnegative integer
+		"""
+		a0 = a[0]
+		if a0 == 0 and not (exponent == int(exponent) and exponent >= 0):
+			raise ValueError(f"I can't raise a series with no constant term to the power {exponent}")
+		if a0 == 0:
+			result = self.constant(1)
+			for _ in range(int(exponent)):
+				result = self.multiply(result, a)
+			return result
+		relative = a/a0
+		relative[0] = 0
+		result = self.constant(1)
+		term = self.constant(1)
+		binomial = 1.
+		for k in range(1, self.order + 1):
+			binomial *= (exponent - k + 1)/k
+			term = self.multiply(term, relative)
+			result = result + binomial*term
+		return a0**exponent*result
+
+
+@lru_cache(maxsize=None)
+def get_algebra(order: int, num_variables: int = NUM_COORDINATES) -> Algebra:
+	return Algebra(order, num_variables)
+
+
+class TransferMap:
+	""" a transfer map as a truncated power series: each final coordinate (x, a, y, b, l, d, then any parameters)
+		as a polynomial in the initial ones, in COSY's units.  maps can be composed, inverted, and combined with
+		drifts and small misalignments, so that the PM printout of one COSY run can stand in for lots of
+		variations on it.  keep in mind that anything that shifts the reference orbit (a map with a constant part)
+		makes the lower orders depend on higher-order terms that were never computed, so those results are only
+		good to the extent that the offsets are small.
+	"""
+	def __init__(self, algebra: Algebra, coefficients: NDArray[float]):
+		""" :param algebra: the monomials that the rows of the coefficient array correspond to
+			:param coefficients: a (monomials × variables) array where column i is the series for final coordinate i
+		"""
+		self.algebra = algebra
+		self.coefficients = np.asarray(coefficients, dtype=float)
+
+	@property
+	def order(self) -> int:
+		return self.algebra.order
+
+	@property
+	def num_variables(self) -> int:
+		return self.algebra.num_variables
+
+	@classmethod
+	def identity(cls, order: int, num_variables: int = NUM_COORDINATES) -> "TransferMap":
+		algebra = get_algebra(order, num_variables)
+		coefficients = np.zeros((algebra.size, num_variables))
+		coefficients[1:1 + num_variables] = np.eye(num_variables)
+		return cls(algebra, coefficients)
+
+	@classmethod
+	def from_matrix(cls, matrix: COSY_Matrix, order: Optional[int] = None) -> "TransferMap":
+		""" convert a map that COSY printed.  COSY doesn't print d (or any parameters), since they don't change,
+			so they're filled in as the identity.  the parameters are whatever exponent columns past the first 6
+			have any nonzero entries.
+			:param order: the order to truncate to (defaults to the highest order in the printout)
+		"""
+		used = np.nonzero(np.any(matrix.exponents != 0, axis=0))[0]
+		num_variables = max(NUM_COORDINATES, used[-1] + 1 if used.size > 0 else 0)
+		exponents = matrix.exponents[:, :num_variables]
+		if order is None:
+			order = int(np.max(np.sum(exponents, axis=1), initial=1))
+		result = cls.identity(order, num_variables)
+		result.coefficients[:, :5] = 0
+		keep = np.sum(exponents, axis=1) <= order
+		result.coefficients[result.algebra.find(exponents[keep]), :5] = matrix.cosy_coefficients[keep]
+		return result
+
+	def to_matrix(self) -> COSY_Matrix:
+		""" convert back to a COSY_Matrix (which only has the first five outputs, like COSY's printouts) """
+		keep = np.any(self.coefficients[:, :5] != 0, axis=1)
+		return COSY_Matrix.from_arrays(self.algebra.exponents[keep], self.coefficients[keep, :5])
+
+	def truncate(self, order: int) -> "TransferMap":
+		algebra = get_algebra(order, self.num_variables)
+		return TransferMap(algebra, self.coefficients[self.algebra.find(algebra.exponents)])
+
+	def linear_part(self) -> NDArray[float]:
+		""" the Jacobian at the origin, as a (final × initial) matrix """
+		return self.coefficients[1:1 + self.num_variables].T.copy()
+
+	def compose(self, inner: "TransferMap") -> "TransferMap":
+		""" the map that applies inner and then this one (that is, this map evaluated at inner) """
+		self._check_compatible(inner)
+		algebra = self.algebra
+		used = np.nonzero(np.any(self.coefficients != 0, axis=1))[0]
+		steps, term_indices = monomial_recipe(algebra.exponents[used])
+		powers = np.empty((len(steps) + 1, algebra.size))
+		powers[0] = algebra.constant(1)
+		for i, (lower, coordinate) in enumerate(steps, start=1):
+			powers[i] = algebra.multiply(powers[lower], inner.coefficients[:, coordinate])
+		return TransferMap(algebra, powers[term_indices].T@self.coefficients[used])
+
+	def __matmul__(self, inner: "TransferMap") -> "TransferMap":
+		return self.compose(inner)
+
+	def then(self, outer: "TransferMap") -> "TransferMap":
+		""" the map that applies this one and then outer, for reading a beamline from left to right """
+		return outer.compose(self)
+
+	def inverse(self) -> "TransferMap":
+		""" the map that undoes this one, to the same order """
+		constant = self.coefficients[0].copy()
+		centered = TransferMap(self.algebra, self.coefficients.copy())
+		centered.coefficients[0] = 0
+		linear_inverse = np.linalg.inv(centered.linear_part())
+		linear = TransferMap.identity(self.order, self.num_variables)
+		linear.coefficients[1:1 + self.num_variables] = linear_inverse.T
+		nonlinear = TransferMap(self.algebra, centered.coefficients.copy())
+		nonlinear.coefficients[1:1 + self.num_variables] = 0
+		# M = L + N, so M⁻¹ = L⁻¹∘(I - N∘M⁻¹); each pass gets one more order right
+		identity = TransferMap.identity(self.order, self.num_variables)
+		inverse = linear
+		for _ in range(self.order - 1):
+			inverse = linear.compose(TransferMap(self.algebra, identity.coefficients - nonlinear.compose(inverse).coefficients))
+		if np.any(constant != 0):
+			inverse = inverse.compose(TransferMap.translation(-constant, self.order, self.num_variables))
+		return inverse
+
+	def evaluate(self, rays: NDArray[float]) -> NDArray[float]:
+		""" push some rays thru the map.
+			:param rays: an (n_rays × variables) array of initial coordinates in COSY's units
+			returns: an (n_rays × variables) array of final coordinates in COSY's units
+		"""
+		rays = np.atleast_2d(np.asarray(rays, dtype=float))
+		used = np.nonzero(np.any(self.coefficients != 0, axis=1))[0]
+		steps, term_indices = monomial_recipe(self.algebra.exponents[used])
+		monomials = np.empty((len(steps) + 1, rays.shape[0]))
+		monomials[0] = 1
+		for i, (lower, coordinate) in enumerate(steps, start=1):
+			np.multiply(monomials[lower], rays[:, coordinate], out=monomials[i])
+		return monomials[term_indices].T@self.coefficients[used]
+
+	def _check_compatible(self, other: "TransferMap") -> None:
+		if other.algebra is not self.algebra:
+			raise ValueError(f"can't combine a map of order {self.order} in {self.num_variables} variables "
+			                 f"with one of order {other.order} in {other.num_variables} variables")
+
+	@classmethod
+	def translation(cls, offsets: Sequence[float], order: int, num_variables: int = NUM_COORDINATES) -> "TransferMap":
+		""" the map that adds a constant to each coordinate """
+		result = cls.identity(order, num_variables)
+		result.coefficients[0, :len(offsets)] += offsets
+		return result
+
+	@classmethod
+	def shift(cls, dx: float, dy: float, order: int, num_variables: int = NUM_COORDINATES) -> "TransferMap":
+		""" the map that moves every ray sideways by (dx, dy) meters """
+		return cls.translation([dx, 0, dy], order, num_variables)
+
+	@classmethod
+	def kick(cls, da: float, db: float, order: int, num_variables: int = NUM_COORDINATES) -> "TransferMap":
+		""" a small change in angle, which is how a small TA tilt acts to first order
+			:param da: the change in the x slope (rad, not degrees like TA takes)
+			:param db: the change in the y slope (rad)
+		"""
+		return cls.translation([0, da, 0, db], order, num_variables)
+
+	def misaligned(self, dx: float = 0., dy: float = 0., tilt_x: float = 0., tilt_y: float = 0.) -> "TransferMap":
+		""" this map as an element that's been shifted and tilted, sandwiched the same way the tolerance script
+			does it (SA -dx -dy; TA -tilt_x -tilt_y; element; TA tilt_x tilt_y; SA dx dy), taking the tilts to be small
+			:param dx: the horizontal shift (m), like SA takes
+			:param dy: the vertical shift (m)
+			:param tilt_x: the tilt in the x direction (degrees), like TA takes, so the script's values can go right in
+			:param tilt_y: the tilt in the y direction (degrees)
+		"""
+		da, db = radians(tilt_x), radians(tilt_y)
+		before = TransferMap.kick(-da, -db, self.order, self.num_variables).compose(
+			TransferMap.shift(-dx, -dy, self.order, self.num_variables))
+		after = TransferMap.shift(dx, dy, self.order, self.num_variables).compose(
+			TransferMap.kick(da, db, self.order, self.num_variables))
+		return after.compose(self.compose(before))
+
+	@classmethod
+	def drift(cls, length: float, order: int, num_variables: int = NUM_COORDINATES,
+	          kinetic_energy: float = E0, mass: float = m0) -> "TransferMap":
+		""" a field-free drift, with the exact (not paraxial) dependence on the angles and energy
+			:param length: the length of the drift in meters (it can be negative, to back up)
+			:param kinetic_energy: the reference particle's kinetic energy in MeV
+			:param mass: the reference particle's mass in Da
+		"""
+		algebra = get_algebra(order, num_variables)
+		a, b, d = algebra.variable(1), algebra.variable(3), algebra.variable(5)
+		one = algebra.constant(1)
+		rest_energy = mass*AMUMEV
+		gamma = 1 + kinetic_energy/rest_energy
+		energy_ratio = one + kinetic_energy/(kinetic_energy + rest_energy)*d  # total energy over the reference's
+		momentum_squared = algebra.multiply(one + d, one + kinetic_energy/(kinetic_energy + 2*rest_energy)*d)  # (p/p0)²
+		longitudinal = algebra.power(momentum_squared - algebra.multiply(a, a) - algebra.multiply(b, b), -0.5)  # p0/pz
+		result = cls.identity(order, num_variables)
+		result.coefficients[:, 0] += length*algebra.multiply(a, longitudinal)
+		result.coefficients[:, 2] += length*algebra.multiply(b, longitudinal)
+		result.coefficients[:, 4] -= length*gamma/(1 + gamma)*(algebra.multiply(energy_ratio, longitudinal) - one)
+		return result
+
+
+def exact_drift(rays: NDArray[float], length: float, kinetic_energy: float = E0, mass: float = m0) -> NDArray[float]:
+	""" push rays (in COSY's units) thru a drift directly, for checking TransferMap.drift """
+	rest_energy = mass*AMUMEV
+	gamma = 1 + kinetic_energy/rest_energy
+	x, a, y, b, l, d = rays[:, :6].T
+	momentum_squared = (1 + d)*(1 + kinetic_energy/(kinetic_energy + 2*rest_energy)*d)
+	longitudinal = 1/np.sqrt(momentum_squared - a**2 - b**2)
+	energy_ratio = 1 + kinetic_energy/(kinetic_energy + rest_energy)*d
+	final = rays.copy()
+	final[:, 0] += length*a*longitudinal
+	final[:, 2] += length*b*longitudinal
+	final[:, 4] -= length*gamma/(1 + gamma)*(energy_ratio*longitudinal - 1)
+	return final
+
+
+def move_detector(matrix: COSY_Matrix, distance: float) -> COSY_Matrix:
+	""" see what the map would be if the detector were moved downstream by some distance (in meters) """
+	transfer_map = TransferMap.from_matrix(matrix)
+	return TransferMap.drift(distance, transfer_map.order, transfer_map.num_variables).compose(transfer_map).to_matrix()
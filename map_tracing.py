@@ -0,0 +1,198 @@
+import sys
+from math import atan, cos, pi, sin, sqrt, tan
+from typing import Dict, Sequence, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+from cosy_output import CosyResult, parse_cosy_output
+from visualize import COSY_Matrix
+
+# the constants and default geometry from MRSt_OMEGA.fox
+E0 = 12.45  # MeV
+m0 = 2.013553213  # Da
+SPECTRAL_RANGE = 3.56  # MeV
+AMUMEV = 931.49410242  # MeV/Da
+CLIGHT = 299792458.  # m/s
+GEOMETRY = {
+	"foil_x_radius": 0.00025,  # m
+	"foil_y_radius": 0.00050,  # m
+	"aperture_half_width": 0.001,  # m
+	"aperture_half_height": 0.003,  # m
+	"S0": 2.00,  # foil-to-aperture distance (m)
+}
+
+
+def matrix_element(matrix: COSY_Matrix, i: int, j: int) -> float:
+	""" the equivalent of COSY's ME(i,j): the coefficient of output i in the term whose coordinates are the
+		digits of j, so matrix_element(matrix, 1, 26) is (x|ad).  it's 0 if the map doesn't have that term.
+	"""
+	exponents = np.zeros(matrix.exponents.shape[1], dtype=int)
+	for digit in str(j):
+		exponents[int(digit) - 1] += 1
+	matches = np.nonzero(np.all(matrix.exponents == exponents, axis=1))[0]
+	if matches.size > 0:
+		return matrix.cosy_coefficients[matches[0], i - 1]
+	else:
+		return 0.
+
+
+def define_rays(d_energy: Union[float, Sequence[float]] = 0., ray_multitude: int = 2,
+                foil_x_radius: float = GEOMETRY["foil_x_radius"], foil_y_radius: float = GEOMETRY["foil_y_radius"],
+                aperture_half_width: float = GEOMETRY["aperture_half_width"],
+                aperture_half_height: float = GEOMETRY["aperture_half_height"], S0: float = GEOMETRY["S0"]
+                ) -> NDArray[float]:
+	""" lay out the same rays as the define_rays procedure: a ring of points on the foil aimed at a grid of points
+		on the aperture.  if several energies are given, you get the whole set at each one, one energy after another.
+		returns: an (n_rays × 6) array of initial coordinates in COSY's units (x, a, y, b, l, d)
+	"""
+	points = []  # (x_foil, x_aperture, y_foil, y_aperture)
+	if ray_multitude == 0:
+		points.append((0, 0, 0, 0))
+	elif ray_multitude == 1 or ray_multitude == 2:
+		num_foil_points = 4 if ray_multitude == 1 else 8
+		for I in [-1, 0, 1]:
+			for J in [-1, 0, 1]:
+				if ray_multitude == 1 and abs(I + J) == 1:
+					continue
+				points.append((0, I*aperture_half_width, 0, J*aperture_half_height))
+				for K in range(num_foil_points):
+					angle = K/(num_foil_points/2)*pi
+					points.append((foil_x_radius*cos(angle), I*aperture_half_width,
+					               foil_y_radius*sin(angle), J*aperture_half_height))
+	else:
+		raise ValueError(f"there's no ray multitude {ray_multitude}")
+	x_foil, x_aperture, y_foil, y_aperture = np.array(points, dtype=float).T
+	rays = np.stack([x_foil, (x_aperture - x_foil)/S0, y_foil, (y_aperture - y_foil)/S0,
+	                 np.zeros(x_foil.size), np.zeros(x_foil.size)], axis=1)
+	d_energy = np.atleast_1d(np.asarray(d_energy, dtype=float))
+	rays = np.tile(rays, (d_energy.size, 1))
+	rays[:, 5] = np.repeat(d_energy, x_foil.size)
+	return rays
+
+
+def reference_gamma() -> float:
+	""" the Lorentz factor of the reference particle, which is what the .fox file calls gamma """
+	return 1 + E0/(m0*AMUMEV)
+
+
+def calculate_velocity(d_energy: NDArray[float]) -> NDArray[float]:
+	""" the speed in m/s corresponding to a given fractional energy deviation """
+	energy = E0*(1 + np.asarray(d_energy))
+	return np.sqrt(1 - 1/(1 + energy/(m0*AMUMEV))**2)*CLIGHT
+
+
+def trace_rays(matrix: COSY_Matrix, rays: NDArray[float], fp_tilt: float = 0.) -> NDArray[float]:
+	""" push some rays thru the map and apply the correction that READ_RAY makes to the time-of-flight
+		coordinate for the tilt of the detector plane
+		:param rays: an (n_rays × 6) array of initial coordinates in COSY's units
+		:param fp_tilt: the focal plane tilt in radians
+		returns: an (n_rays × 6) array of final coordinates in COSY's units (the energy just gets copied over)
+	"""
+	final = np.empty((rays.shape[0], 6))
+	final[:, :5] = matrix.evaluate_cosy(rays, "xaybl")
+	final[:, 5] = rays[:, 5]
+	gamma = reference_gamma()
+	tilt_time = final[:, 0]*tan(fp_tilt)/calculate_velocity(rays[:, 5])
+	final[:, 4] += tilt_time*calculate_velocity(0)*gamma/(1 + gamma)
+	return final
+
+
+def map_design(matrix: COSY_Matrix) -> Dict[str, float]:
+	""" calculate the observables that come straight from the map elements, the same way main does """
+	ME = lambda i, j: matrix_element(matrix, i, j)
+	gamma = reference_gamma()
+	v0 = calculate_velocity(0)
+
+	fp_tilt = atan(-ME(1, 26)/ME(2, 2)/ME(1, 6))
+	plane_length = SPECTRAL_RANGE/E0*ME(1, 6)/cos(fp_tilt)
+	numerator = (ME(1, 6)**2 + ME(1, 1)**2*ME(1, 26)**2)**1.5
+	denominator = ME(1, 1)*(ME(1, 6)*ME(1, 266) - ME(1, 26)*(ME(1, 66) + 2*ME(1, 6)*ME(1, 1)*ME(2, 26)))
+	curvature_radius = numerator/denominator if denominator != 0 else np.inf
+	p_dist = 1000*0.5*plane_length
+	if abs(curvature_radius) > abs(plane_length):
+		p_dist = 1000*(abs(curvature_radius) - sqrt(curvature_radius**2 - 0.25*plane_length**2))
+	if curvature_radius < 0:
+		p_dist = -p_dist
+
+	observables = {
+		"FPDESIGN Tilt Angle(deg)": fp_tilt*180/pi,
+		"FPDESIGN Curv.Radius(m)": curvature_radius,
+		"FPDESIGN p-dist(mm)": p_dist,
+		"FPDESIGN Plane Length(m)": plane_length,
+		"Dispersion (mm/keV)": ME(1, 6)/(E0*cos(fp_tilt)),
+		"Time skew (ps/keV)": (ME(5, 6)*(1 + gamma)/gamma - ME(1, 6)*tan(fp_tilt))*1e12/v0/(E0*1e3),
+	}
+	return {key: float(value) for key, value in observables.items()}
+
+
+def ray_widths(matrix: COSY_Matrix, final_rays: NDArray[float]) -> Dict[str, NDArray[float]]:
+	""" calculate the observables that come from the spread of the traced rays.
+		:param final_rays: a (... × n_rays × 6) array of traced rays, where each set along the second-to-last
+		                   axis gets its own widths
+	"""
+	gamma = reference_gamma()
+	widths = np.max(final_rays, axis=-2) - np.min(final_rays, axis=-2)
+	return {
+		"FPDESIGN HO Resol.RAY(keV)": widths[..., 0]*E0*1000/abs(matrix_element(matrix, 1, 6)),
+		"FPDESIGN Time Resol.(ps)": widths[..., 4]*1e12*(1 + gamma)/(calculate_velocity(0)*gamma),
+		"FPDESIGN y-Size(mm)": widths[..., 2]*1000,
+	}
+
+
+def focal_plane_design(matrix: COSY_Matrix, **geometry: float) -> Dict[str, float]:
+	""" calculate everything in the FPDESIGN block, plus the dispersion and time skew, from a map alone.
+		the keys match CosyResult.observables.
+		:param geometry: any of the entries of GEOMETRY to change
+	"""
+	observables = map_design(matrix)
+	rays = define_rays(0., 2, **{**GEOMETRY, **geometry})
+	final_rays = trace_rays(matrix, rays, observables["FPDESIGN Tilt Angle(deg)"]*pi/180)
+	observables.update({key: float(value) for key, value in ray_widths(matrix, final_rays).items()})
+	return observables
+
+
+def scan_geometry(matrix: COSY_Matrix, name: str, values: Sequence[float], **geometry: float
+                  ) -> Dict[str, NDArray[float]]:
+	""" see how the ray-based observables change as one part of the geometry (the foil size, aperture size,
+		or foil distance) varies, tracing the rays for every value in one go.
+		returns: each of the observables in focal_plane_design as an array with one value per scan value
+	"""
+	if name not in GEOMETRY:
+		raise ValueError(f"'{name}' isn't one of the geometry parameters: {list(GEOMETRY)}")
+	fixed = map_design(matrix)
+	rays = np.stack([define_rays(0., 2, **{**GEOMETRY, **geometry, name: value}) for value in values])
+	final_rays = trace_rays(matrix, rays.reshape((-1, 6)), fixed["FPDESIGN Tilt Angle(deg)"]*pi/180)
+	observables = {key: np.full(len(values), value) for key, value in fixed.items()}
+	observables.update(ray_widths(matrix, final_rays.reshape(rays.shape)))
+	return observables
+
+
+def scan_detector_position(matrix: COSY_Matrix, distances: Sequence[float], **geometry: float
+                           ) -> Dict[str, NDArray[float]]:
+	""" see how the observables change as the detector moves downstream (or upstream, for negative distances)
+		from where the map ends, by tacking a drift onto the map for each distance
+		returns: each of the observables in focal_plane_design as an array with one value per distance
+	"""
+	from map_algebra import move_detector
+	designs = [focal_plane_design(move_detector(matrix, distance), **geometry) for distance in distances]
+	return {key: np.array([design[key] for design in designs]) for key in designs[0]}
+
+
+def compare_to_cosy(result: CosyResult, **geometry: float) -> Dict[str, Tuple[float, float]]:
+	""" recalculate the observables from the map that COSY printed and line them up with what COSY reported.
+		returns: a dict of (COSY's value, the value from the map) for each observable COSY reported
+	"""
+	matrix = COSY_Matrix.from_result(result)
+	from_map = focal_plane_design(matrix, **geometry)
+	reported = result.observables
+	return {key: (reported[key], value) for key, value in from_map.items() if key in reported}
+
+
+if __name__ == "__main__":
+	# compare against a full (non-streamlined) MRSt_OMEGA run, saved from COSY's stdout
+	with open(sys.argv[1], "r") as file:
+		comparison = compare_to_cosy(parse_cosy_output(file.read()))
+	print(f"{'':28s} {'COSY':>14s} {'map':>14s}")
+	for key, (reported, from_map) in comparison.items():
+		print(f"{key:28s} {reported:14.5f} {from_map:14.5f}")
@@ -0,0 +1,158 @@
+import argparse
+import time
+from math import cos, pi, sin
+from typing import Callable, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+MU0 = 1.25663706212e-6  # N/A^2
+CHUNK_SIZE = 2**16  # how many point-wire pairs to do at a time (16 B each, so the temporary arrays stay in cache)
+MULTIPOLE_NAMES = ["dipole", "quadrupole", "hexapole", "octupole", "decapole", "duodecapole"]
+
+
+def wire_sum(x: NDArray[float], y: NDArray[float], wire_x: NDArray[float], wire_y: NDArray[float],
+             weights: NDArray[float], kernel: Callable[[NDArray[complex]], NDArray], chunk_size: int = CHUNK_SIZE
+             ) -> NDArray:
+	""" add up some function of the offset from each of a bunch of wires, at each of a bunch of points.  the
+		points and wires get broadcast against each other a block at a time, so it never needs more than about
+		chunk_size of them in memory at once, and each block is summed with a matrix-vector product.
+		:param x: the x of each point, in any shape
+		:param y: the y of each point, in the same shape
+		:param wire_x: the x of each wire
+		:param wire_y: the y of each wire
+		:param weights: how much each wire counts (like its current)
+		:param kernel: the function of each offset (x - wire_x) + i(y - wire_y), which has to work elementwise on arrays
+		returns: the weighted sum at each point, in the same shape as x
+	"""
+	points = (np.asarray(x, dtype=float) + 1j*np.asarray(y, dtype=float)).ravel()
+	wires = np.asarray(wire_x, dtype=float).ravel() + 1j*np.asarray(wire_y, dtype=float).ravel()
+	weights = np.asarray(weights, dtype=float).ravel()
+	num_wires = min(wires.size, chunk_size)
+	num_points = max(1, chunk_size//num_wires)
+	total = None
+	for start in range(0, points.size, num_points):
+		chunk = points[start:start + num_points]
+		for wire_start in range(0, wires.size, num_wires):
+			values = kernel(chunk[:, np.newaxis] - wires[np.newaxis, wire_start:wire_start + num_wires])
+			if total is None:
+				total = np.zeros(points.size, dtype=np.result_type(values, weights))
+			total[start:start + chunk.size] += values@weights[wire_start:wire_start + num_wires]
+	if total is None:
+		total = np.zeros(points.size)
+	return total.reshape(np.shape(x))
+
+
+def field(x: NDArray[float], y: NDArray[float], wire_x: NDArray[float], wire_y: NDArray[float],
+          currents: NDArray[float], chunk_size: int = CHUNK_SIZE) -> Tuple[NDArray[float], NDArray[float]]:
+	""" the magnetic field of a bunch of long straight wires running along z.  each one adds μ0I/2π(z - w) to
+		By + iBx, where z = x + iy and w is where the wire is.
+		:param currents: the current in each wire (A), positive going in the +z direction
+		returns: Bx and By (T) at each point
+	"""
+	B = MU0/(2*pi)*wire_sum(x, y, wire_x, wire_y, currents, np.reciprocal, chunk_size)
+	return B.imag, B.real
+
+
+def field_gradient(x: NDArray[float], y: NDArray[float], wire_x: NDArray[float], wire_y: NDArray[float],
+                   currents: NDArray[float], chunk_size: int = CHUNK_SIZE) -> Tuple[NDArray[float], NDArray[float]]:
+	""" the derivatives of the field of a bunch of wires.  away from the wires the field has no divergence or
+		curl, so these two are all there is: ∂Bx/∂y = ∂By/∂x and ∂By/∂y = -∂Bx/∂x.
+		returns: ∂By/∂x (the quadrupole gradient) and ∂Bx/∂x (T/m) at each point
+	"""
+	gradient = -MU0/(2*pi)*wire_sum(x, y, wire_x, wire_y, currents, lambda offset: offset**-2, chunk_size)
+	return gradient.real, gradient.imag
+
+
+def multipole_coefficients(wire_x: NDArray[float], wire_y: NDArray[float], currents: NDArray[float],
+                           reference_radius: float, max_order: int = len(MULTIPOLE_NAMES)) -> NDArray[complex]:
+	""" expand the field of a bunch of wires in multipoles, so that By + iBx = Σ C_n (z/r)^(n-1) anywhere
+		inside the nearest wire.  each wire at w adds C_n = -μ0I/2π r^(n-1)/w^n.  the real part of each C_n is
+		the normal component, which is the pole-tip field that M5 takes for a given aperture radius (for n = 2
+		thru 6), and the imaginary part is the skew component.
+		:param reference_radius: the radius r at which to give the fields (m), like the last argument of M5
+		:param max_order: the highest n (2 is a quadrupole, 3 a hexapole, and so on)
+		returns: C_1 thru C_max_order (T)
+	"""
+	wires = np.asarray(wire_x, dtype=float).ravel() + 1j*np.asarray(wire_y, dtype=float).ravel()
+	if np.any(np.abs(wires) <= reference_radius):
+		raise ValueError(f"there's a wire within {reference_radius} m of the axis, so the expansion doesn't converge there")
+	n = np.arange(1, max_order + 1)
+	return -MU0/(2*pi)*np.sum(np.asarray(currents, dtype=float).ravel()[:, np.newaxis]*reference_radius**(n - 1)/
+	                          wires[:, np.newaxis]**n, axis=0)
+
+
+def measure_multipoles(field_function: Callable[[NDArray[float], NDArray[float]], Tuple[NDArray[float], NDArray[float]]],
+                       reference_radius: float, max_order: int = len(MULTIPOLE_NAMES), num_points: int = 256
+                       ) -> NDArray[complex]:
+	""" get the same coefficients as multipole_coefficients, but from any field at all (like one from a field
+		map or a finite element model), by sampling it around a circle and taking the Fourier transform
+		:param field_function: a function that takes arrays of x and y and gives Bx and By
+		:param num_points: how many points to put around the circle; it has to be more than max_order
+		returns: C_1 thru C_max_order (T)
+	"""
+	angles = np.linspace(0, 2*pi, num_points, endpoint=False)
+	Bx, By = field_function(reference_radius*np.cos(angles), reference_radius*np.sin(angles))
+	return np.fft.fft(By + 1j*Bx)[:max_order]/num_points
+
+
+def wire_layout(poles: int, radius: float, width: float, num_wires: int, wire_spacing: float, current: float = 1.
+                ) -> Tuple[NDArray[float], NDArray[float], NDArray[float]]:
+	""" lay out the wires of a multipole magnet like the ones in make_explanatory_figure: a pole face at each
+		of some evenly spaced angles, with a row of wires going out radially along either edge of it, carrying
+		opposite currents, and the currents switching direction from each pole to the next.
+		:param poles: the number of poles (4 for a quadrupole, 6 for a hexapole, and so on)
+		:param radius: the distance from the axis to each pole face (m)
+		:param width: the width of each pole face (m)
+		:param num_wires: the number of wires along each edge
+		:param wire_spacing: the distance between wires (m)
+		:param current: the current in each wire (A)
+		returns: the x and y of each wire (m) and its current (A)
+	"""
+	wire_x, wire_y, currents = [], [], []
+	for j in range(poles):
+		angle = (j + 0.5)*2*pi/poles
+		sine = j%2*2 - 1
+		for side in [-1, 1]:
+			x = radius + (np.arange(num_wires) + 0.5)*wire_spacing
+			y = np.full(num_wires, sine*side*width/2)
+			wire_x.append(cos(angle)*x - sin(angle)*y)
+			wire_y.append(sin(angle)*x + cos(angle)*y)
+			currents.append(np.full(num_wires, side*current))
+	return np.concatenate(wire_x), np.concatenate(wire_y), np.concatenate(currents)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="check the wire sums against the multipole expansion for the magnets in the explanatory figure, "
+		            "and time them on a big grid")
+	parser.add_argument("--resolution", type=int, default=1001, help="how many grid points to put along each side")
+	parser.add_argument("--wires", type=int, default=50, help="how many wires to put along each edge of each pole")
+	args = parser.parse_args()
+
+	radius, spacing = 0.03, 0.001  # m
+	for poles in [4, 6, 8]:
+		width = min(6/poles, 2)*radius
+		wire_x, wire_y, currents = wire_layout(poles, radius, width, args.wires, spacing, 100)
+		reference_radius = 0.9*np.min(np.hypot(wire_x, wire_y))
+		coefficients = multipole_coefficients(wire_x, wire_y, currents, reference_radius, 12)
+		measured = measure_multipoles(lambda x, y: field(x, y, wire_x, wire_y, currents), reference_radius, 12)
+		print(f"{poles} poles, {currents.size} wires, reference radius {reference_radius*1e3:.1f} mm:")
+		for n in range(1, 13):
+			name = MULTIPOLE_NAMES[n - 1] if n <= len(MULTIPOLE_NAMES) else f"{2*n}-pole"
+			print(f"    {name:12s} {coefficients[n - 1].real:11.3e} {coefficients[n - 1].imag:11.3e} T "
+			      f"(measured {measured[n - 1].real:11.3e} {measured[n - 1].imag:11.3e} T)")
+
+		half_width = reference_radius/2
+		X, Y = np.meshgrid(np.linspace(-half_width, half_width, args.resolution),
+		                   np.linspace(-half_width, half_width, args.resolution), indexing="ij")
+		start = time.perf_counter()
+		Bx, By = field(X, Y, wire_x, wire_y, currents)
+		gradient, _ = field_gradient(X, Y, wire_x, wire_y, currents)
+		elapsed = time.perf_counter() - start
+		z = (X + 1j*Y)/reference_radius
+		series = np.polynomial.polynomial.polyval(z, multipole_coefficients(wire_x, wire_y, currents, reference_radius, 60))
+		error = np.max(np.abs(By + 1j*Bx - series))/np.max(np.abs(series))
+		print(f"    the field and gradient on a {args.resolution}×{args.resolution} grid took {elapsed:.1f} s; "
+		      f"it's within {error:.1e} of the multipole series, and the gradient at the center is "
+		      f"{gradient[args.resolution//2, args.resolution//2]:.4g} T/m")
@@ -1,55 +1,338 @@
-import pickle
-import re
-import subprocess
-from math import sqrt, inf, exp
-from typing import Tuple, List, Union
+import os
+from collections import Counter
+from math import inf, ceil
+from typing import Dict, Tuple, List, Union
 
 import numpy as np
 from numpy.typing import NDArray
-from scipy import optimize
+from scipy import optimize, stats
 
+from cosy_batch import BatchingPool, BatchTemplate
+from cosy_output import CosyResult
+from cosy_pool import CosyPool
+from evaluation_store import LEGACY_SCRIPT_HASH, EvaluationStore, hash_script, make_key, import_pickle_cache
+from fox_template import FoxTemplate
+import instrumentation
+from pareto import ParetoArchive
+from surrogate import GaussianProcess
 
 FILE_TO_OPTIMIZE = "MRSt_OMEGA"
 # ORDER = 2
 # PARAMETER_NAMES = ["Q2", "H2", "S1", "angle", "u1", "u2", "c1", "c2"]
 ORDER = 3
 PARAMETER_NAMES = ["Q2", "H2", "S1", "S2", "angle", "u1", "u2", "c1", "c2"]
+COSY_EXECUTABLE = "C:/Program Files/COSY 10.0/cosy.exe"
+NUM_WORKERS = os.cpu_count()
+BATCH_SIZE = 1  # how many parameter sets to evaluate in each COSY run (more than 1 saves on start-up; see cosy_batch)
+OPTIMIZER = "Nelder-Mead"  # or "differential-evolution" to evaluate a whole population per round
+POPULATION_SIZE = 4  # differential evolution's population size, as a multiple of the number of parameters
+FIDELITY_ORDERS = [1, 2, ORDER]  # the orders at which the multi-fidelity search screens candidates, cheapest first
+NUM_CANDIDATES = 27  # how many candidates the multi-fidelity search screens in each round
+SURROGATE_BUDGET = 200  # how many COSY runs the surrogate-assisted search may spend
+OBJECTIVE_OBSERVABLES = ["Time skew (ps/keV)", "FPDESIGN Time Resol.(ps)",
+                         "FPDESIGN HO Resol.RAY(keV)", "FPDESIGN Tilt Angle(deg)"]
+TIMEOUT = 600  # how long a COSY run can go before it's killed and counted as a failure, in seconds
+MEMORY_LIMIT = 4*2**30  # how much memory a COSY run can use before it's counted as a failure, in bytes
+FAILURE_COST = 1e6  # the cost of a design that COSY can't evaluate
+COST_WEIGHTS = (150, 300, 5)  # the scales of the time resolution, energy width, and tilt terms in the cost
+OBJECTIVE_NAMES = ["time resolution (ps)", "energy width (keV)", "tilt (deg)"]  # what the Pareto archive keeps apart
+PARETO_GENERATIONS = 20  # how many generations the multi-objective search runs for
 
 
 with open(f'{FILE_TO_OPTIMIZE}.fox', 'r') as f:
 	script = f.read()
+template = FoxTemplate(script, PARAMETER_NAMES + ["order", "streamlined_mode"])
+batch_template = BatchTemplate(template)
+script_hash = hash_script(script)
 
-try:
-	with open(f"{FILE_TO_OPTIMIZE}_cache.pkl", "rb") as file:
-		cache = pickle.load(file)
-except FileNotFoundError:
-	cache = {}
+store = EvaluationStore(f"{FILE_TO_OPTIMIZE}_cache.sqlite")
 
+pool = CosyPool(COSY_EXECUTABLE, NUM_WORKERS, timeout=TIMEOUT, memory_limit=MEMORY_LIMIT,
+                required_observables=OBJECTIVE_OBSERVABLES + ["FPDESIGN Plane Length(m)"])  # the last FPDESIGN line
 
-def optimize_design():
-	""" optimize a COSY file by tweaking the given parameters to minimize the defined objective function """
+runs_per_order = Counter()  # how many times we've actually called COSY at each order
+archive: ParetoArchive = None  # every full-order evaluation, by objective (see get_archive)
+
+
+def optimize_design(method: str = OPTIMIZER):
+	""" optimize a COSY file by tweaking the given parameters to minimize the defined objective function
+		:param method: either "Nelder-Mead", which goes one COSY run at a time,
+		               "differential-evolution", which sends a whole generation to COSY at once, or
+		               "multi-fidelity", which screens candidates at low order before running them at full order, or
+		               "surrogate", which only runs COSY where a Gaussian-process model of the cache says it's worth it, or
+		               "pareto", which fills in the trade-off between the objectives instead of minimizing the cost
+	"""
 	defaults, bounds = get_defaults()
-	initial_simplex = simplexify(defaults, bounds)
-	result = optimize.minimize(
-		objective_function,
-		defaults,
+	if method == "Nelder-Mead":
+		initial_simplex = simplexify(defaults, bounds)
+		result = optimize.minimize(
+			objective_function,
+			defaults,
+			bounds=bounds,
+			method='Nelder-Mead',
+			options=dict(initial_simplex=initial_simplex)
+			)
+	elif method == "differential-evolution":
+		result = evolve_design(defaults, bounds)
+	elif method == "multi-fidelity":
+		result = multi_fidelity_search(defaults, bounds)
+	elif method == "surrogate":
+		result = surrogate_search(defaults, bounds)
+	elif method == "pareto":
+		result = pareto_search(defaults, bounds)
+	else:
+		raise ValueError(f"I don’t know the optimization method '{method}'.")
+	print(result)
+
+
+def evolve_design(x0: NDArray[float], bounds: List[Tuple[float, float]]) -> optimize.OptimizeResult:
+	""" minimize the objective function with differential evolution, evaluating each generation as
+		one parallel batch.  the population is saved after every generation, so if the run gets
+		interrupted, calling this again picks up where it left off.
+	"""
+	checkpoint_file = f"{FILE_TO_OPTIMIZE}_checkpoint.npz"
+	try:
+		checkpoint = np.load(checkpoint_file)
+		initial_population = checkpoint["population"]
+		print(f"resuming from generation {checkpoint['generation']} of the last run")
+	except FileNotFoundError:
+		checkpoint = None
+		initial_population = "latinhypercube"
+	generation = 0 if checkpoint is None else int(checkpoint["generation"])
+
+	def save_checkpoint(intermediate_result: optimize.OptimizeResult) -> None:
+		nonlocal generation
+		generation += 1
+		np.savez(checkpoint_file,
+		         population=intermediate_result.population,
+		         population_energies=intermediate_result.population_energies,
+		         generation=generation)
+
+	result = optimize.differential_evolution(
+		lambda population: objective_function_batch(population.T),
 		bounds=bounds,
-		method='Nelder-Mead',
-		options=dict(initial_simplex=initial_simplex)
+		x0=x0 if checkpoint is None else None,
+		popsize=POPULATION_SIZE,
+		init=initial_population,
+		callback=save_checkpoint,
+		vectorized=True,
+		updating="deferred",
+		polish=False,
 		)
-	print(result)
+	if result.success:  # once it's converged there's nothing to resume
+		os.remove(checkpoint_file)
+	return result
+
+
+def multi_fidelity_search(x0: NDArray[float], bounds: List[Tuple[float, float]],
+                          num_rounds: int = 30) -> optimize.OptimizeResult:
+	""" minimize the objective function with a random local search that screens its candidates
+		with successive halving: every round, a batch of candidates around the current best design
+		gets run at the lowest order in FIDELITY_ORDERS, the best third of those get run at the next
+		order, and so on, so only the most promising few ever pay for a full-order map.  the number
+		of COSY runs spent at each order is reported every time a design is accepted.
+	"""
+	lower = np.array([low for low, high in bounds])
+	upper = np.array([high for low, high in bounds])
+	rng = np.random.default_rng(0)
+	best_x = np.array(x0, dtype=float)
+	best_cost = objective_function(best_x)
+	spread = 1/4  # how far to look around the current best, as a fraction of the bounds
+	runs_at_last_acceptance = runs_per_order.copy()
+	for i in range(num_rounds):
+		candidates = best_x + rng.uniform(-spread, spread, (NUM_CANDIDATES, best_x.size))*(upper - lower)
+		candidates = np.clip(candidates, lower, upper)
+		for order in FIDELITY_ORDERS[:-1]:
+			costs = objective_function_batch(candidates, order)
+			candidates = candidates[np.argsort(costs)[:ceil(len(candidates)/3)]]
+		costs = objective_function_batch(candidates, FIDELITY_ORDERS[-1])
+		if np.min(costs) < best_cost:
+			best_x, best_cost = candidates[np.argmin(costs)], np.min(costs)
+			runs_spent = runs_per_order - runs_at_last_acceptance
+			runs_at_last_acceptance = runs_per_order.copy()
+			print(f"accepted a design with cost {best_cost:.2f}ps after " +
+			      ", ".join(f"{runs_spent[order]} runs at order {order}" for order in FIDELITY_ORDERS))
+		else:
+			spread /= 2
+	print("in total, " + ", ".join(f"{runs_per_order[order]} runs at order {order}" for order in FIDELITY_ORDERS))
+	return optimize.OptimizeResult(x=best_x, fun=best_cost, nit=num_rounds,
+	                               nfev=sum(runs_per_order.values()), runs_per_order=dict(runs_per_order))
 
 
-def objective_function(parameters: List[float]) -> float:
+def surrogate_search(x0: NDArray[float], bounds: List[Tuple[float, float]],
+                     budget: int = SURROGATE_BUDGET, batch_size: int = NUM_WORKERS,
+                     warm_start: str = None) -> optimize.OptimizeResult:
+	""" minimize the objective function using Gaussian-process models of the four observables that
+		go into it, fit to everything already in the store.  each round, the candidates with the highest
+		expected improvement (within the bounds) get sent to COSY as one batch, and the models are refit.
+		:param budget: the maximum number of new COSY runs to do
+		:param batch_size: the number of COSY runs to do in each round
+		:param warm_start: an old-style _cache.pkl file from which to load additional training points.  there's
+		                   no telling what version of the script those came from, so they only ever go into the
+		                   model, along with anything else imported from old caches; they never count as results.
+	"""
+	script_hashes = [script_hash]
+	if warm_start is not None:
+		import_pickle_cache(store, warm_start, ORDER)
+		script_hashes.append(LEGACY_SCRIPT_HASH)
+	lower = np.array([low for low, high in bounds])
+	upper = np.array([high for low, high in bounds])
+	rng = np.random.default_rng(0)
+
+	# load everything we already know
+	X, Y = [], []
+	for hash_ in script_hashes:
+		for parameters, observables in store.evaluations(hash_, ORDER):
+			if len(parameters) == len(x0) and all(np.isfinite(observables.get(name, inf)) for name in OBJECTIVE_OBSERVABLES):
+				X.append(parameters)
+				Y.append([observables[name] for name in OBJECTIVE_OBSERVABLES])
+	print(f"starting the surrogate model with {len(X)} cached evaluations")
+	if len(X) < 2*len(x0) + 1:  # if there's not much, seed it with a Latin hypercube around the initial guess
+		seeds = stats.qmc.LatinHypercube(d=len(x0), seed=rng).random(2*len(x0))
+		new_X = [x0] + list(lower + seeds*(upper - lower))
+	else:
+		new_X = []
+
+	runs_at_start = runs_per_order[ORDER]
+	while True:
+		if len(new_X) > 0:
+			for parameters, result in zip(new_X, evaluate_batch(new_X)):
+				observables = result.observables
+				calculate_cost(parameters, observables)
+				if not result.failed and all(np.isfinite(observables.get(name, inf)) for name in OBJECTIVE_OBSERVABLES):
+					X.append(parameters)
+					Y.append([observables[name] for name in OBJECTIVE_OBSERVABLES])
+		if len(X) == 0:
+			# every design so far has failed, so there's nothing to fit the models to; try some more random ones
+			if runs_per_order[ORDER] - runs_at_start + batch_size > budget:
+				raise ValueError(f"COSY failed on all {runs_per_order[ORDER] - runs_at_start} designs it ran, "
+				                 f"so I can't fit a surrogate model")
+			seeds = stats.qmc.LatinHypercube(d=len(x0), seed=rng).random(batch_size)
+			new_X = list(lower + seeds*(upper - lower))
+			continue
+		if runs_per_order[ORDER] - runs_at_start + batch_size > budget:
+			break
+		X_array, Y_array = np.array(X, dtype=float), np.array(Y)
+		costs = cost_from_observables(*Y_array.T)[1]
+		best_cost = np.min(costs)
+
+		# fit the models and look for the candidates with the highest expected improvement
+		models = [GaussianProcess(bounds).fit(X_array, Y_array[:, k]) for k in range(len(OBJECTIVE_OBSERVABLES))]
+		best_known = X_array[np.argsort(costs)[:5]]
+		candidates = np.concatenate([
+			lower + rng.random((2000, len(x0)))*(upper - lower),
+			best_known[rng.integers(len(best_known), size=2000)] + rng.normal(0, .02, (2000, len(x0)))*(upper - lower),
+		])
+		candidates = np.clip(candidates, lower, upper)
+		predictions = [model.predict(candidates) for model in models]
+		samples = [mean + std*rng.standard_normal((64, 1)) for mean, std in predictions]  # (samples, candidates)
+		improvement = np.maximum(best_cost - cost_from_observables(*samples)[1], 0)
+		expected_improvement = np.mean(improvement, axis=0)
+
+		# pick the best few, making sure they're not all right on top of each other
+		new_X = []
+		for i in np.argsort(-expected_improvement):
+			distances = np.max(np.abs(np.array(new_X + X) - candidates[i])/(upper - lower), axis=1)
+			if np.min(distances) > 1e-3:
+				new_X.append(candidates[i])
+			if len(new_X) >= batch_size:
+				break
+
+	costs = cost_from_observables(*np.array(Y).T)[1]
+	num_runs = runs_per_order[ORDER] - runs_at_start
+	print(f"the surrogate search used {num_runs} COSY runs and {len(X) - num_runs} cached evaluations")
+	return optimize.OptimizeResult(x=np.array(X[np.argmin(costs)]), fun=np.min(costs), nfev=num_runs)
+
+
+def pareto_search(x0: NDArray[float], bounds: List[Tuple[float, float]],
+                  num_generations: int = PARETO_GENERATIONS) -> optimize.OptimizeResult:
+	""" fill in the front of the Pareto archive with NSGA-II: each generation, breed a batch of children
+		from the population the same way differential evolution does, run them all at once, and keep the
+		best by rank and crowding distance.  the population starts from the archive's front, so running this
+		again picks up where the last run left off, and everything it finds stays in the archive to be queried.
+		returns: the design that minimizes the usual cost, along with the whole front
+	"""
+	lower = np.array([low for low, high in bounds])
+	upper = np.array([high for low, high in bounds])
+	rng = np.random.default_rng(0)
+	population_size = POPULATION_SIZE*len(x0)
+	archive = get_archive()
+
+	def add_to_population(population: NDArray[int], new_X: NDArray[float]) -> NDArray[int]:
+		""" evaluate some designs and put every one that worked into the population, including ones that
+			were already in the store (evaluate_batch only adds the ones it had to run to the archive)
+		"""
+		evaluate_batch(new_X)
+		indices = archive.find(new_X)
+		return np.unique(np.concatenate([population, indices[indices >= 0]]))
+
+	in_bounds = np.all((archive.parameters >= lower) & (archive.parameters <= upper), axis=1)
+	population = archive.select(np.nonzero(in_bounds)[0], population_size)
+	print(f"starting from {population.size} designs on the archive's front")
+	if population.size < population_size:
+		seeds = stats.qmc.LatinHypercube(d=len(x0), seed=rng).random(population_size - population.size)
+		new_X = np.concatenate([[x0], lower + seeds*(upper - lower)])[:population_size - population.size]
+		population = add_to_population(population, new_X)
+
+	for generation in range(num_generations):
+		if population.size < 3:
+			# it takes three donors to make a mutant, so if too many runs failed, throw in some fresh designs
+			seeds = stats.qmc.LatinHypercube(d=len(x0), seed=rng).random(population_size - population.size)
+			population = add_to_population(population, lower + seeds*(upper - lower))
+			if population.size < 3:
+				raise ValueError(f"only {population.size} designs could be evaluated, so I can't breed any more")
+		X = archive.parameters[population]
+		donors = np.array([rng.choice(len(X), 3, replace=False) for _ in range(len(X))])
+		mutants = X[donors[:, 0]] + 0.5*(X[donors[:, 1]] - X[donors[:, 2]])
+		crossover = rng.random(X.shape) < 0.9
+		crossover[np.arange(len(X)), rng.integers(len(x0), size=len(X))] = True
+		children = np.clip(np.where(crossover, mutants, X), lower, upper)  # each mutant crosses with its target
+		population = archive.select(add_to_population(population, children), population_size)
+		print(f"generation {generation + 1}: the front has {archive.front.size} designs")
+
+	best_x, best_objectives = archive.best(weighted_cost)
+	return optimize.OptimizeResult(x=best_x, fun=weighted_cost(best_objectives), nit=num_generations,
+	                               front_x=archive.front_parameters(), front_objectives=archive.front_objectives())
+
+
+def get_archive() -> ParetoArchive:
+	""" the Pareto archive of every full-order evaluation in the store, which gets loaded the first time
+		this is called and kept up to date by evaluate_batch after that
+	"""
+	global archive
+	if archive is None:
+		archive = ParetoArchive(OBJECTIVE_NAMES, len(PARAMETER_NAMES))
+		evaluations = [(parameters, observables) for parameters, observables in store.evaluations(script_hash, ORDER)
+		               if len(parameters) == len(PARAMETER_NAMES)]
+		if len(evaluations) > 0:
+			archive.add(np.array([parameters for parameters, observables in evaluations]),
+			            np.array([objectives_from_observables(observables) for parameters, observables in evaluations]))
+	return archive
+
+
+def objective_function(parameters: List[float], order: int = ORDER) -> float:
 	""" run COSY, read its output, and calculate a number that quantifies the system. smaller should be better """
-	output = run_cosy(parameters)
-	time_skew = get_cosy_output(r"Time skew \(ps/keV\) += +", output)
-	tof_width = get_cosy_output(r"FPDESIGN Time Resol\.\(ps\) +", output)
-	energy_width = get_cosy_output(r"FPDESIGN HO Resol\.RAY\(keV\) +", output)
-	tilt_angle = get_cosy_output(r"FPDESIGN Tilt Angle\(deg\) +", output)
-	time_resolution = sqrt(tof_width**2 + (energy_width*time_skew)**2)
-
-	cost = 150*(time_resolution/150 + energy_width/300 + (exp(abs(tilt_angle) - 80)/5))
+	return objective_function_batch([parameters], order)[0]
+
+
+def objective_function_batch(parameter_sets: Union[NDArray[float], List[List[float]]], order: int = ORDER
+                             ) -> NDArray[float]:
+	""" run COSY on a bunch of parameter sets in parallel and calculate the objective function for each """
+	results = evaluate_batch(parameter_sets, order)
+	return np.array([calculate_cost(parameters, result.observables if not result.failed else {})
+	                 for parameters, result in zip(parameter_sets, results)])
+
+
+def calculate_cost(parameters: List[float], observables: Dict[str, float]) -> float:
+	""" calculate a number that quantifies the system from its COSY observables. smaller should be better.
+		if COSY didn't get far enough to print them all, it gets the FAILURE_COST.
+	"""
+	if any(name not in observables for name in OBJECTIVE_OBSERVABLES):
+		print(f"[{','.join(f'{parameter:.6g}' for parameter in parameters)},]\n\t->   failed = {FAILURE_COST:.2f}ps")
+		return FAILURE_COST
+	time_skew, tof_width, energy_width, tilt_angle = [
+		get_observable(name, observables) for name in OBJECTIVE_OBSERVABLES]
+	time_resolution, cost = cost_from_observables(time_skew, tof_width, energy_width, tilt_angle)
 	print("[", end="")
 	for parameter in parameters:
 		print(f"{parameter:.6g},", end="")
@@ -57,49 +340,113 @@ def objective_function(parameters: List[float]) -> float:
 	return cost
 
 
-def run_cosy(parameters: List[float]) -> str:
+def cost_from_observables(time_skew: NDArray[float], tof_width: NDArray[float],
+                          energy_width: NDArray[float], tilt_angle: NDArray[float]
+                          ) -> Tuple[NDArray[float], NDArray[float]]:
+	""" combine the observables into the total time resolution and the cost.  this works on floats or arrays.
+		returns: the time resolution (ps) and the cost (ps)
+	"""
+	time_resolution = np.hypot(tof_width, energy_width*time_skew)
+	cost = weighted_cost(np.stack([time_resolution, energy_width, np.abs(tilt_angle)], axis=-1))
+	return time_resolution, cost
+
+
+def objectives_from_observables(observables: Dict[str, float]) -> NDArray[float]:
+	""" pull out the objectives that the Pareto archive keeps (see OBJECTIVE_NAMES), which are NaN if COSY didn't print them """
+	if any(name not in observables for name in OBJECTIVE_OBSERVABLES):
+		return np.full(len(OBJECTIVE_NAMES), np.nan)
+	time_skew, tof_width, energy_width, tilt_angle = [observables[name] for name in OBJECTIVE_OBSERVABLES]
+	return np.array([np.hypot(tof_width, energy_width*time_skew), energy_width, abs(tilt_angle)])
+
+
+def weighted_cost(objectives: NDArray[float], weights: Tuple[float, float, float] = COST_WEIGHTS) -> NDArray[float]:
+	""" combine the objectives (along the last axis) into a cost, given the scale of each term """
+	time_weight, energy_weight, tilt_weight = weights
+	return 150*(objectives[..., 0]/time_weight + objectives[..., 1]/energy_weight +
+	            np.exp(objectives[..., 2] - 80)/tilt_weight)
+
+
+def run_cosy(parameters: List[float], order: int = ORDER) -> str:
 	""" get the observable values at these perturbations """
-	parameters = tuple(parameters)
-	if parameters not in cache or "### ERRORS IN CODE" in cache[parameters]:
-		modified_script = script
-		modified_script = re.sub(r"streamlined_mode := \d;", "streamlined_mode := 1;", modified_script)
-		modified_script = re.sub(rf"order := \d;", f"order := {ORDER};", modified_script)
-		for i, name in enumerate(PARAMETER_NAMES):
-			modified_script = re.sub(rf"{name} := [-.\d]+;", f"{name} := {parameters[i]};", modified_script)
-
-		with open('temp.fox', 'w') as f:
-			f.write(modified_script)
-
-		result = subprocess.run(['C:/Program Files/COSY 10.0/cosy.exe', 'temp'], capture_output=True, check=True)
-		if result.returncode > 0:
-			print(result.stdout.decode('ascii'))
-			raise RuntimeError()
-
-		# store full parameter sets and their resulting COSY outputs in the cache
-		output = result.stdout.decode('ascii')
-		if "### ERROR" in output:
-			print(re.sub(r"[\n\r]+", "\n", output))
-			raise RuntimeError("COSY threw an error")
-		output = output[1036:]
-
-		cache[parameters] = output
-		with open(f"{FILE_TO_OPTIMIZE}_cache.pkl", "wb") as file:
-			pickle.dump(cache, file)
-
-	return cache[parameters]
-
-
-def get_cosy_output(pattern: str, output: str) -> float:
-	""" extract a single number from some COSY output using regex """
-	match = re.search(pattern + r"([-.\de*]+)[\sa-z()/]*", output)
-	if match is None:
-		print(output)
-		raise ValueError(f"couldn’t find /{pattern}/ in output")
-	number = match.group(1)
-	if "***" in number:
-		return inf
-	else:
-		return float(number)
+	return run_cosy_batch([parameters], order)[0]
+
+
+def get_observables(parameters: List[float], order: int = ORDER) -> Dict[str, float]:
+	""" get the parsed observable values at these perturbations """
+	return evaluate_batch([parameters], order)[0].observables
+
+
+def run_cosy_batch(parameter_sets: List[List[float]], order: int = ORDER) -> List[str]:
+	""" get the COSY outputs at a bunch of perturbations at once """
+	return [result.output for result in evaluate_batch(parameter_sets, order)]
+
+
+def evaluate_batch(parameter_sets: List[List[float]], order: int = ORDER) -> List[CosyResult]:
+	""" get the parsed COSY results at a bunch of perturbations at once, running
+		any that aren't in the store in parallel.  they come back in the same order as the inputs.  the ones
+		COSY fails on come back failed (with the errors in them) rather than raising, so the rest still count.
+		:param order: the order to which COSY should calculate the map.  each order is cached separately.
+	"""
+	parameter_sets = [tuple(float(x) for x in parameters) for parameters in parameter_sets]
+	keys = [make_key(script_hash, order, parameters) for parameters in parameter_sets]
+	with instrumentation.stopwatch() as lookup:
+		results = store.get_many(keys)
+	lookup_time = lookup["seconds"]/max(len(keys), 1)
+	instrumentation.record("optimize", [{"cached": True, "lookup": lookup_time}]*len(results))
+
+	to_run = {}
+	for key, parameters in zip(keys, parameter_sets):
+		if key not in results:
+			to_run[key] = parameters
+
+	if len(to_run) > 0:
+		new_results, events = instrumentation.run_batch(
+			BatchingPool(pool, batch_template, BATCH_SIZE), lambda parameters: script_values(parameters, order),
+			list(to_run.values()))
+		runs_per_order[order] += len(to_run)
+
+		# store full parameter sets and their parsed COSY results (failures get passed on but not stored)
+		new_entries = []
+		for (key, parameters), result in zip(to_run.items(), new_results):
+			results[key] = result
+			if result.failed:
+				print(f"COSY threw an error at {parameters}: {result.errors[0]}")
+			else:
+				new_entries.append((key, script_hash, order, parameters, result))
+		with instrumentation.stopwatch() as storing:
+			store.put_many(new_entries)
+		for event in events:
+			event["lookup"] = lookup_time
+			event["store"] = storing["seconds"]/len(events)
+		instrumentation.record("optimize", events)
+		if archive is not None and order == ORDER:
+			archive.add(np.array([parameters for parameters in to_run.values()]),
+			            np.array([objectives_from_observables(result.observables) if not result.failed
+			                      else np.full(len(OBJECTIVE_NAMES), np.nan) for result in new_results]))
+
+	return [results[key] for key in keys]
+
+
+def modify_script(parameters: Tuple[float, ...], order: int = ORDER) -> str:
+	""" write a version of the COSY file with the given parameters filled in """
+	return template.render(script_values(parameters, order))
+
+
+def script_values(parameters: Tuple[float, ...], order: int = ORDER) -> Dict[str, float]:
+	""" everything that needs to be filled into the COSY file to evaluate the given parameters """
+	values = dict(zip(PARAMETER_NAMES, parameters))
+	values["order"] = order
+	values["streamlined_mode"] = 1
+	return values
+
+
+def get_observable(name: str, observables: Dict[str, float]) -> float:
+	""" extract a single number from some parsed COSY output """
+	try:
+		return observables[name]
+	except KeyError:
+		print(observables)
+		raise ValueError(f"couldn’t find {name} in output")
 
 
 def get_defaults() -> Tuple[NDArray[float], List[Tuple[float, float]]]:
@@ -107,11 +454,7 @@ def get_defaults() -> Tuple[NDArray[float], List[Tuple[float, float]]]:
 	values = []
 	bounds = []
 	for name in PARAMETER_NAMES:
-		try:
-			values.append(float(re.search(rf"{name} := ([-.\de]+);", script).group(1)))
-		except AttributeError:
-			print(script)
-			raise RuntimeError(f"where is {name}?")
+		values.append(template.defaults[name])
 		if name.startswith("S"):
 			bounds.append((0, 2.0))  # gaps must be positive, no more than 2m
 		elif name.startswith("angle"):
@@ -137,5 +480,9 @@ def simplexify(x0: Union[NDArray[float], List[float]],
 	return np.array(vertices)
 
 
+if len(store) == 0:  # bring over anything from the old pickle cache (under the legacy hash, so it's never taken as current)
+	import_pickle_cache(store, f"{FILE_TO_OPTIMIZE}_cache.pkl", ORDER)
+
+
 if __name__ == '__main__':
 	optimize_design()
@@ -0,0 +1,228 @@
+import re
+from itertools import product
+from math import pi, sqrt
+from typing import Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy import optimize
+
+from cosy_output import CosyResult, parse_cosy_output
+from fox_template import FoxTemplate
+from map_algebra import NUM_COORDINATES, exact_drift, move_detector
+from map_tracing import map_design, ray_widths, trace_rays
+from visualize import COSY_Matrix
+
+SETUP_STATEMENT = re.compile(r"^([ \t]*OV\s+)(\S+)(\s+\S+\s+)(\S+)(\s*;)", re.MULTILINE)
+PARAMETER_ORDER = 2  # how far the maps follow each DA parameter (the sensitivity stencil takes second derivatives)
+PLAIN_ARGUMENT_COMMANDS = ["TA"]  # COSY commands that copy their arguments into one-word variables, so they can't take DA values
+REFOCUS_RANGE = 0.2  # the farthest the detector can move when refocusing (m)
+
+# the spread of the rays that CHARAY uses to fit the focal plane in MRSt_tol.fox
+XX = 0.0001  # m
+AX = 0.00016667  # rad
+YY = 0.0003  # m
+AY = 2*5.0*0.00016667  # rad
+
+
+def tolerance_rays() -> NDArray[float]:
+	""" lay out the same rays as CHARAY does when FLAG_HO is set, all at the central energy: a few along each
+		axis and one in each corner of the (x, a, y, b) box.
+		returns: an (n_rays × 6) array of initial coordinates in COSY's units
+	"""
+	rays = []
+	for fraction in [1, .5, 0, -.5, -1]:
+		rays.append((0, fraction*AX, 0, 0))
+		rays.append((fraction*XX, 0, 0, 0))
+		rays.append((0, 0, 0, fraction*AY))
+		rays.append((0, 0, fraction*YY, 0))
+	rays += [(0, 0, YY, -AY), (0, 0, -YY, -AY)]
+	for signs in product([1, -1], repeat=4):
+		rays.append((signs[0]*XX/sqrt(2), signs[1]*AX, signs[2]*YY/sqrt(2), signs[3]*AY))
+	rays = np.array(rays, dtype=float)
+	return np.concatenate([rays, np.zeros((rays.shape[0], 2))], axis=1)
+
+
+def plain_parameters(template: FoxTemplate, names: Iterable[str]) -> List[str]:
+	""" find the parameters that COSY wouldn't accept as DA values: placeholders that go into a command from
+		PLAIN_ARGUMENT_COMMANDS, and assignments to variables that are declared with only one word
+	"""
+	script = re.sub(r"\{[^{}]*\}", lambda comment: " "*len(comment.group()), template.script)  # so that a ; in a comment doesn't count
+	plain = []
+	for name in names:
+		for match in re.finditer(f"<<{name}>>", script):
+			statement = script[script.rfind(";", 0, match.start()) + 1:match.start()].split()
+			if len(statement) > 0 and statement[0].upper() in PLAIN_ARGUMENT_COMMANDS:
+				plain.append(name)
+				break
+		else:
+			if re.search(rf"\bVARIABLE\s+{name}\s+1\s*;", script, re.IGNORECASE):
+				plain.append(name)
+	return plain
+
+
+def parametric_script(template: FoxTemplate, values: Mapping[str, object], scales: Mapping[str, float],
+                      parameter_order: int = PARAMETER_ORDER) -> Tuple[str, int, int]:
+	""" fill in a template with some of its parameters turned into COSY DA parameters, so that the maps it
+		prints depend on them.  each one goes in as its usual value plus some multiple of PARA()-1 (PARA itself
+		is 1 plus the DA variable), and the new ones go after whatever parameters the OV call already sets up.
+		the OV order gets raised by parameter_order as well, since otherwise the highest-order terms would lose
+		their dependence on the parameters to the truncation; fix_parameters takes the extra terms back out.
+		:param values: the text for every placeholder, same as for FoxTemplate.render
+		:param scales: for each parameter that should become a DA parameter, how much its text changes per unit of it
+		:param parameter_order: the highest power of each parameter that the maps up to the original order should have
+		returns: the script, the column of the map's exponents that goes with the first DA parameter (the rest
+		         follow in the same order as scales), and the order the script was at before it got raised
+	"""
+	if parameter_order < 1:
+		raise ValueError(f"I can't make a map depend on its parameters to order {parameter_order}")
+	plain = plain_parameters(template, scales)
+	if len(plain) > 0:
+		raise ValueError(f"COSY can't take DA values for {', '.join(plain)}")
+
+	script = template.render(values)
+	setup = SETUP_STATEMENT.search(script)
+	if setup is None or not setup.group(4).isdigit():
+		raise ValueError("I can't find an OV call with a set number of parameters in this script")
+	num_existing = int(setup.group(4))
+	order = setup.group(2)
+	if not order.isdigit():  # the OV call names a variable (like order in MRSt_OMEGA.fox), so look up its value
+		assignment = re.search(rf"\b{order} := ([-+]?[.\d]+(?:[eE][-+]?\d+)?);", script)
+		if order in values:
+			order = values[order]
+		elif assignment is not None:
+			order = assignment.group(1)
+		else:
+			raise ValueError(f"I can't tell what order {order} is in the OV call")
+	order = int(float(order))
+
+	parametric = dict(values)
+	for k, name in enumerate(scales):
+		parametric[name] = f"({values[name]}+{scales[name]:g}*(PARA({num_existing + k + 1})-1))"
+	script = template.render(parametric)
+	setup = SETUP_STATEMENT.search(script)
+	script = (script[:setup.start(2)] + str(order + parameter_order) + setup.group(3) +
+	          str(num_existing + len(scales)) + script[setup.end(4):])
+	return script, NUM_COORDINATES + num_existing, order
+
+
+def fix_parameters(matrix: COSY_Matrix, first_column: int, values: Sequence[float], order: Optional[int] = None
+                   ) -> COSY_Matrix:
+	""" plug in numbers for some of a map's parameters, leaving a map of everything else
+		:param first_column: the column of the exponents that goes with the first parameter being fixed
+		:param values: the value of each parameter being fixed, in order starting from that column
+		:param order: if given, drop every term past this order in what's left (for a map from parametric_script,
+		              this should be the order it returned, since the terms past it are incomplete)
+	"""
+	values = np.asarray(values, dtype=float)
+	last_column = first_column + values.size
+	weights = np.prod(values**matrix.exponents[:, first_column:last_column], axis=1)
+	exponents = np.concatenate([matrix.exponents[:, :first_column], matrix.exponents[:, last_column:]], axis=1)
+	if order is not None:
+		keep = np.sum(exponents, axis=1) <= order
+		exponents, weights, coefficients = exponents[keep], weights[keep], matrix.cosy_coefficients[keep]
+	else:
+		coefficients = matrix.cosy_coefficients
+	remaining, index = np.unique(exponents, axis=0, return_inverse=True)
+	totals = np.zeros((remaining.shape[0], coefficients.shape[1]))
+	np.add.at(totals, index.ravel(), weights[:, np.newaxis]*coefficients)
+	return COSY_Matrix.from_arrays(remaining, totals)
+
+
+def refocus(matrix: COSY_Matrix, rays: NDArray[float]) -> COSY_Matrix:
+	""" move the detector to wherever the rays are narrowest in x, the way the FIT S4 at the end of
+		MRSt_tol.fox does.  the rays only go thru the map once; the drift after it is done exactly.
+	"""
+	final = np.empty((rays.shape[0], 6))
+	final[:, :5] = matrix.evaluate_cosy(rays, "xaybl")
+	final[:, 5] = rays[:, 5]
+	width = lambda distance: np.ptp(exact_drift(final, distance)[:, 0])
+	distance = optimize.minimize_scalar(
+		width, bounds=(-REFOCUS_RANGE, REFOCUS_RANGE), method="bounded", options=dict(xatol=1e-7)).x
+	return move_detector(matrix, distance)
+
+
+class ParametricMap:
+	""" everything from one COSY run of a script from parametric_script, which can give the map (and so the
+		observables) at any values of the DA parameters without running COSY again.  the observables are
+		calculated from the map the way map_tracing does it, with the rays the tolerance script uses, and the
+		detector is refocused for every set of values.  only the changes come from the map, tho; they're added
+		to what COSY reported for the unperturbed system.
+	"""
+	def __init__(self, result: CosyResult, first_column: int, num_parameters: int, order: Optional[int] = None,
+	             refocus_detector: bool = True, rays: NDArray[float] = None,
+	             reported: Optional[Mapping[str, float]] = None):
+		""" :param order: the order the script was at before parametric_script raised it
+			:param reported: the observables COSY reported for the unperturbed system.  the parametric run itself
+			                 was done at a higher order, so these should come from a plain run of the same script
+			                 (defaults to whatever the parametric run reported).
+		"""
+		self.matrix = COSY_Matrix.from_result(result)
+		if self.matrix.exponents.shape[1] < first_column + num_parameters:
+			raise ValueError(f"this map only has {self.matrix.exponents.shape[1]} variables, so it can't depend on "
+			                 f"{num_parameters} parameters starting at column {first_column}")
+		self.first_column = first_column
+		self.num_parameters = num_parameters
+		self.order = order
+		self.refocus_detector = refocus_detector
+		self.rays = rays if rays is not None else tolerance_rays()
+		self.reported = dict(reported) if reported is not None else result.observables
+		self.baseline = self.map_observables(np.zeros(num_parameters))
+
+	def fixed_matrix(self, x: Sequence[float]) -> COSY_Matrix:
+		""" the map at these values of the parameters (relative to the ones the script was rendered with) """
+		return fix_parameters(self.matrix, self.first_column, x, self.order)
+
+	def map_observables(self, x: Sequence[float]) -> Dict[str, float]:
+		""" the observables as calculated from the map alone, with keys like "FPDESIGN Tilt Angle(deg)" """
+		matrix = self.fixed_matrix(x)
+		if self.refocus_detector:
+			matrix = refocus(matrix, self.rays)
+		observables = map_design(matrix)
+		final_rays = trace_rays(matrix, self.rays, observables["FPDESIGN Tilt Angle(deg)"]*pi/180)
+		observables.update({key: float(value) for key, value in ray_widths(matrix, final_rays).items()})
+		return observables
+
+	def observables(self, x: Sequence[float]) -> Dict[str, float]:
+		""" the observables at these values of the parameters: what COSY reported, plus however much the map
+			says they change
+		"""
+		observables = self.map_observables(x)
+		return {key: self.reported[key] + value - self.baseline[key]
+		        for key, value in observables.items() if key in self.reported}
+
+
+def run_parametric_map(pool, template: FoxTemplate, values: Mapping[str, object], scales: Mapping[str, float],
+                       refocus_detector: bool = True, parameter_order: int = PARAMETER_ORDER) -> ParametricMap:
+	""" run COSY on a parametric version of a template and read the parameter-dependent map it prints.  the
+		unperturbed script gets run alongside it, so that the reported observables are at the usual order.
+		:param pool: a CosyPool (or anything else with a map method)
+		:param values: the text for every placeholder, same as for FoxTemplate.render
+		:param scales: for each parameter to vary, how much its text changes per unit of it (none of them can
+		               be in plain_parameters)
+		:param parameter_order: the highest power of each parameter that the map should have
+	"""
+	script, first_column, order = parametric_script(template, values, scales, parameter_order)
+	result, plain_result = [parse_cosy_output(output) for output in pool.map([script, template.render(values)])]
+	for run in [result, plain_result]:
+		if run.failed:
+			raise RuntimeError(f"COSY threw an error: {run.errors[0]}")
+	return ParametricMap(result, first_column, len(scales), order, refocus_detector,
+	                     reported=plain_result.observables)
+
+
+if __name__ == "__main__":
+	# compare the sensitivities from one parameter-dependent map with the ones from finite differences
+	import find_tolerances as ft
+	from sensitivity import compute_sensitivities
+	x0 = np.zeros(len(ft.PARAMETERS))
+	steps = np.array(3*[.5] + 6*[.02] + 3*[.1] + 6*[.1] + 5*[.5] + [1])
+	parametric_map, mapped = ft.build_parametric_map(x0)
+	_, from_map, _, _ = compute_sensitivities(lambda X: ft.get_values_from_map(parametric_map, mapped, X), x0, steps)
+	_, from_runs, _, _ = compute_sensitivities(ft.get_values_batch, x0, steps)
+	for i, parameter in enumerate(ft.PARAMETERS):
+		if not mapped[i]:
+			continue  # both columns would come from COSY runs
+		print(f"{parameter}:")
+		for j, (name, _, _, _) in enumerate(ft.OBSERVABLES):
+			print(f"    {name:22s} {from_map[i, j]:12.4g} {from_runs[i, j]:12.4g}")
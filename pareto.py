@@ -0,0 +1,190 @@
+import argparse
+from typing import Callable, Dict, Sequence, Tuple, Union
+
+import numpy as np
+from numpy.typing import NDArray
+
+Objective = Union[int, str]
+
+
+def dominates(a: NDArray[float], b: NDArray[float]) -> NDArray[bool]:
+	""" whether each a is at least as good as b in every objective and better in at least one (smaller is
+		better).  it broadcasts over everything but the last axis.
+	"""
+	return np.all(a <= b, axis=-1) & np.any(a < b, axis=-1)
+
+
+def nondominated(objectives: NDArray[float]) -> NDArray[bool]:
+	""" find the points that no other point dominates.  the points get sorted lexicographically first, so
+		that nothing can be dominated by a point that comes after it, which means each one only has to be
+		checked against the front found so far instead of against every other point.
+		:param objectives: an (n × objectives) array
+		returns: an n-element mask of the nondominated points
+	"""
+	mask = np.zeros(objectives.shape[0], dtype=bool)
+	front = np.empty_like(objectives)
+	size = 0
+	for i in np.lexsort(objectives.T[::-1]):
+		if not np.any(dominates(front[:size], objectives[i])):
+			front[size] = objectives[i]
+			size += 1
+			mask[i] = True
+	return mask
+
+
+def nondominated_ranks(objectives: NDArray[float]) -> NDArray[int]:
+	""" sort the points into fronts: rank 0 is the nondominated set, rank 1 is what's nondominated once
+		that's taken out, and so on
+	"""
+	ranks = np.full(objectives.shape[0], -1)
+	remaining = np.arange(objectives.shape[0])
+	rank = 0
+	while remaining.size > 0:
+		mask = nondominated(objectives[remaining])
+		ranks[remaining[mask]] = rank
+		remaining = remaining[~mask]
+		rank += 1
+	return ranks
+
+
+def crowding_distances(objectives: NDArray[float]) -> NDArray[float]:
+	""" how much room each point on a front has around it: the sum over objectives of the distance between
+		its neighbors, relative to the front's extent.  the points at the ends get infinity.
+	"""
+	distances = np.zeros(objectives.shape[0])
+	if objectives.shape[0] <= 2:
+		return np.full(objectives.shape[0], np.inf)
+	for k in range(objectives.shape[1]):
+		order = np.argsort(objectives[:, k])
+		values = objectives[order, k]
+		extent = values[-1] - values[0]
+		distances[order[0]] = distances[order[-1]] = np.inf
+		if extent > 0:
+			distances[order[1:-1]] += (values[2:] - values[:-2])/extent
+	return distances
+
+
+class ParetoArchive:
+	""" every design that's been evaluated along with its objectives, kept separate instead of rolled into
+		one cost, and the set of them that nothing else beats (the front), which gets updated as points come
+		in.  since any cost that never gets worse when an objective improves is minimized somewhere on the
+		front, questions like "which design is best for these weights" only have to look there, so they're
+		answered right away no matter how many points there are.
+	"""
+	def __init__(self, names: Sequence[str], num_parameters: int):
+		""" :param names: what each objective is called (smaller is always better)
+			:param num_parameters: the length of each parameter vector
+		"""
+		self.names = list(names)
+		self.parameters = np.empty((0, num_parameters))
+		self.objectives = np.empty((0, len(names)))
+		self.front = np.empty(0, dtype=int)  # the indices of the nondominated points
+		self.positions: Dict[Tuple[float, ...], int] = {}  # the index of each parameter vector, for find
+
+	def __len__(self) -> int:
+		return self.parameters.shape[0]
+
+	def add(self, parameters: NDArray[float], objectives: NDArray[float]) -> int:
+		""" put some evaluated points in the archive and update the front.  points with any NaN or infinite
+			objectives (like from failed runs) are left out.
+			returns: how many of them made it onto the front
+		"""
+		parameters = np.reshape(parameters, (-1, self.parameters.shape[1]))
+		objectives = np.reshape(objectives, (-1, len(self.names)))
+		valid = np.all(np.isfinite(objectives), axis=1)
+		start = len(self)
+		self.parameters = np.concatenate([self.parameters, parameters[valid]])
+		self.objectives = np.concatenate([self.objectives, objectives[valid]])
+		for i in range(start, len(self)):
+			self.positions.setdefault(tuple(self.parameters[i]), i)
+		candidates = np.concatenate([self.front, np.arange(start, len(self))])
+		self.front = candidates[nondominated(self.objectives[candidates])]
+		return int(np.count_nonzero(self.front >= start))
+
+	def find(self, parameters: NDArray[float]) -> NDArray[int]:
+		""" look up where some parameter vectors are in the archive
+			returns: the index of each one, or -1 for any that aren't in it (like ones whose runs failed)
+		"""
+		parameters = np.reshape(parameters, (-1, self.parameters.shape[1]))
+		return np.array([self.positions.get(tuple(row), -1) for row in parameters.astype(float)], dtype=int)
+
+	def front_parameters(self) -> NDArray[float]:
+		return self.parameters[self.front]
+
+	def front_objectives(self) -> NDArray[float]:
+		return self.objectives[self.front]
+
+	def index(self, objective: Objective) -> int:
+		return objective if isinstance(objective, int) else self.names.index(objective)
+
+	def best(self, score: Callable[[NDArray[float]], NDArray[float]]) -> Tuple[NDArray[float], NDArray[float]]:
+		""" find the design that minimizes some score, which has to be a function that takes an (n × objectives)
+			array and never gets worse when one of them improves
+			returns: its parameters and its objectives
+		"""
+		if self.front.size == 0:
+			raise ValueError("there's nothing in the archive yet")
+		best = self.front[np.argmin(score(self.front_objectives()))]
+		return self.parameters[best], self.objectives[best]
+
+	def best_weighted(self, weights: Sequence[float]) -> Tuple[NDArray[float], NDArray[float]]:
+		""" find the design with the smallest weighted sum of objectives """
+		return self.best(lambda objectives: objectives@np.asarray(weights, dtype=float))
+
+	def best_constrained(self, objective: Objective, limits: Dict[Objective, float]
+	                     ) -> Tuple[NDArray[float], NDArray[float]]:
+		""" find the design that's best in one objective while keeping some others under some limits
+			:param limits: the largest acceptable value of each of the other objectives
+		"""
+		index = self.index(objective)
+		objectives = self.front_objectives()
+		acceptable = np.ones(self.front.size, dtype=bool)
+		for limited, limit in limits.items():
+			acceptable &= objectives[:, self.index(limited)] <= limit
+		if not np.any(acceptable):
+			raise ValueError("nothing in the archive meets those limits")
+		return self.best(lambda objectives: np.where(acceptable, objectives[:, index], np.inf))
+
+	def select(self, candidates: NDArray[int], size: int) -> NDArray[int]:
+		""" pick the best few of some of the archive's points the way NSGA-II does: by rank, and then within
+			the last rank that fits, the ones with the most room around them
+			:param candidates: the indices of the points to choose from
+			returns: the indices of the ones chosen
+		"""
+		ranks = nondominated_ranks(self.objectives[candidates])
+		chosen = []
+		for rank in range(np.max(ranks, initial=-1) + 1):
+			members = candidates[ranks == rank]
+			if len(chosen) + members.size > size:
+				distances = crowding_distances(self.objectives[members])
+				chosen += list(members[np.argsort(-distances)[:size - len(chosen)]])
+				break
+			chosen += list(members)
+		return np.array(chosen, dtype=int)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="look up the best designs for some trade-off among everything optimize.py has evaluated")
+	parser.add_argument("--weights", type=float, nargs=3, metavar=("TIME", "ENERGY", "TILT"),
+	                    help="the scales of the three terms in the cost (the default cost uses 150 300 5)")
+	parser.add_argument("--minimize", help="the objective to minimize subject to the limits")
+	parser.add_argument("--limit", nargs=2, action="append", default=[], metavar=("OBJECTIVE", "VALUE"),
+	                    help="keep an objective at or below a value (can be given more than once)")
+	args = parser.parse_args()
+
+	import optimize
+	archive = optimize.get_archive()
+	print(f"{len(archive)} evaluated designs, {archive.front.size} of which are on the front")
+	print(f"the objectives are {', '.join(archive.names)}")
+	if args.weights is not None or args.minimize is None:
+		weights = args.weights if args.weights is not None else optimize.COST_WEIGHTS
+		parameters, objectives = archive.best(lambda objectives: optimize.weighted_cost(objectives, weights))
+		print(f"the best design for weights {tuple(weights)} costs {optimize.weighted_cost(objectives, weights):.2f}ps")
+	else:
+		parameters, objectives = archive.best_constrained(args.minimize, {name: float(value) for name, value in args.limit})
+		print(f"the best {args.minimize} with " + " and ".join(f"{name} ≤ {value}" for name, value in args.limit))
+	for name, value in zip(optimize.PARAMETER_NAMES, parameters):
+		print(f"    {name:8s} = {value:.6g}")
+	for name, value in zip(archive.names, objectives):
+		print(f"    {name:20s} = {value:.4g}")
@@ -0,0 +1,248 @@
+import argparse
+import os
+import tempfile
+import time
+from math import isfinite, pi
+from typing import Optional, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+from cosy_output import CosyResult, parse_cosy_output
+from map_tracing import E0, GEOMETRY, SPECTRAL_RANGE, calculate_velocity, map_design, reference_gamma, trace_rays
+from visualize import COSY_Matrix
+
+NUM_SAMPLES = 2**17  # how finely the map gets traced across the energy range when building the table
+TABLE_SIZE = 2**14  # how many evenly spaced positions the table has
+CHUNK_SIZE = 2**14  # how many hits to do at a time (about a MB of temporary arrays, which stays in cache)
+
+
+class HitReconstructor:
+	""" the focal plane map turned around, so that a hit's position and time on the detector give back the
+		deuteron's energy and when it was born.  the position only depends on the energy (to first order in the
+		spread at the foil, which there's no way to measure anyway), so the central ray is traced across the
+		whole energy range once, and resampled to evenly spaced positions.  then each hit only costs one lookup
+		and one linear interpolation, with no searching, so it can do whole arrays of hits at memory speed.
+		positions are COSY's x at the end of the map (m), and times are in s.
+	"""
+	def __init__(self, matrix: COSY_Matrix, flight_time: float = 0.,
+	             energy_range: Tuple[float, float] = (E0 - SPECTRAL_RANGE/2, E0 + SPECTRAL_RANGE/2),
+	             fp_tilt: Optional[float] = None, table_size: int = TABLE_SIZE):
+		""" :param matrix: the map from the foil to the detector
+			:param flight_time: how long the reference particle takes to get from the foil to the detector (s).
+			                    if it's left at 0, the birth times are relative to that.
+			:param energy_range: the lowest and highest energies to cover (MeV).  hits outside of it come back NaN.
+			:param fp_tilt: the tilt of the detector plane (rad), which changes the time at which each energy hits
+			                it; it defaults to the tilt of the focal plane, the way main sets it up
+			:param table_size: how many points go in the lookup table
+		"""
+		self.matrix = matrix
+		self.flight_time = flight_time
+		self.fp_tilt = fp_tilt if fp_tilt is not None else map_design(matrix)["FPDESIGN Tilt Angle(deg)"]*pi/180
+
+		d_energy = np.linspace(energy_range[0]/E0 - 1, energy_range[1]/E0 - 1, NUM_SAMPLES)
+		positions, delays = self.central_ray(d_energy)
+		steps = np.diff(positions)
+		if not (np.all(steps > 0) or np.all(steps < 0)):
+			raise ValueError(f"the position on the detector isn't monotonic in energy between {energy_range[0]} and "
+			                 f"{energy_range[1]} MeV, so I can't tell the energies apart")
+		if steps[0] < 0:
+			positions, d_energy, delays = positions[::-1], d_energy[::-1], delays[::-1]
+
+		# the table has a NaN entry at each end, so that anything off of it comes out NaN without any extra checks
+		self.x_start = positions[0]
+		self.x_step = (positions[-1] - positions[0])/(table_size - 1)
+		grid = np.linspace(positions[0], positions[-1], table_size)
+		energies = E0*(1 + np.interp(grid, positions, d_energy))
+		delays = np.interp(grid, positions, delays)
+		# each row of a table is the value at the start of a segment and how much it changes by the end, so one
+		# gather gets both.  the flight time goes right into the delays.
+		self.energy_table = np.full((table_size + 1, 2), np.nan)
+		self.energy_table[1:-1, 0] = energies[:-1]
+		self.energy_table[1:-1, 1] = np.diff(energies)
+		self.delay_table = np.full((table_size + 1, 2), np.nan)
+		self.delay_table[1:-1, 0] = flight_time + delays[:-1]
+		self.delay_table[1:-1, 1] = np.diff(delays)
+
+	@classmethod
+	def from_result(cls, result: CosyResult, **kwargs) -> "HitReconstructor":
+		""" build a reconstructor from the last map in a COSY run, taking the flight time from the length of the
+			central ray if COSY printed it
+		"""
+		if "flight_time" not in kwargs and isfinite(result.central_ray_length):
+			kwargs["flight_time"] = result.central_ray_length/calculate_velocity(0)
+		return cls(COSY_Matrix.from_result(result), **kwargs)
+
+	def central_ray(self, d_energy: NDArray[float]) -> Tuple[NDArray[float], NDArray[float]]:
+		""" trace rays that start on axis at some energies
+			returns: where they hit the detector (m) and how much later than the reference particle (s)
+		"""
+		rays = np.zeros((np.size(d_energy), 6))
+		rays[:, 5] = d_energy
+		return self.hits(rays)
+
+	def hits(self, rays: NDArray[float]) -> Tuple[NDArray[float], NDArray[float]]:
+		""" trace some rays all the way to the detector
+			:param rays: an (n_rays × 6) array of initial coordinates in COSY's units
+			returns: where each hits the detector (m) and how much later than the reference particle (s)
+		"""
+		gamma = reference_gamma()
+		final = trace_rays(self.matrix, rays, self.fp_tilt)
+		return final[:, 0], -final[:, 4]*(1 + gamma)/(calculate_velocity(0)*gamma)
+
+	def forward(self, energies: NDArray[float], birth_times: NDArray[float], rays: Optional[NDArray[float]] = None
+	            ) -> Tuple[NDArray[float], NDArray[float]]:
+		""" the opposite of reconstruct: where and when deuterons born at some times with some energies hit the detector
+			:param energies: the energies (MeV)
+			:param birth_times: the times (s)
+			:param rays: where each one starts on the foil and which way it goes, as an (n × 4+) array of COSY
+			             coordinates; if this isn't given they all go along the central ray
+			returns: the positions (m) and times (s)
+		"""
+		initial = np.zeros((np.size(energies), 6))
+		if rays is not None:
+			initial[:, :4] = rays[:, :4]
+		initial[:, 5] = np.asarray(energies)/E0 - 1
+		positions, delays = self.hits(initial)
+		return positions, birth_times + self.flight_time + delays
+
+	def reconstruct(self, x: NDArray[float], t: NDArray[float], out: Optional[NDArray[float]] = None,
+	                chunk_size: int = CHUNK_SIZE) -> NDArray[float]:
+		""" work out the energy and birth time of each of a bunch of hits
+			:param x: the position of each hit (m)
+			:param t: the time of each hit (s)
+			:param out: an (n × 2) array in which to put the answer, if you don't want a new one
+			:param chunk_size: how many hits to do at a time; it's fastest when a chunk's temporary arrays fit in cache
+			returns: an (n × 2) array of the energies (MeV) and birth times (s).  hits that are off the end
+			         of the table (or exactly at its high end) get NaN for both.
+		"""
+		x, t = np.asarray(x, dtype=float), np.asarray(t, dtype=float)
+		if out is None:
+			out = np.empty((x.size, 2))
+		position = np.empty(min(chunk_size, x.size))
+		index = np.empty(position.size, dtype=np.intp)
+		for start in range(0, x.size, chunk_size):
+			size = min(chunk_size, x.size - start)
+			chunk_position, chunk_index = position[:size], index[:size]
+			energy, birth_time = out[start:start + size, 0], out[start:start + size, 1]
+			np.multiply(x[start:start + size], 1/self.x_step, out=chunk_position)
+			chunk_position += 1 - self.x_start/self.x_step
+			with np.errstate(invalid="ignore"):  # NaN positions go to some huge negative index, which is fine
+				chunk_index[:] = chunk_position
+			fraction = chunk_position
+			fraction -= chunk_index
+			rows = np.take(self.energy_table, chunk_index, axis=0, mode="clip")
+			np.multiply(rows[:, 1], fraction, out=energy)
+			energy += rows[:, 0]
+			rows = np.take(self.delay_table, chunk_index, axis=0, mode="clip")
+			np.multiply(rows[:, 1], fraction, out=birth_time)
+			birth_time += rows[:, 0]
+			np.subtract(t[start:start + size], birth_time, out=birth_time)
+		return out
+
+	def reconstruct_file(self, hit_filename: str, output_filename: str, chunk_size: int = CHUNK_SIZE) -> int:
+		""" reconstruct a list of hits that's too big to load all at once.  the hits are memory-mapped and done
+			a chunk at a time, and the answers go straight into another memory-mapped file.
+			:param hit_filename: a .npy file with an (n × 2) array of the positions (m) and times (s)
+			:param output_filename: the .npy file in which to put the (n × 2) energies (MeV) and birth times (s)
+			returns: the number of hits
+		"""
+		hits = np.load(hit_filename, mmap_mode="r")
+		if hits.ndim != 2 or hits.shape[1] != 2:
+			raise ValueError(f"I need an (n × 2) array of hits, not {hits.shape}")
+		output = np.lib.format.open_memmap(output_filename, mode="w+", dtype=float, shape=hits.shape)
+		for start in range(0, hits.shape[0], chunk_size):
+			chunk = np.array(hits[start:start + chunk_size], dtype=float)
+			self.reconstruct(chunk[:, 0], chunk[:, 1], output[start:start + chunk_size], chunk_size)
+		output.flush()
+		del output
+		return hits.shape[0]
+
+
+def random_rays(num_rays: int, rng: np.random.Generator, **geometry: float) -> NDArray[float]:
+	""" pick rays like the ones define_rays lays out, but at random: from a random point on the foil to a
+		random point on the aperture
+		:param geometry: any of the entries of GEOMETRY to change
+		returns: an (n_rays × 4) array of x, a, y, and b in COSY's units
+	"""
+	geometry = {**GEOMETRY, **geometry}
+	radius, angle = np.sqrt(rng.uniform(0, 1, num_rays)), rng.uniform(0, 2*pi, num_rays)
+	x_foil = geometry["foil_x_radius"]*radius*np.cos(angle)
+	y_foil = geometry["foil_y_radius"]*radius*np.sin(angle)
+	x_aperture = rng.uniform(-1, 1, num_rays)*geometry["aperture_half_width"]
+	y_aperture = rng.uniform(-1, 1, num_rays)*geometry["aperture_half_height"]
+	return np.stack([x_foil, (x_aperture - x_foil)/geometry["S0"],
+	                 y_foil, (y_aperture - y_foil)/geometry["S0"]], axis=1)
+
+
+def example_matrix() -> COSY_Matrix:
+	""" a made-up third-order spectrometer map with about the dispersion and time skew of MRSt, for when
+		there's no COSY output at hand
+	"""
+	terms = {  # the exponents of x, a, y, b, l, d and the coefficients of x, a, y, b, l
+		(1, 0, 0, 0, 0, 0): (-.6, -.8, 0, 0, .05),
+		(0, 1, 0, 0, 0, 0): (0, -1.6, 0, 0, .4),
+		(0, 0, 1, 0, 0, 0): (0, 0, -2., -.3, 0),
+		(0, 0, 0, 1, 0, 0): (0, 0, .5, -.4, 0),
+		(0, 0, 0, 0, 1, 0): (0, 0, 0, 0, 1.),
+		(0, 0, 0, 0, 0, 1): (1.2, .3, 0, 0, -.7),
+		(0, 1, 0, 0, 0, 1): (.5, .2, 0, 0, .1),
+		(0, 0, 0, 0, 0, 2): (-.4, .1, 0, 0, .3),
+		(0, 2, 0, 0, 0, 0): (3., 1., 0, 0, -2.),
+		(0, 0, 0, 2, 0, 0): (1., .5, 0, 0, -1.),
+		(0, 0, 0, 0, 0, 3): (.2, 0, 0, 0, -.1),
+	}
+	exponents = np.zeros((len(terms), 9), dtype=int)
+	exponents[:, :6] = list(terms.keys())
+	return COSY_Matrix.from_arrays(exponents, np.array(list(terms.values())))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="check how accurately and how fast the hits from the forward map get turned back into "
+		            "energies and birth times")
+	parser.add_argument("output", nargs="?", help="a file of COSY's stdout with the map in it (by default "
+	                                              "it uses a made-up map)")
+	parser.add_argument("--hits", type=int, default=10**6, help="how many hits to check the accuracy with")
+	parser.add_argument("--repeat", type=int, default=20,
+	                    help="how many copies of those hits to reconstruct when timing it")
+	parser.add_argument("--chunk-size", type=int, default=CHUNK_SIZE, help="how many hits to do at a time")
+	args = parser.parse_args()
+
+	if args.output is not None:
+		with open(args.output, "r") as file:
+			reconstructor = HitReconstructor.from_result(parse_cosy_output(file.read()))
+	else:
+		reconstructor = HitReconstructor(example_matrix(), flight_time=20e-9)
+	rng = np.random.default_rng(0)
+	energies = rng.uniform(E0 - SPECTRAL_RANGE/2, E0 + SPECTRAL_RANGE/2, args.hits)
+	birth_times = rng.uniform(0, 1e-9, args.hits)
+
+	# the central ray shows how much error the table adds; the full spread shows the error you'd actually get
+	print(f"{'':20s} {'energy (keV)':>24s} {'birth time (ps)':>24s}")
+	print(f"{'':20s} {'mean':>11s} {'RMS':>12s} {'mean':>11s} {'RMS':>12s} {'off the table':>14s}")
+	for label, rays in [("central ray", None), ("foil and aperture", random_rays(args.hits, rng))]:
+		x, t = reconstructor.forward(energies, birth_times, rays)
+		reconstructed = reconstructor.reconstruct(x, t)
+		found = np.isfinite(reconstructed[:, 0])  # the spread can push hits at either end off of the table
+		energy_error = (reconstructed[found, 0] - energies[found])*1e3
+		time_error = (reconstructed[found, 1] - birth_times[found])*1e12
+		print(f"{label:20s} {np.mean(energy_error):11.3g} {np.sqrt(np.mean(energy_error**2)):12.3g} "
+		      f"{np.mean(time_error):11.3g} {np.sqrt(np.mean(time_error**2)):12.3g} {np.mean(~found):14.2%}")
+
+	hits = np.tile(np.stack([x, t], axis=1), (args.repeat, 1))
+	start = time.perf_counter()
+	reconstructor.reconstruct(hits[:, 0], hits[:, 1], chunk_size=args.chunk_size)
+	in_memory = time.perf_counter() - start
+	start = time.perf_counter()
+	reconstructor.forward(energies, birth_times)
+	forward = time.perf_counter() - start
+	with tempfile.TemporaryDirectory() as directory:
+		hit_filename, output_filename = os.path.join(directory, "hits.npy"), os.path.join(directory, "output.npy")
+		np.save(hit_filename, hits)
+		start = time.perf_counter()
+		reconstructor.reconstruct_file(hit_filename, output_filename, args.chunk_size)
+		from_file = time.perf_counter() - start
+	print(f"forward map:             {args.hits/forward/1e6:6.1f} million hits/s")
+	print(f"reconstruction:          {hits.shape[0]/in_memory/1e6:6.1f} million hits/s")
+	print(f"reconstruction (files):  {hits.shape[0]/from_file/1e6:6.1f} million hits/s")
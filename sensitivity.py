@@ -0,0 +1,81 @@
+from typing import Callable, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+BatchFunction = Callable[[NDArray[float]], NDArray[float]]
+
+
+def build_stencil(x0: NDArray[float], steps: NDArray[float], offsets: Sequence[float] = (-1, 1)
+                  ) -> Tuple[NDArray[float], NDArray[int]]:
+	""" lay out every point needed to take finite differences of each parameter about x0
+		:param x0: the base parameters
+		:param steps: the step size for each parameter
+		:param offsets: the multiples of the step size at which to sample each parameter (0 is always added)
+		returns: the unique points to evaluate, as a (number of points, number of parameters) array, and
+		         a (number of parameters, number of offsets + 1) array of indices into those points, where
+		         column 0 is the baseline and the rest follow `offsets`
+	"""
+	x0 = np.asarray(x0, dtype=float)
+	steps = np.asarray(steps, dtype=float)
+	offsets = np.concatenate([[0], offsets])
+	points = np.tile(x0, (x0.size, offsets.size, 1))
+	for i in range(x0.size):
+		points[i, :, i] += offsets*steps[i]
+	# the baseline shows up once per parameter, and zero steps make more duplicates, so collapse them
+	unique_points, index = np.unique(points.reshape((-1, x0.size)), axis=0, return_inverse=True)
+	return unique_points, index.reshape((x0.size, offsets.size))
+
+
+def compute_sensitivities(get_values_batch: BatchFunction, x0: NDArray[float], steps: NDArray[float],
+                          offsets: Sequence[float] = (-1, 1), filename: Optional[str] = None
+                          ) -> Tuple[NDArray[float], NDArray[float], NDArray[float], NDArray[float]]:
+	""" evaluate the whole finite-difference stencil as a single batch and turn it into derivatives.
+		the first and second derivatives always come from the ±1 step points.
+		:param get_values_batch: a function that takes a (number of points, number of parameters) array and
+		                         returns the (number of points, number of observables) array of observables
+		:param x0: the base parameters
+		:param steps: the step size for each parameter
+		:param offsets: the multiples of the step size at which to sample each parameter.  must include ±1.
+		:param filename: if given, load the results from this .npz file if it matches, and save them there otherwise
+		returns: the baseline observables, the (parameters × observables) Jacobian, the (parameters × observables)
+		         second derivatives, and the (parameters × offsets × observables) observables at each stencil point
+	"""
+	x0 = np.asarray(x0, dtype=float)
+	steps = np.asarray(steps, dtype=float)
+	offsets = np.asarray(offsets, dtype=float)
+	if filename is not None:
+		saved = load_sensitivities(filename, x0, steps, offsets)
+		if saved is not None:
+			return saved
+
+	points, index = build_stencil(x0, steps, offsets)
+	values = np.asarray(get_values_batch(points), dtype=float)
+	y0 = values[index[0, 0]]
+	responses = values[index[:, 1:]]
+
+	plus, minus = np.nonzero(offsets == 1)[0][0], np.nonzero(offsets == -1)[0][0]
+	with np.errstate(divide="ignore", invalid="ignore"):
+		jacobian = (responses[:, plus, :] - responses[:, minus, :])/(2*steps[:, np.newaxis])
+		second_derivatives = (responses[:, plus, :] - 2*y0 + responses[:, minus, :])/steps[:, np.newaxis]**2
+
+	if filename is not None:
+		np.savez(filename, x0=x0, steps=steps, offsets=offsets, y0=y0, jacobian=jacobian,
+		         second_derivatives=second_derivatives, responses=responses)
+	return y0, jacobian, second_derivatives, responses
+
+
+def load_sensitivities(filename: str, x0: NDArray[float], steps: NDArray[float], offsets: NDArray[float]
+                       ) -> Optional[Tuple[NDArray[float], NDArray[float], NDArray[float], NDArray[float]]]:
+	""" load some saved sensitivities, as long as they were computed with the same stencil.
+		returns: the same things as compute_sensitivities, or None if there's no matching file
+	"""
+	try:
+		saved = np.load(filename)
+	except FileNotFoundError:
+		return None
+	if saved["x0"].shape != x0.shape or saved["offsets"].shape != offsets.shape or \
+			not np.array_equal(saved["x0"], x0) or not np.array_equal(saved["steps"], steps) or \
+			not np.array_equal(saved["offsets"], offsets):
+		return None
+	return saved["y0"], saved["jacobian"], saved["second_derivatives"], saved["responses"]
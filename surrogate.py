@@ -0,0 +1,68 @@
+from typing import Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+from scipy import linalg
+
+
+class GaussianProcess:
+	""" a Gaussian-process regression model with a squared-exponential kernel, for standing in for
+		COSY when we already know the answer at a bunch of nearby points.  the inputs are rescaled to
+		the unit hypercube using the given bounds, and the length scale is picked by maximizing the
+		marginal likelihood over a small grid, which is plenty for the few hundred points we ever have.
+	"""
+	LENGTH_SCALES = [0.05, 0.1, 0.2, 0.4, 0.8, 1.6]
+
+	def __init__(self, bounds: Sequence[Tuple[float, float]], noise: float = 1e-6):
+		self.lower = np.array([low for low, high in bounds], dtype=float)
+		self.width = np.array([high - low for low, high in bounds], dtype=float)
+		self.noise = noise
+		self.length_scale = None
+		self.X = None
+		self.y_mean = 0.
+		self.y_scale = 1.
+		self.cholesky = None
+		self.alpha = None
+
+	def normalize(self, X: NDArray[float]) -> NDArray[float]:
+		return (np.atleast_2d(X) - self.lower)/self.width
+
+	def kernel(self, A: NDArray[float], B: NDArray[float], length_scale: float) -> NDArray[float]:
+		squared_distance = np.sum(A**2, axis=1)[:, np.newaxis] + np.sum(B**2, axis=1)[np.newaxis, :] - 2*A@B.T
+		squared_distance = np.maximum(squared_distance, 0)
+		return np.exp(-squared_distance/(2*length_scale**2))
+
+	def fit(self, X: NDArray[float], y: NDArray[float]) -> "GaussianProcess":
+		""" train the model on some points where we know the true value """
+		self.X = self.normalize(X)
+		y = np.asarray(y, dtype=float)
+		self.y_mean = np.mean(y)
+		self.y_scale = np.std(y) if np.std(y) > 0 else 1.
+		y = (y - self.y_mean)/self.y_scale
+
+		best_likelihood = -np.inf
+		for length_scale in GaussianProcess.LENGTH_SCALES:
+			K = self.kernel(self.X, self.X, length_scale) + self.noise*np.identity(len(y))
+			try:
+				cholesky = linalg.cholesky(K, lower=True)
+			except linalg.LinAlgError:
+				continue
+			alpha = linalg.cho_solve((cholesky, True), y)
+			likelihood = -y@alpha/2 - np.sum(np.log(np.diag(cholesky)))
+			if likelihood > best_likelihood:
+				best_likelihood = likelihood
+				self.length_scale, self.cholesky, self.alpha = length_scale, cholesky, alpha
+		if self.cholesky is None:
+			raise ValueError("the training points are too degenerate to fit a Gaussian process to")
+		return self
+
+	def predict(self, X: NDArray[float]) -> Tuple[NDArray[float], NDArray[float]]:
+		""" estimate the value at some new points.
+			returns: the posterior mean and standard deviation at each point
+		"""
+		X = self.normalize(X)
+		K_cross = self.kernel(X, self.X, self.length_scale)
+		mean = K_cross@self.alpha
+		v = linalg.solve_triangular(self.cholesky, K_cross.T, lower=True)
+		variance = np.maximum(1 + self.noise - np.sum(v**2, axis=0), 0)
+		return self.y_mean + self.y_scale*mean, self.y_scale*np.sqrt(variance)
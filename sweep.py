@@ -0,0 +1,194 @@
+import argparse
+import csv
+import hashlib
+import json
+import os
+import re
+import shlex
+from concurrent.futures import as_completed
+from dataclasses import dataclass
+from itertools import zip_longest
+from typing import Any, Dict, List, Optional, Sequence
+
+from cosy_output import CosyResult, parse_cosy_output
+from cosy_pool import CosyPool
+from evaluation_store import EvaluationStore, hash_script, make_key
+from fox_template import FoxTemplate
+import instrumentation
+
+COSY_EXECUTABLE = "cosy"
+STORE_FILENAME = "sweep.sqlite"
+LIBRARY_FILENAME = "COSY.bin"  # the compiled library every run loads; any change to it invalidates every stored result
+SETUP_STATEMENT = re.compile(r"^([ \t]*OV\s+)(\w+)", re.MULTILINE)
+
+
+@dataclass
+class SweepPoint:
+	""" one COSY run in a sweep: a design at some order with some of its assignments changed """
+	design: str
+	order: int
+	overrides: Dict[str, float]
+	script: str
+	key: str
+	result: Optional[CosyResult] = None
+
+	@property
+	def label(self) -> str:
+		settings = "".join(f", {name}={value:g}" for name, value in self.overrides.items())
+		return f"{self.design} (order {self.order}{settings})"
+
+
+class Design:
+	""" one .fox file in a sweep, picked apart so that its order and any of its numeric assignments can be
+		changed.  if the order is written right into the OV call it becomes a placeholder; otherwise the OV
+		call names a variable (like order in MRSt_OMEGA.fox), and that variable's assignment gets changed.
+	"""
+	def __init__(self, filename: str, names: Sequence[str], name: Optional[str] = None):
+		""" :param names: the assignments that will be changed at some point in the sweep
+			:param name: what to call it in the table (defaults to the filename minus the extension)
+		"""
+		with open(filename, "r") as f:
+			script = f.read()
+		self.name = name if name is not None else os.path.splitext(os.path.basename(filename))[0]
+		setup = SETUP_STATEMENT.search(script)
+		if setup is None:
+			raise ValueError(f"there's no OV call in {filename}")
+		if setup.group(2).isdigit():
+			self.order_name = "order"
+			script = script[:setup.start(2)] + f"<<{self.order_name}>>" + script[setup.end(2):]
+			self.template = FoxTemplate(script, list(names) + [self.order_name])
+			self.default_order = int(setup.group(2))
+		else:
+			self.order_name = setup.group(2)
+			self.template = FoxTemplate(script, list(names) + [self.order_name])
+			self.default_order = int(self.template.defaults[self.order_name])
+
+	def render(self, overrides: Dict[str, float], order: int) -> str:
+		""" write out the script with these assignments changed, at this order """
+		return self.template.render({**self.template.defaults, **overrides, self.order_name: order})
+
+
+def plan_sweep(manifest: Dict[str, Any], directory: str = ".", library: str = "") -> List[List[SweepPoint]]:
+	""" lay out every run that a manifest calls for.  the manifest has a list of "designs", each of which has
+		a "file" and can have a "name", a list of "orders", and a list of "overrides" (dicts of assignments
+		to change; one run per dict per order).  an "orders" list at the top level applies to every design
+		that doesn't have its own, and any that has neither runs at whatever order its file says.
+		:param directory: the directory that the design files are relative to
+		:param library: the hash of COSY.bin, which goes into every run's key
+		returns: the runs for each design
+	"""
+	plans = []
+	for entry in manifest["designs"]:
+		override_sets = entry.get("overrides", [{}])
+		names = sorted({name for overrides in override_sets for name in overrides})
+		design = Design(os.path.join(directory, entry["file"]), names, entry.get("name"))
+		orders = entry.get("orders", manifest.get("orders", [design.default_order]))
+		points = []
+		for order in orders:
+			for overrides in override_sets:
+				script = design.render(overrides, order)
+				points.append(SweepPoint(design.name, order, dict(overrides), script,
+				                         make_key(hash_script(library + script), order, [])))
+		plans.append(points)
+	return plans
+
+
+def interleave(plans: List[List[SweepPoint]]) -> List[SweepPoint]:
+	""" put the runs in round-robin order, one from each design at a time, so that every design moves along
+		at the same rate and one with a lot of runs can't hold up the rest
+	"""
+	return [point for group in zip_longest(*plans) for point in group if point is not None]
+
+
+def run_sweep(points: Sequence[SweepPoint], pool: CosyPool, store: EvaluationStore) -> None:
+	""" fill in the result of every point, taking whatever's already in the store and running the rest.
+		everything is submitted to the pool at once, in order, so no worker sits idle until the very end,
+		and each result gets stored as soon as it comes in, so an interrupted sweep picks up where it left off.
+	"""
+	results = store.get_many([point.key for point in points])
+	instrumentation.record("sweep", [{"cached": True}]*len(results))
+	to_run = {}
+	for point in points:
+		if point.key not in results and point.key not in to_run:
+			to_run[point.key] = point
+	print(f"{len(points)} runs: {len(points) - len(to_run)} already done and {len(to_run)} to go")
+
+	futures = {pool.submit(point.script): point for point in to_run.values()}
+	for num_done, future in enumerate(as_completed(futures)):
+		point = futures[future]
+		output, timings = future.result()
+		result = parse_cosy_output(output)
+		if not result.failed:
+			store.put(point.key, hash_script(point.script), point.order, list(point.overrides.values()), result)
+		instrumentation.record("sweep", [{**timings, "cached": False, "failed": result.failed}])
+		results[point.key] = result
+		status = f"failed: {result.errors[0]}" if result.failed else f"done in {timings['subprocess']:.1f} s"
+		print(f"[{num_done + 1}/{len(to_run)}] {point.label} {status}")
+
+	for point in points:
+		point.result = results[point.key]
+
+
+def comparison_table(points: Sequence[SweepPoint], observables: Sequence[str] = ()) -> List[List[str]]:
+	""" line up the FPDESIGN figures of every point (plus any other observables you name), one row per point.
+		anything a run didn't print is left blank.
+		returns: the header and then the rows, all as text
+	"""
+	names = []
+	for point in points:
+		for name in point.result.fpdesign:
+			if name not in names:
+				names.append(name)
+	columns = [f"FPDESIGN {name}" for name in names] + list(observables)
+	table = [["design", "order", "overrides"] + columns]
+	for point in points:
+		values = point.result.observables
+		settings = " ".join(f"{name}={value:g}" for name, value in point.overrides.items())
+		row = [point.design, str(point.order), settings if not point.result.failed else f"{settings} (failed)".strip()]
+		row += [f"{values[column]:.6g}" if column in values else "" for column in columns]
+		table.append(row)
+	return table
+
+
+def print_table(table: List[List[str]]) -> None:
+	widths = [max(len(row[k]) for row in table) for k in range(len(table[0]))]
+	for row in table:
+		print("  ".join(cell.ljust(width) if k < 3 else cell.rjust(width)
+		                for k, (cell, width) in enumerate(zip(row, widths))))
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(
+		description="run every design in a manifest at every order and setting it lists, on one shared pool of "
+		            "COSY workers, and compare their focal plane designs")
+	parser.add_argument("manifest", help="the JSON file that lists the designs (see plan_sweep)")
+	parser.add_argument("--executable", default=COSY_EXECUTABLE,
+	                    help="the command that runs COSY, which can include arguments (like 'python fake_cosy.py')")
+	parser.add_argument("--workers", type=int, default=os.cpu_count(), help="how many COSY processes to run at once")
+	parser.add_argument("--store", default=STORE_FILENAME, help="the SQLite file in which to keep the results")
+	parser.add_argument("--timeout", type=float, help="how long a run can go before it's killed, in seconds")
+	parser.add_argument("--csv", help="a file to which to save the comparison table")
+	args = parser.parse_args()
+
+	with open(args.manifest, "r") as file:
+		manifest = json.load(file)
+	library = ""
+	if os.path.isfile(LIBRARY_FILENAME):
+		# hash the compiled library rather than cosy.fox, since that's what the runs actually load
+		with open(LIBRARY_FILENAME, "rb") as file:
+			library = hashlib.sha256(file.read()).hexdigest()
+		if os.path.isfile("cosy.fox") and os.path.getmtime("cosy.fox") > os.path.getmtime(LIBRARY_FILENAME):
+			print(f"warning: cosy.fox has changed since {LIBRARY_FILENAME} was compiled, so the runs won't see that change")
+	plans = plan_sweep(manifest, os.path.dirname(os.path.abspath(args.manifest)), library)
+
+	store = EvaluationStore(args.store)
+	with CosyPool(shlex.split(args.executable), args.workers, timeout=args.timeout) as pool:
+		run_sweep(interleave(plans), pool, store)
+	store.close()
+
+	table = comparison_table([point for points in plans for point in points], manifest.get("observables", []))
+	print()
+	print_table(table)
+	if args.csv is not None:
+		with open(args.csv, "w", newline="") as file:
+			csv.writer(file).writerows(table)
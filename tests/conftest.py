@@ -0,0 +1,23 @@
+import os
+import sys
+
+import pytest
+
+# the modules all live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+FIXTURE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fixtures")
+
+
+@pytest.fixture
+def read_fixture():
+	""" a function that reads a file from tests/fixtures.  some of them have to be made by running COSY (the README
+		in there says how), so a test that needs one of those gets skipped until it's been made.
+	"""
+	def read(filename: str) -> str:
+		path = os.path.join(FIXTURE_DIRECTORY, filename)
+		if not os.path.isfile(path):
+			pytest.skip(f"{filename} hasn't been made yet (see tests/fixtures/README.md)")
+		with open(path, "r") as file:
+			return file.read()
+	return read
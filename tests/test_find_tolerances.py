@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+import pytest
+
+SLOPES = np.array([.1, 0, 0, .01, 0, 0])  # how the observables respond to the first parameter (HO Resol. and Plane Length)
+Y0 = np.array([100., 40., 10., .35, 60., 0.])
+TOLERANCES = {1: 2., -1: 3.}  # where those two run out of room in each direction
+
+
+@pytest.fixture
+def ft(monkeypatch):
+	""" find_tolerances, with the tolerance script loaded from the top of the repository """
+	monkeypatch.chdir(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+	import find_tolerances
+	return find_tolerances
+
+
+def bounds(ft):
+	y_min = np.array([y + lo for y, (_, lo, _, _) in zip(Y0, ft.OBSERVABLES)])
+	y_max = np.array([y + hi for y, (_, _, hi, _) in zip(Y0, ft.OBSERVABLES)])
+	return y_min, y_max
+
+
+def linear_model(failed):
+	""" a stand-in for get_values_batch where the observables are linear in the first parameter, except at the
+		points where failed says COSY crashed
+	"""
+	def get_values_batch(Xs):
+		values = []
+		for X in Xs:
+			if failed(X[0]):
+				values.append(np.full(Y0.size, np.nan))
+			else:
+				values.append(Y0 + X[0]*SLOPES)
+		return np.array(values)
+	return get_values_batch
+
+
+def search(ft, monkeypatch, failed):
+	monkeypatch.setattr(ft, "get_values_batch", linear_model(failed))
+	y_min, y_max = bounds(ft)
+	return ft.find_tolerances([(0, ft.MAX_TOLERANCE), (0, -ft.MAX_TOLERANCE)], y_min, y_max, Y0, np.outer(
+		np.eye(len(ft.PARAMETERS))[0], SLOPES))
+
+
+def test_tolerances_without_failures(ft, monkeypatch):
+	tolerances = search(ft, monkeypatch, lambda x: False)
+	for tolerance, sign in zip(tolerances, [1, -1]):
+		assert TOLERANCES[sign]*(1 - ft.FINNESS) <= tolerance <= TOLERANCES[sign]*(1 + 1e-12)  # (the roundoff can go either way right at the edge)
+
+
+def test_failed_runs_are_out_of_bounds(ft, monkeypatch):
+	# every run past 1.5 in either direction fails, so that's where the tolerance ends up
+	tolerances = search(ft, monkeypatch, lambda x: abs(x) > 1.5)
+	assert np.all(np.isfinite(tolerances))
+	for tolerance in tolerances:
+		assert 1.5*(1 - ft.FINNESS) <= tolerance <= 1.5
+
+
+def test_scattered_failures(ft, monkeypatch):
+	rng = np.random.default_rng(0)
+	for rate in [.3, .8, 1.]:
+		tolerances = search(ft, monkeypatch, lambda x: rng.random() < rate)
+		assert np.all(np.isfinite(tolerances))
+		for tolerance, sign in zip(tolerances, [1, -1]):
+			assert 0 <= tolerance <= TOLERANCES[sign]*(1 + 1e-12)  # (the roundoff can go either way right at the edge)
@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from grid_scan import polish_root
+
+TARGETS = [(0, 1.), (1, .5)]
+
+
+def cubic(failed):
+	""" a stand-in for COSY whose first output is the cube of the first parameter and whose second output is the
+		second parameter, except at the points where failed says it crashed
+	"""
+	def evaluate_batch(X):
+		return np.array([[np.nan, np.nan] if failed(x) else [x[0]**3, x[1]] for x in X])
+	return evaluate_batch
+
+
+def test_polish_root():
+	root, y = polish_root(cubic(lambda x: False), [.5, .3], TARGETS, [1e-3, 1e-3], [1e-6, 1e-6])
+	np.testing.assert_allclose(root, [1, .5], atol=1e-6)
+
+
+def test_polish_root_backs_off_from_failures():
+	# the first Newton step overshoots to 1.67, and the second parameter's neighbor always fails
+	failed = lambda x: x[0] > 1.3 or x[1] > .5
+	root, y = polish_root(cubic(failed), [.5, .5], TARGETS, [1e-3, 1e-3], [1e-6, 1e-6])
+	assert np.all(np.isfinite(y))
+	np.testing.assert_allclose(root, [1, .5], atol=1e-6)
+
+
+def test_polish_root_cant_start_from_a_failure():
+	with pytest.raises(ValueError, match="COSY fails there"):
+		polish_root(cubic(lambda x: True), [.5, .5], TARGETS, [1e-3, 1e-3], [1e-6, 1e-6])
@@ -0,0 +1,95 @@
+import numpy as np
+import pytest
+
+from map_algebra import TransferMap, exact_drift
+from visualize import COSY_Matrix
+
+
+def load_map(text: str) -> TransferMap:
+	return TransferMap.from_matrix(COSY_Matrix(text))
+
+
+def rows(matrix: COSY_Matrix) -> dict:
+	""" the coefficients of each term, keyed by the exponents of the coordinates (COSY pads them with zeros) """
+	return {tuple(exponents[:6]): coefficients for exponents, coefficients in zip(matrix.exponents, matrix.cosy_coefficients)}
+
+
+def assert_maps_close(actual: TransferMap, expected: TransferMap, rtol: float, scale: float = None) -> None:
+	""" compare two maps coefficient by coefficient, to within rtol of the biggest coefficient in each output
+		(or of some other scale, if the expected map's coefficients say nothing about how big the errors can get)
+	"""
+	assert actual.coefficients.shape == expected.coefficients.shape
+	if scale is None:
+		scale = np.max(np.abs(expected.coefficients), axis=0)
+	error = np.max(np.abs(actual.coefficients - expected.coefficients), axis=0)
+	assert np.all(error <= rtol*scale), f"the maps differ by up to {error/scale} relative to each output's biggest coefficient"
+
+
+@pytest.fixture
+def cosy_map(read_fixture) -> TransferMap:
+	""" a 3rd-order map that COSY printed """
+	return load_map(read_fixture("map_order3.txt"))
+
+
+def test_matrix_round_trip(read_fixture):
+	matrix = COSY_Matrix(read_fixture("map_order3.txt"))
+	round_trip = TransferMap.from_matrix(matrix).to_matrix()
+	expected = {term: coefficients for term, coefficients in rows(matrix).items() if np.any(coefficients != 0)}
+	actual = rows(round_trip)
+	assert actual.keys() == expected.keys()
+	for term in expected:
+		np.testing.assert_array_equal(actual[term], expected[term])
+
+
+def test_inverse_undoes_the_map(cosy_map):
+	identity = TransferMap.identity(cosy_map.order, cosy_map.num_variables)
+	inverse = cosy_map.inverse()
+	scale = np.max(np.abs(cosy_map.coefficients))  # the roundoff scales with the biggest aberrations
+	assert_maps_close(cosy_map@inverse, identity, 1e-12, scale)
+	assert_maps_close(inverse@cosy_map, identity, 1e-12, scale)
+
+
+def test_composition_matches_one_map_at_a_time(cosy_map):
+	drift = TransferMap.drift(.3, cosy_map.order, cosy_map.num_variables)
+	rays = np.zeros((1000, cosy_map.num_variables))
+	# small enough that the 4th-order terms the composed map leaves out don't matter
+	rays[:, :6] = np.random.default_rng(0).normal(0, [1e-5, 1e-5, 1e-5, 1e-5, 0, 1e-4], (1000, 6))
+	one_at_a_time = cosy_map.evaluate(drift.evaluate(rays))
+	np.testing.assert_allclose(drift.then(cosy_map).evaluate(rays), one_at_a_time,
+	                           rtol=0, atol=1e-6*np.max(np.abs(one_at_a_time)))
+
+
+def test_drift_series_matches_exact_drift():
+	rays = np.zeros((1000, 6))
+	rays[:, :6] = np.random.default_rng(1).normal(0, [1e-4, 1e-4, 1e-4, 1e-4, 0, 1e-3], (1000, 6))
+	np.testing.assert_allclose(TransferMap.drift(.3, 3).evaluate(rays), exact_drift(rays, .3), rtol=0, atol=1e-10)
+
+
+def test_drifts_add_up():
+	assert_maps_close(TransferMap.drift(.3, 3)@TransferMap.drift(.45, 3), TransferMap.drift(.75, 3), 1e-12)
+
+
+def test_shifting_a_drift_does_nothing():
+	drift = TransferMap.drift(.3, 3)
+	assert_maps_close(drift.misaligned(1e-4, -2e-4), drift, 1e-12)
+
+
+# the rest need the maps that map_checks.fox makes.  COSY prints 7 significant figures, so that's about as
+# close as they can match.
+
+def test_drift_matches_cosy(read_fixture):
+	cosy_drift = load_map(read_fixture("map_checks_drift.txt"))
+	assert_maps_close(TransferMap.drift(.75, cosy_drift.order), cosy_drift, 1e-6)
+
+
+def test_composition_matches_cosy(read_fixture):
+	beamline = load_map(read_fixture("map_checks_map.txt"))
+	middle = load_map(read_fixture("map_checks_middle.txt"))
+	composed = TransferMap.drift(.6, middle.order).then(middle).then(TransferMap.drift(.3, middle.order))
+	assert_maps_close(composed, beamline, 1e-5)
+
+
+def test_inverse_matches_cosy(read_fixture):
+	beamline = load_map(read_fixture("map_checks_map.txt"))
+	cosy_inverse = load_map(read_fixture("map_checks_inverse.txt"))
+	assert_maps_close(beamline.inverse(), cosy_inverse, 1e-5)
@@ -0,0 +1,41 @@
+import pytest
+
+from cosy_output import parse_cosy_output
+from map_tracing import compare_to_cosy, map_design
+from visualize import COSY_Matrix
+
+# how close each observable from the map has to come to what COSY reported, as (relative, absolute).  COSY
+# prints the map to 7 significant figures and the observables to 5 decimal places, and the p-dist is the
+# difference of two nearly equal numbers, so it gets more room.
+TOLERANCES = {
+	"FPDESIGN Tilt Angle(deg)": (1e-4, 1e-4),
+	"FPDESIGN Curv.Radius(m)": (1e-3, 1e-5),
+	"FPDESIGN p-dist(mm)": (1e-3, 1e-3),
+	"FPDESIGN Plane Length(m)": (1e-4, 1e-5),
+	"FPDESIGN HO Resol.RAY(keV)": (1e-3, 1e-5),
+	"FPDESIGN Time Resol.(ps)": (1e-3, 1e-5),
+	"FPDESIGN y-Size(mm)": (1e-3, 1e-5),
+	"Dispersion (mm/keV)": (1e-4, 1e-5),
+	"Time skew (ps/keV)": (1e-3, 1e-5),
+}
+
+
+@pytest.fixture
+def full_run(read_fixture):
+	""" everything a full (not streamlined) MRSt_OMEGA run printed """
+	return parse_cosy_output(read_fixture("MRSt_OMEGA_full.txt"))
+
+
+def test_map_design_matches_cosy(full_run):
+	from_map = map_design(COSY_Matrix.from_result(full_run))
+	for key in ["FPDESIGN Tilt Angle(deg)", "FPDESIGN Curv.Radius(m)", "Dispersion (mm/keV)"]:
+		relative, absolute = TOLERANCES[key]
+		assert from_map[key] == pytest.approx(full_run.observables[key], rel=relative, abs=absolute), key
+
+
+def test_everything_matches_cosy(full_run):
+	comparison = compare_to_cosy(full_run)
+	assert set(TOLERANCES) <= set(comparison)
+	for key, (reported, from_map) in comparison.items():
+		relative, absolute = TOLERANCES[key]
+		assert from_map == pytest.approx(reported, rel=relative, abs=absolute), key
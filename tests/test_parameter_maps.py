@@ -0,0 +1,154 @@
+import re
+
+import numpy as np
+import pytest
+
+from cosy_output import CosyResult
+from fox_template import FoxTemplate
+from map_algebra import TransferMap, get_algebra
+from parameter_maps import ParametricMap, fix_parameters, parametric_script, plain_parameters
+from sensitivity import compute_sensitivities
+from visualize import COSY_Matrix
+
+SCRIPT = """
+PROCEDURE RUN;
+	OV 3 3 3;
+	RP 12.45 2.013553213 1;
+	UM;
+	DL 0.5+(<<shiftz>>);
+	SA -(<<shiftx>>) 0;
+	TA -(<<tiltx>>) 0; {the tilt goes into TA; this line has a ; in it}
+	MQ 0.1 0.2*<<strength>> 0.05;
+	TA (<<tiltx>>) 0;
+	SA (<<shiftx>>) 0;
+	DL 0.5-(<<shiftz>>);
+ENDPROCEDURE;
+RUN;
+END;
+"""
+VALUES = {"shiftz": "0.000000", "shiftx": "0.000000", "tiltx": "0.000000", "strength": "1.000000"}
+OBSERVABLES = ["FPDESIGN Tilt Angle(deg)", "FPDESIGN Curv.Radius(m)", "FPDESIGN HO Resol.RAY(keV)",
+               "FPDESIGN Time Resol.(ps)", "FPDESIGN y-Size(mm)", "FPDESIGN Plane Length(m)"]
+LENS_STRENGTH = 0.05  # the thin lens that the synthetic parametric maps put in front of the real one (1/m)
+
+
+def embed(matrix: COSY_Matrix, order: int, num_variables: int) -> TransferMap:
+	""" a map that COSY printed, as a map of more variables (which it doesn't depend on) """
+	result = TransferMap.identity(order, num_variables)
+	result.coefficients[:, :5] = 0
+	exponents = np.zeros((matrix.exponents.shape[0], num_variables), dtype=int)
+	exponents[:, :6] = matrix.exponents[:, :6]
+	result.coefficients[result.algebra.find(exponents), :5] = matrix.cosy_coefficients
+	return result
+
+
+def thin_lens(strength: float, order: int, num_variables: int, parameter: int = None) -> TransferMap:
+	""" a thin quadrupole, with its strength scaled by 1 plus one of the variables if there is one """
+	algebra = get_algebra(order, num_variables)
+	k = algebra.constant(strength)
+	if parameter is not None:
+		k = k + strength*algebra.variable(parameter)
+	lens = TransferMap.identity(order, num_variables)
+	lens.coefficients[:, 1] -= algebra.multiply(k, algebra.variable(0))
+	lens.coefficients[:, 3] += algebra.multiply(k, algebra.variable(2))
+	return lens
+
+
+def parametric_matrix(cosy_matrix: COSY_Matrix, order: int) -> COSY_Matrix:
+	""" the real map after a lens whose strength is a parameter, the way COSY would print it with OV order 3 3 1
+		(so the parameter is the 7th column after the 3 that MRSt_OMEGA.fox sets up)
+	"""
+	return (embed(cosy_matrix, order, 10)@thin_lens(LENS_STRENGTH, order, 10, parameter=9)).to_matrix()
+
+
+def direct_matrix(cosy_matrix: COSY_Matrix, x: float) -> COSY_Matrix:
+	""" the real map after a lens with its strength set to a number """
+	return (embed(cosy_matrix, 3, 6)@thin_lens(LENS_STRENGTH*(1 + x), 3, 6)).to_matrix()
+
+
+def unparametric_map(matrix: COSY_Matrix) -> ParametricMap:
+	return ParametricMap(CosyResult(map_exponents=matrix.exponents, map_coefficients=matrix.cosy_coefficients), 6, 0)
+
+
+def map_values(parametric_map: ParametricMap, Xs) -> np.ndarray:
+	return np.array([[parametric_map.map_observables(X)[key] for key in OBSERVABLES] for X in Xs])
+
+
+def coefficient_error(actual: COSY_Matrix, expected: COSY_Matrix, order: int) -> float:
+	""" the biggest difference between the two maps' terms up to this order, relative to the biggest term """
+	actual = TransferMap.from_matrix(actual, order)
+	expected = TransferMap.from_matrix(expected, order)
+	return np.max(np.abs(actual.coefficients - expected.coefficients))/np.max(np.abs(expected.coefficients))
+
+
+@pytest.fixture
+def template() -> FoxTemplate:
+	return FoxTemplate(SCRIPT, list(VALUES))
+
+
+@pytest.fixture
+def cosy_matrix(read_fixture) -> COSY_Matrix:
+	return COSY_Matrix(read_fixture("map_order3.txt"))
+
+
+def test_parametric_script_raises_the_order(template):
+	script, first_column, order = parametric_script(template, VALUES, {"shiftz": .01, "strength": .01})
+	assert re.search(r"OV 5 3 5;", script)
+	assert first_column == 9
+	assert order == 3
+	assert "DL 0.5+((0.000000+0.01*(PARA(4)-1)));" in script
+	assert "MQ 0.1 0.2*(1.000000+0.01*(PARA(5)-1)) 0.05;" in script
+
+
+def test_parametric_script_reads_a_named_order(template):
+	named = FoxTemplate(SCRIPT.replace("OV 3 3 3;", "order := 4;\n\tOV order 3 3;"), list(VALUES))
+	script, _, order = parametric_script(named, VALUES, {"shiftz": .01}, parameter_order=1)
+	assert order == 4
+	assert re.search(r"OV 5 3 4;", script)
+
+
+def test_tilts_cant_be_da_parameters(template):
+	assert plain_parameters(template, VALUES) == ["tiltx"]
+	with pytest.raises(ValueError, match="tiltx"):
+		parametric_script(template, VALUES, {"shiftx": .01, "tiltx": 1.})
+
+
+def test_fixed_parameters_match_the_map_at_those_values(cosy_matrix):
+	parametric = parametric_matrix(cosy_matrix, 5)
+	for x in [-.1, .1]:
+		expected = direct_matrix(cosy_matrix, x)
+		assert coefficient_error(fix_parameters(parametric, 9, [x], order=3), expected, 3) < 1e-6
+	# without the extra orders, the parameter's effect on the 3rd-order terms gets cut off
+	truncated = parametric_matrix(cosy_matrix, 3)
+	assert coefficient_error(fix_parameters(truncated, 9, [.1], order=3), direct_matrix(cosy_matrix, .1), 3) > 1e-4
+
+
+def test_sensitivities_match_the_finite_difference_stencil(cosy_matrix):
+	parametric = parametric_matrix(cosy_matrix, 5)
+	parametric_map = ParametricMap(CosyResult(map_exponents=parametric.exponents, map_coefficients=parametric.cosy_coefficients),
+	                               9, 1, order=3)
+	x0, steps = np.zeros(1), np.array([.1])
+	y0, slopes, curvatures, _ = compute_sensitivities(lambda Xs: map_values(parametric_map, Xs), x0, steps)
+	y0_direct, slopes_direct, curvatures_direct, _ = compute_sensitivities(
+		lambda Xs: np.concatenate([map_values(unparametric_map(direct_matrix(cosy_matrix, X[0])), [[]]) for X in Xs]),
+		x0, steps)
+	np.testing.assert_allclose(y0, y0_direct, rtol=1e-6)
+	np.testing.assert_allclose(slopes, slopes_direct, rtol=1e-3, atol=1e-6*np.max(np.abs(slopes_direct)))
+	np.testing.assert_allclose(curvatures, curvatures_direct, rtol=1e-2, atol=1e-4*np.max(np.abs(curvatures_direct)))
+
+
+# the rest need the maps that parametric_map.fox makes.  COSY prints 7 significant figures, so that's about as
+# close as they can match.
+
+def test_parametric_printout(read_fixture):
+	matrix = COSY_Matrix(read_fixture("parametric_map_map.txt"))
+	assert matrix.exponents.shape[1] == 7
+	assert np.max(np.sum(matrix.exponents, axis=1)) == 5
+	assert {1, 2} <= set(matrix.exponents[:, 6])
+
+
+def test_fixed_parameters_match_cosy(read_fixture):
+	parametric = COSY_Matrix(read_fixture("parametric_map_map.txt"))
+	for x, filename in [(-1, "parametric_map_minus.txt"), (1, "parametric_map_plus.txt")]:
+		expected = COSY_Matrix(read_fixture(filename))
+		assert coefficient_error(fix_parameters(parametric, 6, [x], order=3), expected, 3) < 1e-5
@@ -0,0 +1,102 @@
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import numpy as np
+from numpy.typing import NDArray
+
+PERCENTILES = [0.5, 2.5, 50, 97.5, 99.5]
+
+
+def sample_perturbations(tolerances: NDArray[float], distributions: Sequence[str], num_samples: int,
+                         rng: np.random.Generator) -> NDArray[float]:
+	""" draw random perturbation vectors, treating each tolerance according to its distribution:
+		"uniform" means anywhere in ±tol, "normal" means tol is two standard deviations,
+		and "corners" means exactly ±tol with a random sign.
+		returns: a (num_samples, number of parameters) array
+	"""
+	tolerances = np.asarray(tolerances, dtype=float)
+	samples = np.empty((num_samples, tolerances.size))
+	for i, (tolerance, distribution) in enumerate(zip(tolerances, distributions)):
+		if distribution == "uniform":
+			samples[:, i] = rng.uniform(-tolerance, tolerance, num_samples)
+		elif distribution == "normal":
+			samples[:, i] = rng.normal(0, tolerance/2, num_samples)
+		elif distribution == "corners":
+			samples[:, i] = tolerance*rng.choice([-1., 1.], num_samples)
+		else:
+			raise ValueError(f"I don't know the distribution '{distribution}'")
+	return samples
+
+
+def undefined_sensitivities(jacobian: NDArray[float], second_derivatives: Optional[NDArray[float]] = None
+                            ) -> NDArray[bool]:
+	""" find the sensitivities that couldn't be worked out (NaN where an observable was missing, or infinite
+		where a stencil point failed)
+		returns: a (parameters × observables) mask of the ones that aren't finite
+	"""
+	undefined = ~np.isfinite(jacobian)
+	if second_derivatives is not None:
+		undefined |= ~np.isfinite(second_derivatives)
+	return undefined
+
+
+def predict_values(X: NDArray[float], y0: NDArray[float], jacobian: NDArray[float],
+                   second_derivatives: Optional[NDArray[float]] = None) -> NDArray[float]:
+	""" estimate the observables at some perturbations using the local response model
+		y ≈ y0 + J·x + ½ H·x², where H only has the diagonal (unmixed) second derivatives.
+		any observable with an undefined sensitivity to any parameter comes out NaN, since there's no
+		telling how much that parameter moves it.
+	"""
+	undefined = undefined_sensitivities(jacobian, second_derivatives)
+	Y = y0 + X@np.where(undefined, 0, jacobian)
+	if second_derivatives is not None:
+		Y += (X**2)@np.where(undefined, 0, second_derivatives)/2
+	Y[..., np.any(undefined, axis=0)] = np.nan
+	return Y
+
+
+def monte_carlo_tolerances(y0: NDArray[float], jacobian: NDArray[float], second_derivatives: Optional[NDArray[float]],
+                           tolerances: NDArray[float], distributions: Sequence[str],
+                           y_min: NDArray[float], y_max: NDArray[float], checked: NDArray[bool],
+                           num_samples: int = 1_000_000, chunk_size: int = 100_000, seed: int = 0
+                           ) -> Dict[str, NDArray[float]]:
+	""" push a whole lot of random misalignments thru the response model and see how often things stay in bounds
+		:param checked: which observables count toward the overall yield (the others are assumed to get tuned out)
+		:param second_derivatives: the diagonal second derivatives, or None to use a purely linear model
+		returns: a dict with "yield" (the fraction of samples where each observable is in bounds),
+		         "total yield" (the fraction where all of the checked ones are), "percentiles"
+		         (the PERCENTILES of each observable, as a (percentiles × observables) array), and "undefined"
+		         (the (parameters × observables) mask from undefined_sensitivities).  the observables with any
+		         undefined sensitivities get NaN for their yield and percentiles and are left out of the total
+		         yield, so check that before believing it.
+	"""
+	undefined = undefined_sensitivities(jacobian, second_derivatives)
+	unpredictable = np.any(undefined, axis=0)
+	checked = np.asarray(checked) & ~unpredictable
+	rng = np.random.default_rng(seed)
+	values = np.empty((num_samples, y0.size), dtype=np.float32)
+	in_bounds = np.zeros(y0.size)
+	all_in_bounds = 0
+	for start in range(0, num_samples, chunk_size):
+		X = sample_perturbations(tolerances, distributions, min(chunk_size, num_samples - start), rng)
+		Y = predict_values(X, y0, jacobian, second_derivatives)
+		values[start:start + X.shape[0], :] = Y
+		acceptable = (Y >= y_min) & (Y <= y_max)
+		in_bounds += np.sum(acceptable, axis=0)
+		all_in_bounds += np.sum(np.all(acceptable[:, checked], axis=1))
+	return {
+		"yield": np.where(unpredictable, np.nan, in_bounds/num_samples),
+		"total yield": all_in_bounds/num_samples,
+		"percentiles": np.percentile(values, PERCENTILES, axis=0),
+		"undefined": undefined,
+	}
+
+
+def spot_check(get_values_batch: Callable[[NDArray[float]], NDArray[float]], y0: NDArray[float],
+               jacobian: NDArray[float], second_derivatives: Optional[NDArray[float]],
+               tolerances: NDArray[float], distributions: Sequence[str], num_points: int = 8, seed: int = 1
+               ) -> Tuple[NDArray[float], NDArray[float], NDArray[float]]:
+	""" run COSY at a few random samples to see how well the response model holds up
+		returns: the sampled perturbations, the model's predictions there, and COSY's actual values
+	"""
+	X = sample_perturbations(tolerances, distributions, num_points, np.random.default_rng(seed))
+	return X, predict_values(X, y0, jacobian, second_derivatives), np.asarray(get_values_batch(X))
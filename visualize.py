@@ -1,21 +1,21 @@
 from __future__ import annotations
 
-import re
 from math import sqrt
 
 import numpy as np
 from matplotlib import pyplot as plt
+from numpy.typing import NDArray
 from pint import UnitRegistry, Quantity
 
+from cosy_output import CosyResult, parse_cosy_lines
+
 ureg = UnitRegistry()
 
 
 def visualize(matrix: COSY_Matrix):
 	E = np.linspace(10.7, 14.2, 21)*ureg("MeV")
 	print(E)
-	x = np.zeros(E.size)*ureg("m")
-	for i, e in enumerate(E):
-		x[i] = matrix.value("x", [0*ureg("m"), 0*ureg("rad"), 0*ureg("m"), 0*ureg("rad"), 0*ureg("s"), e - E0])
+	x = matrix.value("x", [0*ureg("m"), 0*ureg("rad"), 0*ureg("m"), 0*ureg("rad"), 0*ureg("s"), E - E0])
 	print(x)
 	plt.plot(E.to("MeV").m, x.to("cm").m)
 	plt.xlabel("Energy (MeV)")
@@ -32,45 +32,148 @@ v0 = np.sqrt(2*E0/m0)
 ɣ = 1/sqrt(1 - v0**2/ureg.speed_of_light**2)
 cosy_coordinates = "xaybld"
 cosy_units = [ureg("m"), ureg("rad"), ureg("m"), ureg("rad"), -ureg("m")*(1 + ɣ)/(ɣ*v0), E0, m0, z0, ureg("")]
+cosy_scales = np.array([unit.to_base_units().magnitude for unit in cosy_units])  # the size of each COSY unit in SI
 
 class COSY_Matrix:
+	""" a transfer map, stored as an (n_terms × n_variables) array of exponents and an (n_terms × 5) array of
+		coefficients, so that it can be applied to whole ensembles of rays at once.  the coefficients are kept
+		both as COSY prints them (in its own units) and in SI; everything that goes in or out of evaluate() is SI.
+	"""
 	def __init__(self, printout: str):
-		self.rows: dict[tuple[int], tuple[Quantity]] = {}
-		for line in printout.splitlines():
-			blank_match = re.fullmatch(r"\s*", line)
-			row_match = re.fullmatch(r"\s*([0-9E.+-]+)\s+([0-9E.+-]+)\s+([0-9E.+-]+)\s+([0-9E.+-]+)\s+([0-9E.+-]+)\s+([0-9]{9})", line)
-			if blank_match:
-				pass
-			elif row_match:
-				input_index = []
-				input_unit = ureg("")
-				for i, numeral in enumerate(row_match.group(6)):
-					input_index.append(int(numeral))
-					input_unit *= cosy_units[i]**int(input_index[i])
-				coefficients = []
-				for i in range(5):
-					coefficient_unit = cosy_units[i]/input_unit
-					coefficients.append(float(row_match.group(1 + i))*coefficient_unit)
-				self.rows[tuple(input_index)] = tuple(coefficients)
-
-	def coefficient(self, output: str, inputs: str) -> float:
+		result = parse_cosy_lines(printout.splitlines())
+		if result.map_coefficients is None:
+			self._set_arrays(np.zeros((0, 9), dtype=int), np.zeros((0, 5)))
+		else:
+			self._set_arrays(result.map_exponents, result.map_coefficients)
+
+	@classmethod
+	def from_arrays(cls, exponents: NDArray[int], cosy_coefficients: NDArray[float]) -> COSY_Matrix:
+		""" build a matrix from the exponent codes and the coefficients in COSY's units """
+		matrix = cls.__new__(cls)
+		matrix._set_arrays(exponents, cosy_coefficients)
+		return matrix
+
+	@classmethod
+	def from_result(cls, result: CosyResult) -> COSY_Matrix:
+		""" build a matrix from the last map that was printed in a COSY run """
+		if result.map_coefficients is None:
+			raise ValueError("there's no map in this COSY output")
+		return cls.from_arrays(result.map_exponents, result.map_coefficients)
+
+	def _set_arrays(self, exponents: NDArray[int], cosy_coefficients: NDArray[float]) -> None:
+		self.exponents = np.asarray(exponents, dtype=int)
+		self.cosy_coefficients = np.asarray(cosy_coefficients, dtype=float)
+		scales = variable_scales(self.exponents.shape[1])
+		input_scales = np.prod(scales**self.exponents, axis=1)
+		self.coefficients = self.cosy_coefficients*cosy_scales[:5]/input_scales[:, np.newaxis]
+
+	@property
+	def rows(self) -> dict[tuple[int], tuple[Quantity]]:
+		""" the map as a dict from exponents to the coefficient of each output, with units """
+		return {tuple(exponents): tuple(self.coefficient(output, exponents) for output in cosy_coordinates[:5])
+		        for exponents in self.exponents}
+
+	def coefficient(self, output: str, inputs: str | tuple[int]) -> float:
 		output_index = cosy_coordinates.index(output)
-		input_index = [0]*9
-		for inpoot in inputs:
-			input_index[cosy_coordinates.index(inpoot)] += 1
-		if tuple(input_index) in self.rows:
-			return self.rows[tuple(input_index)][output_index]
+		if type(inputs) is str:
+			input_index = [0]*self.exponents.shape[1]
+			for inpoot in inputs:
+				input_index[cosy_coordinates.index(inpoot)] += 1
+		else:
+			input_index = list(inputs)
+		matches = np.nonzero(np.all(self.exponents == input_index, axis=1))[0]
+		if matches.size > 0:
+			input_unit = ureg("")
+			for unit, order in zip(cosy_units, input_index):
+				input_unit *= unit**int(order)
+			return self.cosy_coefficients[matches[0], output_index]*cosy_units[output_index]/input_unit
 		else:
 			return 0.
 
-	def value(self, output: str, inputs: list[Quantity]) -> float:
-		value = 0.*cosy_units[cosy_coordinates.index(output)]
-		for input_orders, coefficients in self.rows.items():
-			term = coefficients[cosy_coordinates.index(output)]
-			for coordinate, position, order in zip(cosy_coordinates, inputs, input_orders):
-				term *= position**order
-			value += term
-		return value
+	def value(self, output: str, inputs: list[Quantity]) -> Quantity:
+		""" apply the map to one ray, or to arrays of rays if the inputs are arrays (they get broadcast together) """
+		output_index = cosy_coordinates.index(output)
+		positions = np.broadcast_arrays(*[np.asarray(position.to_base_units().magnitude, dtype=float)
+		                                  for position in inputs])
+		shape = positions[0].shape
+		rays = np.stack([position.ravel() for position in positions], axis=1)
+		values = self.evaluate(rays, outputs=[output_index])[:, 0].reshape(shape)
+		return values*cosy_units[output_index].to_base_units().units
+
+	def evaluate(self, rays: NDArray[float], outputs: str | list[int] = "xaybl", chunk_size: int = 16384
+	             ) -> NDArray[float]:
+		""" push a whole ensemble of rays thru the map at once.
+			:param rays: an (n_rays × n_coordinates) array of initial coordinates in SI units (m, rad, s, J, ...).
+			             any coordinates past the end of each row are taken to be zero.
+			:param outputs: which of the final coordinates to calculate, by letter or index
+			:param chunk_size: how many rays to do at a time, which caps the memory usage
+			returns: an (n_rays × n_outputs) array of final coordinates in SI units
+		"""
+		output_indices = [cosy_coordinates.index(output) if type(output) is str else output for output in outputs]
+		rays = np.atleast_2d(np.asarray(rays, dtype=float))
+		num_variables = min(rays.shape[1], self.exponents.shape[1])
+		# work in COSY's units, where everything is order 1
+		values = self.evaluate_cosy(rays[:, :num_variables]/variable_scales(num_variables), output_indices, chunk_size)
+		return values*cosy_scales[output_indices]
+
+	def evaluate_cosy(self, rays: NDArray[float], outputs: str | list[int] = "xaybl", chunk_size: int = 16384
+	                  ) -> NDArray[float]:
+		""" push a whole ensemble of rays thru the map at once, like evaluate(), but with everything in COSY's
+			own coordinates (x and y in m, a and b as slopes, l in m, d as the fractional energy deviation)
+		"""
+		output_indices = [cosy_coordinates.index(output) if type(output) is str else output for output in outputs]
+		rays = np.atleast_2d(np.asarray(rays, dtype=float))
+		num_variables = min(rays.shape[1], self.exponents.shape[1])
+		# terms with any power of a coordinate we weren't given are zero
+		relevant = np.all(self.exponents[:, num_variables:] == 0, axis=1)
+		exponents = self.exponents[relevant, :num_variables]
+		coefficients = self.cosy_coefficients[relevant][:, output_indices]
+		rays = rays[:, :num_variables]
+
+		# each monomial is some lower monomial times one more coordinate, so if we build them up in order
+		# (filling in any lower ones the map happens to skip) every term costs a single multiplication
+		steps, term_indices = monomial_recipe(exponents)
+		table_coefficients = np.zeros((len(steps) + 1, len(output_indices)))
+		table_coefficients[term_indices] = coefficients
+
+		values = np.empty((rays.shape[0], len(output_indices)))
+		table = np.empty((len(steps) + 1, min(chunk_size, rays.shape[0])))
+		for start in range(0, rays.shape[0], chunk_size):
+			chunk = rays[start:start + chunk_size].T.copy()
+			monomials = table[:, :chunk.shape[1]]
+			monomials[0] = 1
+			for i, (lower, coordinate) in enumerate(steps, start=1):
+				np.multiply(monomials[lower], chunk[coordinate], out=monomials[i])
+			values[start:start + chunk.shape[1]] = monomials.T@table_coefficients
+		return values
+
+
+def variable_scales(num_variables: int) -> NDArray[float]:
+	""" the size of each of the first so many COSY units in SI.  anything past the ones in cosy_units (like the
+		DA parameters in a parameter-dependent map) is taken to be dimensionless.
+	"""
+	scales = np.ones(num_variables)
+	scales[:min(num_variables, cosy_scales.size)] = cosy_scales[:num_variables]
+	return scales
+
+
+def monomial_recipe(exponents: NDArray[int]) -> tuple[list[tuple[int, int]], list[int]]:
+	""" work out how to build every monomial in a map by multiplying a lower one by a single coordinate.
+		returns: the steps, each of which is the index of the lower monomial and the coordinate to multiply it by
+		         (the constant monomial 1 is index 0, and step i makes monomial i + 1), and the index of each
+		         term's monomial
+	"""
+	indices = {(0,)*exponents.shape[1]: 0}
+	steps = []
+	def build(term: tuple[int, ...]) -> int:
+		if term not in indices:
+			coordinate = next(j for j, order in enumerate(term) if order > 0)
+			lower = build(term[:coordinate] + (term[coordinate] - 1,) + term[coordinate + 1:])
+			steps.append((lower, coordinate))
+			indices[term] = len(steps)
+		return indices[term]
+	term_indices = [build(tuple(int(order) for order in term)) for term in exponents]
+	return steps, term_indices
 
 
 if __name__ == "__main__":